@@ -0,0 +1,233 @@
+"""
+Find the histories of chrome profiles in users' home directories, and collect them.
+
+The histories can be used where they are, while chrome may be running, see
+:py:func:`historian.merge.snapshot_history` for how they are read. Or they can be
+collected into a store, see :py:func:`collect_histories`, to be merged elsewhere.
+"""
+import json
+import os
+import pathlib
+import re
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from historian.exceptions import InvalidHistory
+from historian.merge import snapshot_history
+from historian.utils import Fingerprint, file_fingerprint, history_hash
+
+#: Where chrome keeps its profiles, relative to a home directory, on Linux, Windows and macOS
+CHROME_DIRS = (
+    pathlib.Path('.config', 'google-chrome'),
+    pathlib.Path('AppData', 'Local', 'Google', 'Chrome', 'User Data'),
+    pathlib.Path('Library', 'Application Support', 'Google', 'Chrome'),
+)
+
+#: The directories chrome keeps its profiles in
+PROFILE_PATTERN = re.compile(r'^(Default|Profile \d+)$')
+
+#: The profile that is named after the user alone
+DEFAULT_PROFILE = 'Default'
+
+#: The file listing the histories in a store, see :py:func:`collect_histories`
+MANIFEST_NAME = 'manifest.json'
+
+#: The directory of a store the histories are kept in, by their hash
+OBJECTS_DIR = 'objects'
+
+#: The number of threads home directories are scanned and collected with
+COLLECT_WORKERS = 8
+
+#: A history in a store: its hash, the path of its copy relative to the store, and the
+#: path and fingerprint of the history it was collected from
+CollectedHistory = namedtuple('CollectedHistory', 'hash,object,source,size,mtime_ns,inode')
+
+
+def find_profiles(user_data: pathlib.Path) -> List[Tuple[str, pathlib.Path]]:
+    """
+    Find the profiles in a chrome user data directory that have a history.
+
+    :param user_data: The chrome user data directory, i.e. ``~/.config/google-chrome``
+    :return: Pairs of profile name and the path of its history, the default profile first
+    """
+    try:
+        entries = list(user_data.iterdir())
+    except OSError:
+        # Missing, or a home directory we can't read
+        return []
+
+    profiles = []
+    for entry in entries:
+        history = entry / 'History'
+        if PROFILE_PATTERN.match(entry.name) and os.path.isfile(str(history)):
+            profiles.append((entry.name, history))
+    return sorted(profiles, key=lambda profile: (profile[0] != DEFAULT_PROFILE, len(profile[0]), profile[0]))
+
+
+def profile_username(user: str, profile: str) -> str:
+    """
+    Get the username a profile's history is merged as.
+
+    The default profile is merged as the user, like the collect scripts name it, and
+    other profiles as ``user.Profile N``.
+    """
+    return user if profile == DEFAULT_PROFILE else '{}.{}'.format(user, profile)
+
+
+def find_home_histories(home: pathlib.Path) -> Dict[str, pathlib.Path]:
+    """
+    Find the history of every chrome profile in a home directory, named after the directory.
+
+    :return: Dictionary of username to the path of the history
+    """
+    histories = {}
+    for chrome_dir in CHROME_DIRS:
+        for profile, history in find_profiles(home / chrome_dir):
+            histories[profile_username(home.name, profile)] = history
+    return histories
+
+
+def find_live_histories(homes: str) -> Dict[str, pathlib.Path]:
+    """
+    Find the history of every chrome profile of every user.
+
+    :param homes: The directory holding the users' home directories, i.e. ``/home`` or ``C:\\Users``
+    :return: Dictionary of username to the path of the history
+    """
+    histories = {}
+    for user in sorted(os.listdir(homes)):
+        histories.update(find_home_histories(pathlib.Path(homes, user)))
+    return histories
+
+
+def load_manifest(store: pathlib.Path) -> Tuple[Optional[str], Dict[str, CollectedHistory]]:
+    """
+    Read the manifest of a store.
+
+    :return: The digest the histories were hashed with, and the histories by username.
+             ``None`` and no histories if the store has no manifest.
+    """
+    try:
+        with open(str(store / MANIFEST_NAME)) as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return None, {}
+    histories = {}
+    for username, history in manifest['histories'].items():
+        history = CollectedHistory(**history)
+        if ':' not in history.hash:
+            # Written before hashes were stored along with their digest
+            history = history._replace(hash='{}:{}'.format(manifest['digest'], history.hash))
+        histories[username] = history
+    return manifest['digest'], histories
+
+
+def write_manifest(store: pathlib.Path, digest: str, histories: Dict[str, CollectedHistory]):
+    """
+    Replace the manifest of a store, atomically so a merge never reads half of it.
+    """
+    fd, path = tempfile.mkstemp(prefix='.manifest-', dir=str(store))
+    with os.fdopen(fd, 'w') as fp:
+        json.dump({'digest': digest, 'histories': {username: history._asdict()
+                                                   for username, history in sorted(histories.items())}},
+                  fp, indent=2)
+    os.replace(path, str(store / MANIFEST_NAME))
+
+
+def collect_history(store: pathlib.Path, source: pathlib.Path, previous: Optional[CollectedHistory] = None,
+                    digest: str = 'sha256') -> CollectedHistory:
+    """
+    Copy a history into a store, unless it is unchanged since it was last collected.
+
+    The history is snapshotted, see :py:func:`historian.merge.snapshot_history`, and
+    kept by its hash. A history identical to one already in the store isn't kept twice.
+
+    :param store: The store to collect into
+    :param source: The history to collect
+    :param previous: The history as last collected from ``source``
+    :param digest: The digest to hash the history with
+    """
+    fingerprint = file_fingerprint(str(source))
+    if previous is not None and Fingerprint(previous.size, previous.mtime_ns, previous.inode) == fingerprint and \
+            (store / previous.object).is_file():
+        return previous
+
+    fd, snapshot = tempfile.mkstemp(prefix='.collect-', dir=str(store))
+    os.close(fd)
+    try:
+        snapshot_history(source, pathlib.Path(snapshot))
+        hash = history_hash(snapshot, digest)
+        hexdigest = hash.partition(':')[2]
+        object = pathlib.Path(OBJECTS_DIR, hexdigest[:2], hexdigest)
+        if not (store / object).is_file():
+            (store / object).parent.mkdir(parents=True, exist_ok=True)
+            os.replace(snapshot, str(store / object))
+    finally:
+        if os.path.exists(snapshot):
+            os.unlink(snapshot)
+    return CollectedHistory(hash, object.as_posix(), str(source), *fingerprint)
+
+
+def collect_histories(homes: str, store: str, workers: int = COLLECT_WORKERS,
+                      digest: str = 'sha256') -> Dict[str, CollectedHistory]:
+    """
+    Collect the history of every chrome profile of every user into a store.
+
+    Home directories are scanned and histories collected by a pool of threads. Only
+    histories whose fingerprint changed since the last run are copied, the others
+    cost a ``stat``. The store keeps each history under ``objects/`` by its hash, and
+    lists which user has which in its manifest, so a merge can trust the hashes
+    rather than hash every history again. Copies no user has any more are removed.
+
+    :param homes: The directory holding the users' home directories, i.e. ``/home`` or ``C:\\Users``
+    :param store: The directory to collect into
+    :param workers: The number of threads to collect with
+    :param digest: The digest to hash histories with
+    :return: The collected histories, by username
+    """
+    store = pathlib.Path(store)
+    store.mkdir(parents=True, exist_ok=True)
+    previous_digest, previous = load_manifest(store)
+    if previous_digest != digest:
+        previous = {}
+
+    collected = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        found = {}
+        for histories in pool.map(find_home_histories, [pathlib.Path(homes, user) for user in os.listdir(homes)]):
+            found.update(histories)
+
+        futures = {username: pool.submit(collect_history, store, source, previous.get(username), digest)
+                   for username, source in sorted(found.items())}
+        for username, future in futures.items():
+            try:
+                collected[username] = future.result()
+            except (InvalidHistory, OSError) as e:
+                # The copy from the last run is kept rather than dropping the user
+                print("[Historian] {}: Not collected, {}".format(username, e))
+                if username in previous:
+                    collected[username] = previous[username]
+
+    write_manifest(store, digest, collected)
+
+    objects = {history.object for history in collected.values()}
+    for path in (store / OBJECTS_DIR).glob('*/*'):
+        if path.relative_to(store).as_posix() not in objects:
+            path.unlink()
+    return collected
+
+
+def read_store(store: pathlib.Path, digest: str) -> Tuple[Dict[str, pathlib.Path], Dict[str, str]]:
+    """
+    Get the histories of a store to merge.
+
+    :param store: The store, see :py:func:`collect_histories`
+    :param digest: The digest the merge hashes with, hashes in another digest aren't used
+    :return: The paths of the histories and their hashes, by username
+    """
+    manifest_digest, histories = load_manifest(store)
+    dbs = {username: store / history.object for username, history in histories.items()}
+    hashes = {username: history.hash for username, history in histories.items()} if manifest_digest == digest else {}
+    return dbs, hashes
@@ -0,0 +1,79 @@
+"""
+Decode whole columns of timestamps and transitions at once.
+
+:py:func:`historian.utils.webkit_datetime` and the model properties built on it decode
+one value at a time, which dominates reports over millions of visits. The functions
+here take a column of values and return arrays instead: NumPy arrays when NumPy is
+installed, otherwise :py:class:`array.array`.
+"""
+from array import array
+from collections import namedtuple
+from typing import Iterable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+#: Microseconds between the WebKit epoch (01-Jan-1601) and the unix epoch
+WEBKIT_EPOCH_OFFSET = 11644473600 * 1000000
+
+#: The masks of :py:class:`historian.models.TransitionCore` and :py:class:`historian.models.TransitionQualifier`,
+#: repeated here so decoding does not need the ORM
+CORE_MASK = 0xFF
+QUALIFIER_MASK = 0xFFFFFF00
+
+#: A column of visits decoded by :py:func:`decode_visits`
+DecodedVisits = namedtuple('DecodedVisits', 'timestamps,core,qualifier')
+
+
+def _column(values: Iterable[int]):
+    if numpy is not None:
+        if isinstance(values, numpy.ndarray):
+            return values.astype(numpy.int64, copy=False)
+        return numpy.fromiter(values, dtype=numpy.int64)
+    return array('q', values)
+
+
+def decode_times(times: Iterable[int], datetimes: bool = False):
+    """
+    Convert a column of WebKit timestamps to unix timestamps.
+
+    :param times: Timestamps in WebKit's format, e.g. ``visit_time`` or ``last_visit_time``
+    :param datetimes: Return ``datetime64[us]`` values rather than microseconds, needs NumPy
+    :return: Microseconds since the unix epoch (UTC)
+    :raises RuntimeError: If ``datetimes`` is asked for without NumPy installed
+    """
+    times = _column(times)
+    if numpy is not None:
+        epoch = times - WEBKIT_EPOCH_OFFSET
+        return epoch.astype('datetime64[us]') if datetimes else epoch
+
+    if datetimes:
+        raise RuntimeError("NumPy is needed to decode timestamps to datetime64")
+    return array('q', (time - WEBKIT_EPOCH_OFFSET for time in times))
+
+
+def decode_transitions(transitions: Iterable[int]):
+    """
+    Split a column of transitions into their core and qualifier.
+
+    :param transitions: Raw ``transition`` values of visits
+    :return: Tuple of the transition core codes and the transition qualifier flags
+    """
+    transitions = _column(transitions)
+    if numpy is not None:
+        return transitions & CORE_MASK, transitions & QUALIFIER_MASK
+    return (array('q', (transition & CORE_MASK for transition in transitions)),
+            array('q', (transition & QUALIFIER_MASK for transition in transitions)))
+
+
+def decode_visits(times: Iterable[int], transitions: Iterable[int], datetimes: bool = False) -> DecodedVisits:
+    """
+    Decode the timestamps and transitions of a column of visits.
+
+    :param times: The ``visit_time`` of each visit
+    :param transitions: The ``transition`` of each visit
+    :param datetimes: Decode the timestamps to ``datetime64[us]``, see :py:func:`decode_times`
+    """
+    return DecodedVisits(decode_times(times, datetimes), *decode_transitions(transitions))
@@ -13,4 +13,28 @@ class DoesNotExist(Exception):
         """
         super(DoesNotExist, self).__init__("{} with index {} does not exist".format(
             type.__name__, index
-        ))
\ No newline at end of file
+        ))
+
+
+class InvalidHistory(Exception):
+    """
+    Indicates that a chrome history is corrupt or is not a chrome history.
+    """
+    def __init__(self, path, reason):
+        """
+        :param path: The path of the history
+        :param reason: Why the history is invalid
+        """
+        super(InvalidHistory, self).__init__("{} is not a valid history: {}".format(path, reason))
+
+
+class InvalidMergedDatabase(Exception):
+    """
+    Indicates that a database is not merged by this version of chrome historian.
+    """
+    def __init__(self, path, reason):
+        """
+        :param path: The path of the merged database
+        :param reason: Why the merged database can't be used
+        """
+        super(InvalidMergedDatabase, self).__init__("{} is not a valid merged database: {}".format(path, reason))
@@ -1,47 +1,58 @@
 import json
 
-from flask import Flask, render_template, request, jsonify
+from flask import Flask, abort, g, render_template, request, jsonify
 
-from ..models import Visits, Urls
+from ..history import GRAPH_DEPTH, GRAPH_LIMIT
+from ..models import database, TransitionCore, TransitionQualifier, User
 
 app = Flask(__name__)
 
 
+@app.before_request
+def connect_db():
+    g.db_generation = database.check_replaced()
+    database.connect(reuse_if_open=True)
+
+
+@app.teardown_request
+def close_db(exc):
+    # Hands the connection back to the pool for the next request, unless the merged
+    # database was swapped for a new one during the request
+    database.release(g.get('db_generation', database.generation))
+
+
 @app.route('/')
 def index():
     date_lt = request.args.get('date_lt', None)
     date_gt = request.args.get('date_gt', None)
     url_match = request.args.get('url_match', None)
     title_match = request.args.get('title_match', None)
-    limit = request.args.get('limit', 25)
-    start = request.args.get('start', 0)
+    search = request.args.get('search', None)
+    limit = int(request.args.get('limit', 25))
+    cursor = request.args.get('cursor', None)
     username = request.args.get('username', None)
 
-    if limit:
-        limit = int(limit)
-    if start:
-        start = int(start)
-
     hist = app.config['HISTORIES']
-
-    will_paginate = False
     url_count = hist.get_url_count()
-    if limit:
-        if url_count > limit:
-            will_paginate = True
-
-    hist.get_urls(date_lt=date_lt, date_gt=date_gt, url_match=url_match, title_match=title_match, limit=limit,
-                  start=start)
 
     user_list = hist.get_users()
     users = [u.name for u in user_list]
     user = list(filter(lambda u: u.name == username, user_list))[0] if username in users else None
-    urls = hist.get_urls(username=username, date_lt=date_lt, date_gt=date_gt, url_match=url_match,
-                         title_match=title_match, limit=limit, start=start)
+
+    filters = dict(username=username, date_lt=date_lt, date_gt=date_gt, url_match=url_match,
+                   title_match=title_match, search=search)
+    try:
+        page = hist.get_url_page(limit=limit, cursor=cursor, **filters)
+    except ValueError:
+        abort(400)
+
+    # Carried over to the pager links, empty filters are left out
+    filters = {key: value for key, value in filters.items() if value}
+    filters['limit'] = limit
 
     return render_template('index.html', hist=hist, date_lt=date_lt, date_gt=date_gt, url_match=url_match,
-                           title_match=title_match, will_paginate=will_paginate, limit=limit, start=start,
-                           url_count=url_count, users=users, current_user=user, urls=urls)
+                           title_match=title_match, search=search, limit=limit, page=page, filters=filters,
+                           url_count=url_count, users=users, current_user=user, urls=page.urls)
 
 
 @app.route('/graph/<int:user_id>/<int:id>')
@@ -55,41 +66,59 @@ def graph(user_id, id):
 
 @app.route('/graph/<int:user_id>/<int:id>/json')
 def graph_ajax(user_id, id):
-    visits = set(Visits.select().where(Visits.user == user_id, Visits.url == id))
-    data = []
-    left = True
-    visited = set()
+    hist = app.config['HISTORIES']
+    try:
+        depth = int(request.args.get('depth', GRAPH_DEPTH))
+        limit = int(request.args.get('limit', GRAPH_LIMIT))
+    except ValueError:
+        abort(400)
+    if depth < 0 or limit < 1:
+        abort(400)
 
-    while left:
-        visit = visits.pop()
-        visited.add(visit)
-        url = Urls.select().where(Urls.id == visit.url).get()
+    data = []
+    for node in hist.get_visit_graph(user_id, id, depth=depth, limit=limit):
         data.append({
-            "id": visit.id,
-            "url_id": visit.url,
-            "url": url.url,
-            "url_title": url.title,
-            "from": visit.from_visit,
-            "transition": visit.transition,
-            "transition_core": visit.transition_core,
-            "transition_qualifier": visit.transition_qualifier,
+            "id": node.id,
+            "url_id": node.url_id,
+            "url": node.url,
+            "url_title": node.url_title,
+            "from": node.from_visit,
+            "transition": node.transition,
+            "transition_core": TransitionCore(node.transition & TransitionCore.MASK),
+            "transition_qualifier": TransitionQualifier(node.transition & TransitionQualifier.MASK),
+            "depth": node.depth,
         })
+    return jsonify(data)
 
-        if visit.from_visit:
-            from_visit = visit.from_visit
-            if from_visit not in visited:
-                from_visit = Visits.select().where(Visits.id == from_visit).get()
-                visits.add(from_visit)
 
-        to = Visits.select().where(Visits.from_visit == visit.id)
-        if len(to) > 0 and len(visits) < 50 and len(visited) < 50:
-            for to_visit in to:
-                if to_visit not in visited:
-                    visits.add(to_visit)
+def rollup_filters():
+    """
+    Get the filters of a rollup endpoint from the request, 404 if the user doesn't exist.
+    """
+    username = request.args.get('username', None)
+    if username and not User.select().where(User.name == username).exists():
+        abort(404)
+    return dict(username=username, since=request.args.get('since', None), until=request.args.get('until', None))
 
-        if len(visits) == 0:
-            left = False
-    return jsonify(data)
+
+@app.route('/rollups/daily/json')
+def daily_visits_ajax():
+    hist = app.config['HISTORIES']
+    rows = hist.get_daily_visits(**rollup_filters())
+    return jsonify([row._asdict() for row in rows])
+
+
+@app.route('/rollups/hosts/json')
+def top_hosts_ajax():
+    hist = app.config['HISTORIES']
+    try:
+        limit = int(request.args.get('limit', 10))
+    except ValueError:
+        abort(400)
+    if limit < 1:
+        abort(400)
+    rows = hist.get_top_hosts(limit=limit, **rollup_filters())
+    return jsonify([row._asdict() for row in rows])
 
 
 @app.route('/user/')
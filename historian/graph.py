@@ -0,0 +1,160 @@
+"""
+An in-memory index of the ``from_visit`` graph of a single user.
+
+The edges are held as compact integer arrays: the visit ids in order, the position
+of each visit's parent, and the children of every visit in CSR form (``offsets[i]``
+to ``offsets[i + 1]`` in ``targets`` are the children of the ``i``-th visit). Walking
+the graph is then pure array indexing, with no queries.
+"""
+from array import array
+from bisect import bisect_left
+from collections import deque
+from typing import Iterable, List, Optional, Tuple
+
+#: Position used for a visit without a (known) parent
+NO_PARENT = -1
+
+
+class VisitGraph:
+    """
+    The navigation graph of a user's visits.
+
+    :param edges: Pairs of visit id and the id of the visit it came from, ordered by visit id
+    :param hash: The hash of the history the edges were read from
+    """
+    def __init__(self, edges: Iterable[Tuple[int, int]], hash: Optional[str] = None):
+        self.hash = hash
+        self.ids = array('q')
+        from_visits = array('q')
+        for id, from_visit in edges:
+            self.ids.append(id)
+            from_visits.append(from_visit)
+
+        self.parents = array('l', (self._position(from_visit) for from_visit in from_visits))
+
+        counts = array('l', [0]) * (len(self.ids) + 1)
+        for parent in self.parents:
+            if parent != NO_PARENT:
+                counts[parent + 1] += 1
+
+        self.offsets = counts
+        for i in range(len(self.ids)):
+            self.offsets[i + 1] += self.offsets[i]
+
+        self.targets = array('l', [0]) * self.offsets[-1]
+        filled = array('l', self.offsets[:-1])
+        for child, parent in enumerate(self.parents):
+            if parent != NO_PARENT:
+                self.targets[filled[parent]] = child
+                filled[parent] += 1
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: int) -> bool:
+        return self._position(id) != NO_PARENT
+
+    def _position(self, id: int) -> int:
+        i = bisect_left(self.ids, id)
+        if i < len(self.ids) and self.ids[i] == id:
+            return i
+        return NO_PARENT
+
+    def _index(self, id: int) -> int:
+        i = self._position(id)
+        if i == NO_PARENT:
+            raise KeyError(id)
+        return i
+
+    def _children(self, i: int) -> array:
+        return self.targets[self.offsets[i]:self.offsets[i + 1]]
+
+    def parent(self, id: int) -> Optional[int]:
+        """
+        Get the visit the given visit came from, if it is in the graph.
+
+        :raises KeyError: If the visit is not in the graph
+        """
+        parent = self.parents[self._index(id)]
+        return None if parent == NO_PARENT else self.ids[parent]
+
+    def children(self, id: int) -> List[int]:
+        """
+        Get the visits that came from the given visit.
+
+        :raises KeyError: If the visit is not in the graph
+        """
+        return [self.ids[child] for child in self._children(self._index(id))]
+
+    def ancestors(self, id: int) -> List[int]:
+        """
+        Get the chain of visits leading to the given visit, nearest first.
+
+        :raises KeyError: If the visit is not in the graph
+        """
+        chain = []
+        seen = set()
+        i = self.parents[self._index(id)]
+        while i != NO_PARENT and i not in seen:
+            seen.add(i)
+            chain.append(self.ids[i])
+            i = self.parents[i]
+        return chain
+
+    def descendants(self, id: int) -> List[int]:
+        """
+        Get every visit reached from the given visit, nearest first.
+
+        :raises KeyError: If the visit is not in the graph
+        """
+        start = self._index(id)
+        seen = {start}
+        queue = deque([start])
+        found = []
+        while queue:
+            for child in self._children(queue.popleft()):
+                if child not in seen:
+                    seen.add(child)
+                    found.append(self.ids[child])
+                    queue.append(child)
+        return found
+
+    def root(self, id: int) -> int:
+        """
+        Get the visit the chain leading to the given visit starts with.
+
+        :raises KeyError: If the visit is not in the graph
+        """
+        ancestors = self.ancestors(id)
+        return ancestors[-1] if ancestors else id
+
+    def shortest_path(self, source: int, target: int) -> Optional[List[int]]:
+        """
+        Get the shortest path between two visits, following edges in either direction.
+
+        :return: The visit ids from ``source`` to ``target``, or ``None`` if they are not connected
+        :raises KeyError: If either visit is not in the graph
+        """
+        start, end = self._index(source), self._index(target)
+        previous = {start: NO_PARENT}
+        queue = deque([start])
+        while queue and end not in previous:
+            i = queue.popleft()
+            neighbours = list(self._children(i))
+            if self.parents[i] != NO_PARENT:
+                neighbours.append(self.parents[i])
+            for neighbour in neighbours:
+                if neighbour not in previous:
+                    previous[neighbour] = i
+                    queue.append(neighbour)
+
+        if end not in previous:
+            return None
+
+        path = []
+        i = end
+        while i != NO_PARENT:
+            path.append(self.ids[i])
+            i = previous[i]
+        path.reverse()
+        return path
@@ -1,11 +1,20 @@
 import os
+import shutil
+import sys
 from argparse import ArgumentParser
+from multiprocessing import Process
 from pathlib import Path
 
+from historian.collect import COLLECT_WORKERS, MANIFEST_NAME, collect_histories, find_live_histories, read_store
+from historian.exceptions import InvalidMergedDatabase
 from historian.flask import app
 from historian.inspector import InspectorShell
-from historian.history import MultiUserHistory, History
-from historian.utils import get_dbs
+from historian.history import MultiUserHistory, History, ShardedHistory
+from historian.models import READ_ONLY_CACHE_KIB, READ_ONLY_MMAP_SIZE
+from historian.plans import check_query_plans, full_scans
+from historian.server import serve_workers
+from historian.utils import DIGESTS, get_dbs
+from historian.watch import POLL_SECONDS, SETTLE_SECONDS, watch_histories
 
 
 def main():
@@ -14,18 +23,66 @@ def main():
                         ' the current directory')
     parser.add_argument('-m', '--merged', help='Location of the merged history DB', default=None)
     parser.add_argument('-c', '--clean-db', help='Clean merged DB', action='store_true', default=False)
+    parser.add_argument('-w', '--merge-workers', help='Number of workers used to stage histories while merging',
+                        type=int, default=1)
+    parser.add_argument('--verify', help='Hash every history, even if its size and mtime are unchanged',
+                        action='store_true', default=False)
+    parser.add_argument('--digest', help='Digest used to hash histories', choices=DIGESTS, default='sha256')
+    parser.add_argument('--live', help='Merge the history of every chrome profile of the home directories in this '
+                        'directory (i.e. /home), snapshotting them even while chrome is running', metavar='HOMES')
+    merge_mode = parser.add_mutually_exclusive_group()
+    merge_mode.add_argument('--bulk-load', help='Merge with relaxed syncing in a single transaction, faster for '
+                            'large first-time merges', action='store_true', default=False)
+    merge_mode.add_argument('--chunk-size', help='Merge each history in transactions of this many rows, resuming '
+                            'an interrupted merge where it stopped', type=int, default=None)
+    parser.add_argument('--swap', help='Merge into a copy of the merged DB and swap it in once done, so running '
+                        'servers and inspectors never see a merge in progress', action='store_true', default=False)
+    parser.add_argument('--shard', help='Keep the merged DB given by -m as a directory with a shard per user, so '
+                        'merging a user only rewrites theirs', action='store_true', default=False)
     subparsers = parser.add_subparsers()
 
     webapp = subparsers.add_parser('server', help='Run local web version of historian')
     webapp.set_defaults(func=run_webapp)
     webapp.add_argument('-l', '--host', default='127.0.0.1')
-    webapp.add_argument('-p', '--port', default=5000)
+    webapp.add_argument('-p', '--port', type=int, default=5000)
     webapp.add_argument('--debug', action='store_true', default=False)
+    webapp.add_argument('--mmap-size', help='MiB of the merged DB each connection reads through a memory map',
+                        type=int, default=READ_ONLY_MMAP_SIZE // (1024 * 1024))
+    webapp.add_argument('--cache-size', help='MiB of page cache for each connection', type=int,
+                        default=READ_ONLY_CACHE_KIB // 1024)
+    webapp.add_argument('--workers', help='Number of server processes, 0 for one per CPU. Defaults to a single '
+                        'threaded process', type=int, default=1)
+
+    webapp.add_argument('--watch', help='Merge histories as they change while serving, see the watch command',
+                        action='store_true', default=False)
+    add_watch_arguments(webapp)
+
+    watch = subparsers.add_parser('watch', help='Merge histories whenever they are added, changed or deleted')
+    watch.set_defaults(func=run_watch)
+    add_watch_arguments(watch)
+
+    collect = subparsers.add_parser('collect', help='Collect the chrome histories of every user into the store '
+                                    'given by -d, copying only those that changed since the last run')
+    collect.set_defaults(func=run_collect)
+    collect.add_argument('homes', help='The directory holding the home directories. Defaults to /home', nargs='?',
+                         default='/home')
+    collect.add_argument('--threads', help='Number of threads to scan and copy with', type=int,
+                         default=COLLECT_WORKERS)
+
+    combine = subparsers.add_parser('combine', help='Merge databases merged by other historians, i.e. on each host '
+                                    'histories are collected on, into the merged DB given by -m')
+    combine.set_defaults(func=run_combine)
+    combine.add_argument('databases', help='The merged DBs to combine', nargs='+')
 
     inspector = subparsers.add_parser('inspect', help='Inspect a chrome history from the command line')
     inspector.set_defaults(func=run_inspector)
 
+    check_plans = subparsers.add_parser('check-plans', help='Fail if any query the library issues scans a whole table')
+    check_plans.set_defaults(func=run_check_plans)
+
     args = parser.parse_args()
+    if args.shard and (args.swap or args.bulk_load):
+        parser.error("--shard merges one shard at a time, it can't be combined with --swap or --bulk-load")
 
     if 'func' in args:
         args.func(args)
@@ -33,30 +90,132 @@ def main():
         parser.print_usage()
 
 
-def run_webapp(args):
+def add_watch_arguments(parser):
+    parser.add_argument('--settle', help='Seconds a history must stay unchanged before it is merged', type=float,
+                        default=SETTLE_SECONDS)
+    parser.add_argument('--poll', help='Seconds between scans of the histories when inotify is not available',
+                        type=float, default=POLL_SECONDS)
+
+
+def load_history(args):
     if args.histories:
         histories = args.histories
     else:
         histories = os.getcwd()
 
     if args.clean_db and args.merged:
-        if os.path.exists(args.merged):
+        if os.path.isdir(args.merged):
+            print("[Historian] Remove old merged DB")
+            shutil.rmtree(args.merged)
+        elif os.path.exists(args.merged):
             print("[Historian] Remove old merged DB")
             os.unlink(args.merged)
 
+    history_class = ShardedHistory if args.shard else MultiUserHistory
+
+    if args.live:
+        print("[Historian] Using the chrome profiles in {}".format(args.live))
+        return history_class(find_live_histories(args.live), args.merged, merge_workers=args.merge_workers,
+                             verify=args.verify, digest=args.digest, bulk_load=args.bulk_load, swap=args.swap,
+                             chunk_size=args.chunk_size, live=True)
+
     history_path = Path(histories)
 
+    if (history_path / MANIFEST_NAME).is_file():
+        print("[Historian] Using histories collected in {}".format(histories))
+        dbs, hashes = read_store(history_path, args.digest)
+        return history_class(dbs, args.merged, merge_workers=args.merge_workers, verify=args.verify,
+                             digest=args.digest, bulk_load=args.bulk_load, swap=args.swap,
+                             chunk_size=args.chunk_size, hashes=hashes)
+
     if history_path.is_dir():
         dbs = get_dbs(histories)
 
         print("[Historian] Using histories from {}".format(histories))
-        hist = MultiUserHistory(dbs, args.merged)
-    else:
-        print("[Historian] Using history {}".format(histories))
-        hist = History(histories)
+        return history_class(dbs, args.merged, merge_workers=args.merge_workers, verify=args.verify,
+                             digest=args.digest, bulk_load=args.bulk_load, swap=args.swap,
+                             chunk_size=args.chunk_size)
+
+    print("[Historian] Using history {}".format(histories))
+    return History(histories, history_path.name)
+
+
+def run_webapp(args):
+    hist = load_history(args)
+    hist.serve_read_only(mmap_size=args.mmap_size * 1024 * 1024, cache_kib=args.cache_size * 1024)
     app.config['HISTORIES'] = hist
-    app.run(host=args.host, port=args.port, debug=args.debug)
+
+    if args.watch:
+        # The watcher merges in its own process, swapping in each merged DB so requests never see a merge.
+        # Shards are merged in place, as a merge only locks the shard of the user being merged.
+        args.swap = not args.shard
+        args.clean_db = False
+        Process(target=run_watch, args=(args,), daemon=True).start()
+
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        app.debug = args.debug
+        serve_workers(app, args.host, args.port, workers)
+    else:
+        app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
+
+
+def run_watch(args):
+    histories = args.histories or os.getcwd()
+    if args.live or not Path(histories).is_dir() or Path(histories, MANIFEST_NAME).is_file():
+        print("[Historian] Only a directory of histories can be watched, not chrome profiles or a collected store")
+        sys.exit(1)
+
+    hist = load_history(args)
+    try:
+        watch_histories(hist, histories, settle=args.settle, poll=args.poll)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_collect(args):
+    if not args.histories:
+        print("[Historian] Give the store to collect into with -d")
+        sys.exit(1)
+
+    collected = collect_histories(args.homes, args.histories, workers=args.threads, digest=args.digest)
+    print("[Historian] Collected {} histories into {}".format(len(collected), args.histories))
+
+
+def run_combine(args):
+    if not args.merged:
+        print("[Historian] Give the merged DB to combine into with -m")
+        sys.exit(1)
+
+    history_class = ShardedHistory if args.shard else MultiUserHistory
+    hist = history_class({}, args.merged)
+    try:
+        changed = hist.merge_merged(args.databases)
+    except InvalidMergedDatabase as e:
+        print("[Historian] {}".format(e))
+        sys.exit(1)
+    print("[Historian] {} {}".format("Combined into" if changed else "Nothing new to combine into", args.merged))
 
 
 def run_inspector(args):
     InspectorShell(args).cmdloop()
+
+
+def run_check_plans(args):
+    if args.shard:
+        print("[Historian] Query plans can only be checked on a merged DB that isn't sharded")
+        sys.exit(1)
+
+    hist = load_history(args)
+
+    failed = False
+    for plan in check_query_plans(hist):
+        scans = full_scans(plan)
+        failed = failed or bool(scans)
+        print("[{}] {}".format("SCAN" if scans else " OK ", plan.sql))
+        for step in plan.plan:
+            print("       {}".format(step))
+
+    if failed:
+        print("[Historian] Some queries scan a whole table")
+        sys.exit(1)
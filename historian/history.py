@@ -1,35 +1,117 @@
+import os
 import pathlib
 import tempfile
 from collections import namedtuple
-from typing import List, Optional
+from typing import Dict, Iterable, Iterator, List, Optional
 
-from historian.utils import hash_file
-from .models import database, User, Urls, Visits, VisitSource
+from peewee import JOIN, Column, Tuple, fn
+
+from historian.decode import WEBKIT_EPOCH_OFFSET, DecodedVisits, decode_visits
+from historian.exceptions import InvalidMergedDatabase
+from historian.graph import VisitGraph
+from historian.merge import (SOURCE_COLUMNS, KnownHistory, StagedHistory, discard_snapshot, load_staged,
+                             snapshot_database, stage_histories, stage_history)
+from historian.utils import FTS_MIN_WORD_LENGTH, decode_cursor, encode_cursor, file_fingerprint, fts_query
+from .models import (database, create_schema, create_search_index, drop_indexes, drop_search_index, open_merged,
+                     open_read_only, prefetch_visits, INDEX_MODELS, MODELS, READ_ONLY_CACHE_KIB,
+                     READ_ONLY_MMAP_SIZE, SHARD_MODELS, DailyRollup, MergeCheckpoint, RedirectChain, TransitionCore,
+                     TransitionQualifier, User, Urls, UrlsSearch, UserStats, Visits, VisitSource, VisitSourceEnum)
 
 UserRecord = namedtuple('UserRecord', 'id,username,hash')
 
+#: A url as yielded by :py:meth:`MultiUserHistory.iter_urls`
+UrlRow = namedtuple('UrlRow', [field.column_name for field in Urls._meta.sorted_fields])
+
+#: A visit as yielded by :py:meth:`MultiUserHistory.iter_visits`
+VisitRow = namedtuple('VisitRow', [field.column_name for field in Visits._meta.sorted_fields])
+
+#: A page of urls, with the cursors of the pages around it (``None`` if there is no such page)
+UrlPage = namedtuple('UrlPage', 'urls,next,previous')
+
+#: A visit in the navigation graph around a url, ``depth`` is the number of hops from a visit to the url
+GraphNode = namedtuple('GraphNode', 'id,url_id,url,url_title,from_visit,transition,depth')
+
+#: The default number of hops and visits returned by :py:meth:`MultiUserHistory.get_visit_graph`
+GRAPH_DEPTH = 25
+GRAPH_LIMIT = 1000
+
+#: Redirect chains are followed back at most this many hops, in case ``from_visit`` loops
+REDIRECT_CHAIN_MAX_HOPS = 100
+
+#: Microseconds in a day, the unit of :py:class:`DailyRollup`
+DAY_MICROSECONDS = 86400 * 1000000
+
+#: Size of the page cache used while bulk loading, in KiB
+BULK_LOAD_CACHE_KIB = 512 * 1024
+
+#: The highest rowid SQLite allows, i.e. to copy every row of a table
+MAX_ROW_ID = 2 ** 63 - 1
+
+#: The file of a sharded merged database listing the users, see :py:class:`ShardedHistory`
+SHARD_INDEX_NAME = 'index.db'
+
+#: The directory of a sharded merged database holding the shard of each user
+SHARDS_DIR = 'shards'
+
+#: The name a user's shard is attached to the index as
+SHARD_SCHEMA = 'shard'
+
+#: The name a merged database is attached as, see :py:meth:`MultiUserHistory.merge_merged`
+MERGED_SCHEMA = 'mergeddb'
+
+#: The tables of a user copied out of another merged database, see :py:meth:`MultiUserHistory.merge_merged`
+MERGED_COPY_MODELS = [Urls, Visits, VisitSource, RedirectChain, DailyRollup, UserStats]
+
+#: A host as returned by :py:meth:`ShardedHistory.get_top_hosts` across users
+HostRow = namedtuple('HostRow', 'host,visit_count,typed_count,duration')
+
 
 class MultiUserHistory(object):
     """
     Represents a collection of chrome histories. It assumes we have one database per user,
-    and will use the filename of the database in the histories folder as the username.
+    and will use the filename of the database in the histories folder as the username,
+    unless the histories are given as a dictionary of username to path.
 
     :ivar str merged_path: The filepath to the merged database
     :ivar dict dbs: Dictionary containing histories
     :ivar str username: Active username (nicer single user history)
+    :ivar int merge_workers: Number of workers used to stage histories while merging
+    :ivar bool verify: Hash every history, even those whose size, mtime and inode are unchanged
+    :ivar str digest: The digest used to hash histories
+    :ivar bool bulk_load: Merge in bulk-load mode, see :py:meth:`bulk_merge`
+    :ivar int chunk_size: Merge each history in batches of this many rows, see :py:meth:`chunked_merge`
+    :ivar bool live: The histories are in chrome profiles that may be in use, see
+                     :py:func:`historian.merge.snapshot_history`
+    :ivar dict hashes: Hashes of histories known to be right, by username, i.e. from the manifest of a
+                       :py:func:`historian.collect.collect_histories` store
+    :ivar bool search_index: Whether the merged database has a :py:class:`~historian.models.UrlsSearch` index
     """
 
-    def __init__(self, db_paths, merged_path=None):
+    def __init__(self, db_paths, merged_path=None, merge_workers=1, verify=False, digest='sha256', bulk_load=False,
+                 swap=False, chunk_size=None, live=False, hashes=None):
+        if bulk_load and chunk_size:
+            raise ValueError("A bulk load merges in a single transaction, so it can't be chunked")
         if not merged_path:
             merged_path = tempfile.mkstemp(prefix='historian-combined-')[1]
 
         # Setup PeeWee with given path
-        database.init(merged_path)
+        open_merged(merged_path)
         self.merged_path = pathlib.Path(merged_path)
-        db_paths = map(pathlib.Path, db_paths)
         self.dbs = {}
+        self.merge_workers = merge_workers
+        self.verify = verify
+        self.digest = digest
+        self.bulk_load = bulk_load
+        self.chunk_size = chunk_size
+        self.live = live
+        self.hashes = hashes or {}
+        self.swap = swap
+        self._bulk_loading = False
+        self._indexes_dropped = False
+        self.search_index = False
+        self._visit_graphs = {}
         self.find_histories(db_paths)
-        self.merge_history()
+        self.refresh()
 
         # This is needed to make queries work nicer in the frontends for
         # single- vs multi-user  histories
@@ -39,58 +121,590 @@ class MultiUserHistory(object):
         """
         Load the given histories into the dbs dict.
         """
-        for path in db_paths:
+        if isinstance(db_paths, dict):
+            self.dbs.update((username, pathlib.Path(path)) for username, path in db_paths.items())
+            return
+
+        for path in map(pathlib.Path, db_paths):
             self.dbs[path.name] = path
 
-    def merge_history(self):
+    def refresh(self, usernames: Optional[List[str]] = None, dropped: Iterable[str] = ()) -> bool:
+        """
+        Bring the merged database up to date with the histories, swapping in a new merged
+        database if ``swap`` is set, otherwise merging in place.
+
+        See :py:meth:`merge_history` for the parameters.
+        """
+        if self.swap:
+            return self.swap_merge(usernames, dropped)
+        return self.merge_history(usernames, dropped)
+
+    def find_changed(self, usernames: Optional[List[str]] = None) -> List[str]:
+        """
+        Get the users whose history is new or changed since it was last merged, going by
+        the fingerprint of the files.
+
+        :param usernames: Only check these users, rather than every history
+        """
+        known = {user.name: user.fingerprint for user in User.select()}
+        return [username for username in (self.dbs if usernames is None else usernames)
+                if known.get(username) != file_fingerprint(str(self.dbs[username]))]
+
+    def merge_history(self, usernames: Optional[List[str]] = None, dropped: Iterable[str] = ()) -> bool:
         """
         Merge the individual user histories into the merged database.
 
         Individual user database are hashed so avoid re-merging the histories on every
         run. The merged database will be created if it doesn't already exist.
+
+        When ``merge_workers`` is greater than one the histories are hashed, validated and
+        read by a pool of workers, while this thread stays the only writer to the merged
+        database.
+
+        :param usernames: Only merge the histories of these users, rather than every history
+        :param dropped: Users to remove from the merged database, i.e. whose history was deleted
+        :return: Whether any rows of the merged database were changed
         """
         print("[Historian] Merging History")
+        database.connect()
+        try:
+            return self._merge_histories(usernames, dropped)
+        finally:
+            database.close()
+
+    def _merge_histories(self, usernames: Optional[List[str]], dropped: Iterable[str]) -> bool:
+        self.upgrade_schema()
+
+        known_users = {user.name: user for user in User.select()}
+        for username in dropped:
+            if username in known_users:
+                self.drop_user(known_users.pop(username))
+
+        known = {username: KnownHistory(user.hash, user.fingerprint) for username, user in known_users.items()}
+        options = {'verify': self.verify, 'digest': self.digest, 'live': self.live}
+        histories = [(username, db) for username, db in self.dbs.items()
+                     if usernames is None or username in usernames]
+        if self.merge_workers > 1:
+            print("[Historian] Staging histories with {} workers".format(self.merge_workers))
+            # Chunked and live merges attach the history (or its snapshot) rather than stage its rows,
+            # and bulk loads stream them into memory one history at a time, see load_staged
+            read_rows = not (self.bulk_load or self.chunk_size or self.live)
+            staged_histories = stage_histories(histories, known, self.merge_workers, hashes=self.hashes,
+                                               read_rows=read_rows, **options)
+        else:
+            staged_histories = (stage_history(username, db, known.get(username), read_rows=False,
+                                              hash=self.hashes.get(username), **options)
+                                for username, db in histories)
+
+        if self.bulk_load:
+            self.bulk_merge(staged_histories, known_users)
+        else:
+            for staged in staged_histories:
+                try:
+                    self.merge_user(staged, known_users.get(staged.username))
+                finally:
+                    discard_snapshot(staged)
+
+        self.search_index = self.has_search_index()
+        return database.connection().total_changes > 0
+
+    @staticmethod
+    def has_search_index() -> bool:
+        """
+        Whether the merged database has a :py:class:`~historian.models.UrlsSearch` index.
+        """
+        return UrlsSearch.table_exists()
+
+    def upgrade_schema(self):
+        """
+        Create the tables of the merged database, filling in those added since it was
+        created by an older version of historian.
+        """
+        backfill_chains = not RedirectChain.table_exists()
+        backfill_rollups = not DailyRollup.table_exists()
+        backfill_stats = not UserStats.table_exists()
+        create_schema()
+        if backfill_chains:
+            self.import_redirect_chains()
+        if backfill_rollups:
+            self.import_daily_rollups()
+        if backfill_stats:
+            self.count_user_rows()
+
+    @staticmethod
+    def drop_user(user: User):
+        """
+        Remove a user and everything merged from their history.
+        """
+        print("[Historian] {}: Dropping user".format(user.name))
+        with database.atomic():
+            for model in [Urls, Visits, VisitSource, RedirectChain, DailyRollup, UserStats, MergeCheckpoint]:
+                model.delete().where(model.user == user).execute()
+            user.delete_instance()
+
+    def swap_merge(self, usernames: Optional[List[str]] = None, dropped: Iterable[str] = ()) -> bool:
+        """
+        Merge into a copy of the merged database, then swap it in for the live one.
+
+        The copy is taken next to the merged database with SQLite's backup API and
+        merged as usual, while the live database stays untouched for anyone reading
+        it. It then replaces the live database with an atomic rename: readers still
+        connected keep reading the old file, and the connection pool of
+        :py:class:`historian.models.MergedDatabase` connects new readers to the new one.
+        Nobody sees a half merged database or waits on the merge's locks. If the merge
+        changed nothing the copy is thrown away, and if no history looks changed and no
+        user is dropped it isn't taken at all.
+
+        See :py:meth:`merge_history` for the parameters.
+
+        :return: Whether the merged database was replaced
+        """
         if not self.merged_path.exists():
-            database.connect()
-            print("[Historian] Creating merged database")
-            database.create_tables([User, Urls, Visits, VisitSource])
-
-        for username, db in self.dbs.items():
-            print("[Historian] {}: Loading history for user".format(username))
-            hash = hash_file(str(db))
-
-            new = False
-            if User.select().where(User.name == username).count() < 1:
-                User.create(name=username, hash=hash)
-                new = True
-            user = User.select().where(User.name == username).get()
+            return self.merge_history(usernames, dropped)
+        if not dropped and not self.verify and not self.find_changed(usernames):
+            print("[Historian] Histories unchanged, keeping the merged DB")
+            return False
+
+        next_path = self.merged_path.with_name(self.merged_path.name + '.next')
+        print("[Historian] Copying merged DB to {}".format(next_path))
+        snapshot_database(self.merged_path, next_path)
+
+        open_merged(str(next_path))
+        try:
+            changed = self.merge_history(usernames, dropped)
+            database.close_all()
+            if changed:
+                print("[Historian] Swapping in the new merged DB")
+                os.replace(str(next_path), str(self.merged_path))
+            else:
+                next_path.unlink()
+        except BaseException:
+            database.close_all()
+            next_path.unlink()
+            raise
+        finally:
+            open_merged(str(self.merged_path))
+        return changed
+
+    def bulk_merge(self, staged_histories: Iterable[StagedHistory], known_users: Dict[str, User]):
+        """
+        Merge the staged histories in bulk-load mode.
 
-            if user.hash == hash and not new:
-                print("[Historian] {} already loaded and latest version".format(username))
+        The merged database is switched to WAL with relaxed syncing and a large cache, and
+        every user is merged in a single transaction. On a first-time merge the secondary
+        indexes are dropped and rebuilt once all rows are in. Once finished the database is
+        checkpointed, synced and switched back to its usual journal mode.
+
+        The rows of each history are copied into memory before they are merged, so the
+        largest history has to fit in memory, though only one is held at a time.
+        """
+        print("[Historian] Bulk loading merged database")
+        database.execute_sql("PRAGMA journal_mode = WAL")
+        database.execute_sql("PRAGMA synchronous = OFF")
+        database.execute_sql("PRAGMA cache_size = -{}".format(BULK_LOAD_CACHE_KIB))
+        database.execute_sql("PRAGMA temp_store = MEMORY")
+
+        # Rows are loaded into memory as a transaction can't detach the databases it read from
+        database.execute_sql("ATTACH ':memory:' AS userdb")
+        self._bulk_loading = True
+        try:
+            with database.atomic():
+                indexes = []
+                if not known_users:
+                    indexes = drop_indexes([Urls, Visits, VisitSource, RedirectChain, DailyRollup])
+                    drop_search_index()
+                    self._indexes_dropped = True
+
+                for staged in staged_histories:
+                    try:
+                        self.merge_user(staged, known_users.get(staged.username))
+                    finally:
+                        discard_snapshot(staged)
+
+                if indexes:
+                    print("[Historian] Rebuilding indexes")
+                    for sql in indexes:
+                        database.execute_sql(sql)
+                    create_search_index()
+                    self.import_redirect_chains()
+                    self.import_daily_rollups()
+        finally:
+            self._bulk_loading = False
+            self._indexes_dropped = False
+            database.execute_sql("DETACH userdb")
+            database.execute_sql("PRAGMA synchronous = FULL")
+            database.execute_sql("PRAGMA wal_checkpoint(TRUNCATE)")
+            database.execute_sql("PRAGMA journal_mode = DELETE")
+
+    def merge_user(self, staged: StagedHistory, user: Optional[User] = None):
+        """
+        Merge a single staged history into the merged database.
+
+        A history that only grew since it was last merged is merged incrementally: only
+        visits newer than the user's ``max_visit_id`` are inserted and only urls that
+        changed are updated. If the history looks truncated or rewritten (i.e. chrome
+        expired old history) the user's rows are rebuilt instead. Either way the merge
+        happens in one transaction, so an interrupted merge never leaves a user half
+        imported, unless ``chunk_size`` is set, see :py:meth:`chunked_merge`.
+
+        :param staged: The staged history, if its rows were not staged the history is attached directly
+        :param user: The user as last merged, if the user has been merged before
+        """
+        username = staged.username
+        print("[Historian] {}: Loading history for user".format(username))
+
+        # A chunked merge left unfinished may have copied rows of another version of the history
+        if user is not None and staged.hash == user.hash and not self.has_checkpoint(user):
+            print("[Historian] {} already loaded and latest version".format(username))
+            if staged.fingerprint != user.fingerprint:
+                User.update(size=staged.fingerprint.size, mtime_ns=staged.fingerprint.mtime_ns,
+                            inode=staged.fingerprint.inode).where(User.id == user.id).execute()
+            return
+
+        # This allows us to perform the import in sqlite, rather than in python
+        if self._bulk_loading:
+            load_staged(database.connection(), staged)
+        elif staged.tables is None:
+            database.execute_sql("ATTACH ? AS userdb", (str(staged.path),))
+        else:
+            database.execute_sql("ATTACH ':memory:' AS userdb")
+            load_staged(database.connection(), staged)
+
+        try:
+            if self.chunk_size and not self._bulk_loading:
+                self.chunked_merge(staged, user)
+                return
+
+            with database.atomic():
+                incremental = False
+                if user is None:
+                    user = User.add(username, staged.hash)
+                    self.import_user(user)
+                elif self.is_append_only(user):
+                    print("[Historian] {} has changed since last load, merging new history".format(username))
+                    incremental = True
+                    self.find_rollup_days(user)
+                    self.import_user(user, incremental=True)
+                else:
+                    print("[Historian] {} has been rewritten since last load, re-merging".format(username))
+                    self.delete_user_rows(user)
+                    self.import_user(user)
+
+                self.finish_user(staged, user, incremental)
+        finally:
+            if not self._bulk_loading:
+                database.execute_sql("DETACH userdb")
+
+    def chunked_merge(self, staged: StagedHistory, user: Optional[User] = None):
+        """
+        Merge the attached ``userdb`` in batches of ``chunk_size`` rows.
+
+        Each batch copies a range of ids of one table in its own transaction, and records
+        how far it got in the user's :py:class:`~historian.models.MergeCheckpoint`. The
+        journal only ever holds one batch, and an interrupted merge of the same history
+        carries on from the last batch. The user's chains, rollups, counts and hash are
+        only updated once every batch is in, so until then the user is merged again on
+        the next run.
+
+        :param staged: The staged history, attached as ``userdb``
+        :param user: The user as last merged, if the user has been merged before
+        """
+        username = staged.username
+        checkpoint = MergeCheckpoint.get_or_none(MergeCheckpoint.user == user) if user else None
+        if checkpoint is not None and checkpoint.hash == staged.hash:
+            print("[Historian] {}: Resuming merge at {} id {}".format(username, checkpoint.source_table,
+                                                                      checkpoint.last_id))
+        else:
+            with database.atomic():
+                incremental = False
+                if user is None:
+                    # Without a hash the user is merged again if this merge doesn't finish
+                    user = User.add(username, '')
+                elif checkpoint is None and self.is_append_only(user):
+                    print("[Historian] {} has changed since last load, merging new history".format(username))
+                    incremental = True
+                else:
+                    print("[Historian] {} has been rewritten since last load, re-merging".format(username))
+                    self.delete_user_rows(user)
+                MergeCheckpoint.replace(user=user, hash=staged.hash, incremental=incremental,
+                                        source_table=next(iter(SOURCE_COLUMNS)), last_id=0).execute()
+            checkpoint = MergeCheckpoint.get(MergeCheckpoint.user == user)
+
+        tables = list(SOURCE_COLUMNS)
+        for table in tables[tables.index(checkpoint.source_table):]:
+            after = checkpoint.last_id if table == checkpoint.source_table else 0
+            while True:
+                until = database.execute_sql(
+                    "SELECT MAX(id) FROM (SELECT id FROM userdb.{} WHERE id > ? ORDER BY id LIMIT ?)".format(table),
+                    (after, self.chunk_size)).fetchone()[0]
+                if until is None:
+                    break
+                with database.atomic():
+                    self.import_table(user, table, checkpoint.incremental, after, until)
+                    MergeCheckpoint.update(source_table=table, last_id=until).where(
+                        MergeCheckpoint.user == user).execute()
+                after = until
+
+        # The days an incremental merge changed can't be told apart once it's copied, so all are rebuilt
+        with database.atomic():
+            self.finish_user(staged, user)
+
+    def finish_user(self, staged: StagedHistory, user: User, incremental: bool = False):
+        """
+        Bring the rows derived from a user's merged history up to date once it has been
+        copied, and record the history as merged.
+
+        :param staged: The staged history, attached as ``userdb``
+        :param user: The user the history was merged into
+        :param incremental: Only rebuild the rollups of days found by :py:meth:`find_rollup_days`
+        """
+        # Without their indexes chains and rollups are built for all users at once, once they are rebuilt
+        if not self._indexes_dropped:
+            self.import_redirect_chains(user)
+            self.import_daily_rollups(user, incremental)
+
+        # The merged rows of the user now match the history, so it can be counted instead
+        database.execute_sql(
+            "INSERT INTO user_stats (user_id, url_count, visit_count, visit_source_count) "
+            "SELECT :user_id, (SELECT COUNT(*) FROM userdb.urls), (SELECT COUNT(*) FROM userdb.visits), "
+            "(SELECT COUNT(*) FROM userdb.visit_source) "
+            "ON CONFLICT (user_id) DO UPDATE SET url_count = excluded.url_count, "
+            "visit_count = excluded.visit_count, visit_source_count = excluded.visit_source_count",
+            {'user_id': user.id})
+
+        database.execute_sql(
+            "UPDATE users SET hash = :hash, size = :size, mtime_ns = :mtime_ns, inode = :inode, "
+            "max_visit_id = (SELECT COALESCE(MAX(id), 0) FROM userdb.visits), "
+            "max_url_id = (SELECT COALESCE(MAX(id), 0) FROM userdb.urls) WHERE id = :user_id",
+            dict(staged.fingerprint._asdict(), hash=staged.hash, user_id=user.id))
+        MergeCheckpoint.delete().where(MergeCheckpoint.user == user).execute()
+
+    def merge_merged(self, merged_paths: Iterable[str]) -> bool:
+        """
+        Merge databases merged by other historians into the merged database, i.e. those
+        merged on each host histories are collected on.
+
+        Users are told apart by name. A user whose history has the same hash as the one
+        already merged for them is skipped. The others are added with a new user id, or replace
+        the rows of the user by that name. Their rows, chains, rollups and counts are
+        copied as they are, a statement per table, rather than merged from their history
+        again. Users whose chunked merge was left unfinished are left out. The merged
+        database can be merged in turn, so histories can be combined host by host.
+
+        :param merged_paths: The merged databases to merge
+        :return: Whether any rows of the merged database were changed
+        :raises InvalidMergedDatabase: If a database wasn't merged by this version of historian
+        """
+        print("[Historian] Merging merged DBs")
+        database.connect()
+        try:
+            # Pooled connections keep counting changes from when they were opened
+            changes = database.connection().total_changes
+            self.upgrade_schema()
+            for path in merged_paths:
+                self.import_merged(pathlib.Path(path))
+            self.search_index = self.has_search_index()
+            return database.connection().total_changes > changes
+        finally:
+            database.close()
+
+    def import_merged(self, path: pathlib.Path):
+        """
+        Copy the users of another merged database, see :py:meth:`merge_merged`.
+        """
+        database.execute_sql("ATTACH ? AS {}".format(MERGED_SCHEMA), (str(path),))
+        try:
+            sources = self.read_merged_users(path)
+        finally:
+            database.execute_sql("DETACH {}".format(MERGED_SCHEMA))
+
+        known_users = {user.name: user for user in User.select()}
+        merged = {(user.name, user.hash) for user in known_users.values()}
+        for source in sources:
+            if (source.username, source.hash) in merged:
+                print("[Historian] {}: Already merged from {}".format(source.username, path))
                 continue
-            elif not new:
-                print("[Historian] {} has changed since last load, re-merging".format(username))
-                Urls.delete().where(Urls.user == user).execute()
-                Visits.delete().where(Visits.user == user).execute()
-                VisitSource.delete().where(VisitSource.user == user).execute()
+            print("[Historian] {}: Copying user from {}".format(source.username, path))
+            self.copy_merged_user(path, source, known_users.get(source.username))
+            merged.add((source.username, source.hash))
+
+    @staticmethod
+    def read_merged_users(path: pathlib.Path) -> List[UserRecord]:
+        """
+        Check that the attached ``mergeddb`` has every table of the merged database, and get its users.
+
+        :return: The users whose merge finished, in order of id
+        :raises InvalidMergedDatabase: If a table or column is missing
+        """
+        for model in MODELS:
+            table = model._meta.table_name
+            columns = {row[1] for row in database.execute_sql(
+                "PRAGMA {}.table_info({})".format(MERGED_SCHEMA, table))}
+            missing = {field.column_name for field in model._meta.sorted_fields} - columns
+            if missing:
+                raise InvalidMergedDatabase(path, "{} is missing {}, merge it again with this version first".format(
+                    table, ", ".join(sorted(missing))))
+
+        cursor = database.execute_sql(
+            "SELECT id, name, hash FROM {0}.users WHERE hash != '' "
+            "AND id NOT IN (SELECT user_id FROM {0}.merge_checkpoints) ORDER BY id".format(MERGED_SCHEMA))
+        return [UserRecord._make(row) for row in cursor]
+
+    def copy_merged_user(self, path: pathlib.Path, source: UserRecord, user: Optional[User] = None):
+        """
+        Copy a user's rows out of another merged database, under the user's id in the merged database.
+
+        :param path: The merged database to copy from, attached as ``mergeddb`` while copying
+        :param source: The user in the merged database copied from
+        :param user: The user by the same name in the merged database, whose rows are replaced
+        """
+        database.execute_sql("ATTACH ? AS {}".format(MERGED_SCHEMA), (str(path),))
+        try:
+            self._copy_merged_user(source, user)
+        finally:
+            database.execute_sql("DETACH {}".format(MERGED_SCHEMA))
+
+    @staticmethod
+    def _copy_merged_user(source: UserRecord, user: Optional[User]):
+        with database.atomic():
+            if user is None:
+                user = User.add(source.username, source.hash)
+            else:
+                for model in MERGED_COPY_MODELS + [MergeCheckpoint]:
+                    model.delete().where(model.user == user).execute()
+
+            for model in MERGED_COPY_MODELS:
+                columns = ", ".join(field.column_name for field in model._meta.sorted_fields
+                                    if field.column_name != 'user_id')
+                database.execute_sql(
+                    "INSERT INTO {0} (user_id, {1}) "
+                    "SELECT :user_id, {1} FROM {2}.{0} WHERE user_id = :source_id".format(
+                        model._meta.table_name, columns, MERGED_SCHEMA),
+                    {'user_id': user.id, 'source_id': source.id})
+
+            # The fingerprint is of a history on another host, so any history here is hashed again
+            database.execute_sql(
+                "UPDATE users SET (hash, max_visit_id, max_url_id) = "
+                "(SELECT hash, max_visit_id, max_url_id FROM {}.users WHERE id = :source_id), "
+                "size = 0, mtime_ns = 0, inode = 0 WHERE id = :user_id".format(MERGED_SCHEMA),
+                {'user_id': user.id, 'source_id': source.id})
 
-            # This allows us to perform the import in sqlite, rather than in python
-            database.execute_sql("ATTACH ? AS userdb", (str(db),))
+    @staticmethod
+    def has_checkpoint(user: User) -> bool:
+        """
+        Check whether a chunked merge of the user was left unfinished.
+        """
+        return MergeCheckpoint.select().where(MergeCheckpoint.user == user).exists()
+
+    @staticmethod
+    def delete_user_rows(user: User):
+        """
+        Delete the urls, visits and visit sources merged for a user, before merging them again.
+        """
+        Urls.delete().where(Urls.user == user).execute()
+        Visits.delete().where(Visits.user == user).execute()
+        VisitSource.delete().where(VisitSource.user == user).execute()
+
+    @staticmethod
+    def is_append_only(user: User) -> bool:
+        """
+        Check whether the attached ``userdb`` only grew since the user was last merged.
+
+        Every visit and url merged last time must still be present in the history,
+        and the newest merged visit must be unchanged.
+        """
+        if not user.max_visit_id:
+            return False
+
+        params = {'user_id': user.id, 'max_visit_id': user.max_visit_id, 'max_url_id': user.max_url_id}
+        source = database.execute_sql(
+            "SELECT (SELECT COUNT(*) FROM userdb.visits WHERE id <= :max_visit_id), "
+            "(SELECT visit_time FROM userdb.visits WHERE id = :max_visit_id), "
+            "(SELECT COUNT(*) FROM userdb.urls WHERE id <= :max_url_id)", params).fetchone()
+        merged = database.execute_sql(
+            "SELECT (SELECT COUNT(*) FROM visits WHERE user_id = :user_id), "
+            "(SELECT visit_time FROM visits WHERE user_id = :user_id AND id = :max_visit_id), "
+            "(SELECT COUNT(*) FROM urls WHERE user_id = :user_id)", params).fetchone()
+        return source == merged
+
+    @classmethod
+    def import_user(cls, user: User, incremental: bool = False):
+        """
+        Copy the rows of the attached ``userdb`` into the merged database.
+
+        :param user: The user the rows belong to
+        :param incremental: Only copy visits newer than ``user.max_visit_id``, and urls
+                            and visit durations that changed since the last merge
+        """
+        for table in SOURCE_COLUMNS:
+            cls.import_table(user, table, incremental)
 
+    @staticmethod
+    def import_table(user: User, table: str, incremental: bool = False, after: int = 0, until: int = MAX_ROW_ID):
+        """
+        Copy the rows of a table of the attached ``userdb`` into the merged database.
+
+        :param user: The user the rows belong to
+        :param table: The table to copy, one of ``urls``, ``visits`` or ``visit_source``
+        :param incremental: See :py:meth:`import_user`
+        :param after: Only copy rows with an id greater than this
+        :param until: Only copy rows with an id up to this
+        """
+        params = {'user_id': user.id, 'max_visit_id': user.max_visit_id if incremental else 0,
+                  'core_mask': int(TransitionCore.MASK), 'qualifier_mask': int(TransitionQualifier.MASK),
+                  'after': after, 'until': until}
+
+        if table == 'urls' and incremental:
             database.execute_sql(
-                "INSERT INTO urls (user_id, id, url, title, visit_count, typed_count, last_visit_time, hidden, favicon_id) "
-                "SELECT p.id, u.id, u.url, u.title, u.visit_count, u.typed_count, u.last_visit_time, u.hidden, u.favicon_id FROM userdb.urls AS u LEFT JOIN users AS p ON p.name = :username",
-                {'username': username})
+                "INSERT INTO urls "
+                "(user_id, id, url, title, visit_count, typed_count, last_visit_time, hidden, favicon_id) "
+                "SELECT :user_id, u.id, u.url, u.title, u.visit_count, u.typed_count, u.last_visit_time, u.hidden, "
+                "u.favicon_id FROM userdb.urls AS u "
+                "LEFT JOIN urls AS m ON m.user_id = :user_id AND m.id = u.id "
+                "WHERE u.id > :after AND u.id <= :until "
+                "AND (m.id IS NULL OR m.url IS NOT u.url OR m.title IS NOT u.title "
+                "OR m.visit_count IS NOT u.visit_count OR m.typed_count IS NOT u.typed_count "
+                "OR m.last_visit_time IS NOT u.last_visit_time OR m.hidden IS NOT u.hidden "
+                "OR m.favicon_id IS NOT u.favicon_id) "
+                "ON CONFLICT (user_id, id) DO UPDATE SET url = excluded.url, title = excluded.title, "
+                "visit_count = excluded.visit_count, typed_count = excluded.typed_count, "
+                "last_visit_time = excluded.last_visit_time, hidden = excluded.hidden, "
+                "favicon_id = excluded.favicon_id",
+                params)
+        elif table == 'urls':
             database.execute_sql(
-                "INSERT INTO visits (user_id, id, url, visit_time, from_visit, transition, segment_id, visit_duration) "
-                "SELECT u.id, v.id, v.url, v.visit_time, v.from_visit, v.transition, v.segment_id, v.visit_duration FROM userdb.visits AS v LEFT JOIN users AS u ON u.name = :username",
-                {'username': username})
+                "INSERT INTO urls "
+                "(user_id, id, url, title, visit_count, typed_count, last_visit_time, hidden, favicon_id) "
+                "SELECT :user_id, u.id, u.url, u.title, u.visit_count, u.typed_count, u.last_visit_time, u.hidden, "
+                "u.favicon_id FROM userdb.urls AS u "
+                "WHERE u.id > :after AND u.id <= :until",
+                params)
+        elif table == 'visits' and incremental:
+            # Chrome fills in the duration of a visit once the user navigates away
             database.execute_sql(
-                "INSERT INTO visit_source (user_id, id, source)  SELECT u.id, v.id, v.source FROM userdb.visit_source AS v LEFT JOIN users AS u ON u.name = :username",
-                {'username': username}, require_commit=True)
-
-            database.execute_sql("DETACH userdb")
-        database.close()
+                "INSERT INTO visits (user_id, id, url, visit_time, from_visit, transition, segment_id, visit_duration, "
+                "transition_core, transition_qualifier) "
+                "SELECT :user_id, v.id, v.url, v.visit_time, v.from_visit, v.transition, v.segment_id, "
+                "v.visit_duration, v.transition & :core_mask, v.transition & :qualifier_mask FROM userdb.visits AS v "
+                "LEFT JOIN visits AS m ON m.user_id = :user_id AND m.id = v.id "
+                "WHERE v.id > :after AND v.id <= :until "
+                "AND (v.id > :max_visit_id OR m.visit_duration IS NOT v.visit_duration) "
+                "ON CONFLICT (user_id, id) DO UPDATE SET visit_duration = excluded.visit_duration",
+                params)
+        elif table == 'visits':
+            database.execute_sql(
+                "INSERT INTO visits (user_id, id, url, visit_time, from_visit, transition, segment_id, visit_duration, "
+                "transition_core, transition_qualifier) "
+                "SELECT :user_id, v.id, v.url, v.visit_time, v.from_visit, v.transition, v.segment_id, "
+                "v.visit_duration, v.transition & :core_mask, v.transition & :qualifier_mask FROM userdb.visits AS v "
+                "WHERE v.id > :after AND v.id <= :until",
+                params)
+        else:
+            database.execute_sql(
+                "INSERT INTO visit_source (user_id, id, source) "
+                "SELECT :user_id, v.id, v.source FROM userdb.visit_source AS v "
+                "WHERE v.id > :after AND v.id <= :until AND v.id > :max_visit_id",
+                params)
 
     def get_users(self) -> List[UserRecord]:
         """
@@ -99,6 +713,14 @@ class MultiUserHistory(object):
         users = User.select()
         return list(users)
 
+    def serve_read_only(self, mmap_size: int = READ_ONLY_MMAP_SIZE, cache_kib: int = READ_ONLY_CACHE_KIB):
+        """
+        Switch to read-only connections to the merged database, once it has been merged.
+
+        See :py:func:`historian.models.open_read_only`.
+        """
+        open_read_only(str(self.merged_path), mmap_size, cache_kib)
+
     def get_user(self, user_id: Optional[int] = None, username: Optional[str] = None) -> User:
         """
         Get the given user by user id or username.
@@ -115,44 +737,148 @@ class MultiUserHistory(object):
         """
         return User.select().count()
 
-    def get_url_count(self, username: Optional[str] = None) -> int:
+    def get_url_count(self, username: Optional[str] = None, live: bool = False) -> int:
         """
         Get the number of urls in the merged database.
 
         :param username: Username to filter and count on
+        :param live: Count the urls themselves rather than read the count kept when merging
         """
-        if username:
-            user = User.select().where(User.name == username).get()
-            return Urls.select().where(Urls.user == user).count()
-        else:
-            return Urls.select().count()
+        return self._count(Urls, UserStats.url_count, username, live)
+
+    @staticmethod
+    def _count(model, stat, username, live):
+        user = User.select().where(User.name == username).get() if username else None
+        if live:
+            query = model.select()
+            return (query.where(model.user == user) if user else query).count()
+
+        query = UserStats.select(fn.COALESCE(fn.SUM(stat), 0))
+        return (query.where(UserStats.user == user) if user else query).scalar()
 
     def get_url_by_id(self, id: int, user_id: int) -> Urls:
         """
         Get a url by the url id and user id.
         """
-        return Urls.select().where(Urls.id == id, Urls.user == user_id).get()
+        return Urls.select(Urls, User).join(User).where(Urls.id == id, Urls.user == user_id).get()
 
-    def get_urls(self, *, username=None, date_lt=None, date_gt=None, url_match=None, title_match=None, limit=None,
-                 start=None):
+    @staticmethod
+    def import_redirect_chains(user: Optional[User] = None):
         """
-        Retrieve all urls for a given username, if a username is not given, get all urls in all users.
+        Rebuild the :py:class:`RedirectChain` rows of a user from their merged visits.
 
-        :param str username: Search in this user's database
-        :param int date_lt: Search for all urls last visited before this date
-        :param int date_gt: Search for all urls last visited after this date
-        :param str url_match: Search for urls matching this pattern
-        :param str title_match: Search for urls with titles matching this pattern
-        :param int limit:  Restrict search to this many urls
-        :param int start: Start the search with this offset, can only be used with `limit`
+        Chains are followed back from each visit ending a redirect chain to the visit that
+        started it. The whole chain is rebuilt each time, as chrome fills in the duration
+        of the last visit of a chain after it was first merged.
+
+        :param user: The user to rebuild the chains of, all users if not given
+        """
+        params = {'user_id': user.id if user else None, 'chain_start': int(TransitionQualifier.CHAIN_START),
+                  'chain_end': int(TransitionQualifier.CHAIN_END), 'max_hops': REDIRECT_CHAIN_MAX_HOPS}
+        where = "user_id = :user_id AND " if user else ""
+        database.execute_sql("DELETE FROM redirect_chains" + (" WHERE user_id = :user_id" if user else ""), params)
+        database.execute_sql(
+            "WITH RECURSIVE chain (user_id, end_visit, end_url, id, url, from_visit, transition, visit_time, hops, "
+            "duration) AS ("
+            "SELECT user_id, id, url, id, url, from_visit, transition, visit_time, 0, visit_duration FROM visits "
+            "WHERE " + where + "(transition & :chain_end) AND NOT (transition & :chain_start) "
+            "UNION ALL "
+            "SELECT c.user_id, c.end_visit, c.end_url, v.id, v.url, v.from_visit, v.transition, v.visit_time, "
+            "c.hops + 1, c.duration + v.visit_duration FROM chain AS c "
+            "JOIN visits AS v ON v.user_id = c.user_id AND v.id = c.from_visit "
+            "WHERE NOT (c.transition & :chain_start) AND c.hops < :max_hops) "
+            "INSERT INTO redirect_chains (user_id, start_visit, end_visit, start_url, end_url, hops, "
+            "duration, visit_time) "
+            "SELECT user_id, id, end_visit, url, end_url, hops, duration, visit_time FROM chain "
+            "WHERE transition & :chain_start",
+            params)
+
+    @staticmethod
+    def count_user_rows():
+        """
+        Recount the :py:class:`UserStats` of every user from the merged tables.
+        """
+        database.execute_sql("DELETE FROM user_stats")
+        database.execute_sql(
+            "INSERT INTO user_stats (user_id, url_count, visit_count, visit_source_count) "
+            "SELECT u.id, (SELECT COUNT(*) FROM urls WHERE user_id = u.id), "
+            "(SELECT COUNT(*) FROM visits WHERE user_id = u.id), "
+            "(SELECT COUNT(*) FROM visit_source WHERE user_id = u.id) FROM users AS u")
+
+    @staticmethod
+    def find_rollup_days(user: User):
+        """
+        Find the days an incremental merge of the attached ``userdb`` is going to change.
+
+        These are the days of visits newer than ``user.max_visit_id`` or whose duration
+        changed. They are kept in ``temp.rollup_days`` by the timestamp the day starts at,
+        for :py:meth:`import_daily_rollups`.
+        """
+        database.execute_sql("CREATE TEMP TABLE IF NOT EXISTS rollup_days (start INTEGER PRIMARY KEY)")
+        database.execute_sql("DELETE FROM temp.rollup_days")
+        database.execute_sql(
+            "INSERT OR IGNORE INTO temp.rollup_days (start) "
+            "SELECT (v.visit_time - :epoch) / :day * :day + :epoch FROM userdb.visits AS v "
+            "LEFT JOIN visits AS m ON m.user_id = :user_id AND m.id = v.id "
+            "WHERE v.id > :max_visit_id OR m.visit_duration IS NOT v.visit_duration",
+            {'user_id': user.id, 'max_visit_id': user.max_visit_id, 'epoch': WEBKIT_EPOCH_OFFSET,
+             'day': DAY_MICROSECONDS})
+
+    @staticmethod
+    def import_daily_rollups(user: Optional[User] = None, incremental: bool = False):
+        """
+        Rebuild the :py:class:`DailyRollup` rows of a user from their merged visits.
+
+        :param user: The user to rebuild the rollups of, all users if not given
+        :param incremental: Only rebuild the days found by :py:meth:`find_rollup_days`
+        """
+        params = {'user_id': user.id if user else None, 'epoch': WEBKIT_EPOCH_OFFSET, 'day': DAY_MICROSECONDS,
+                  'typed': int(TransitionCore.TYPED)}
+        insert = (
+            "INSERT INTO daily_rollups (user_id, day, host, visit_count, typed_count, duration) "
+            "SELECT v.user_id, date((v.visit_time - :epoch) / 1000000, 'unixepoch'), url_host(u.url), COUNT(*), "
+            "SUM(v.transition_core = :typed), SUM(v.visit_duration) ")
+        urls = "LEFT JOIN urls AS u ON u.user_id = v.user_id AND u.id = v.url "
+        group = "GROUP BY 1, 2, 3"
+
+        if incremental:
+            database.execute_sql(
+                "DELETE FROM daily_rollups WHERE user_id = :user_id AND day IN "
+                "(SELECT date((start - :epoch) / 1000000, 'unixepoch') FROM temp.rollup_days)", params)
+            # CROSS JOIN keeps the few changed days as the outer loop
+            database.execute_sql(
+                insert + "FROM temp.rollup_days AS d CROSS JOIN visits AS v ON v.user_id = :user_id "
+                "AND v.visit_time >= d.start AND v.visit_time < d.start + :day " + urls + group, params)
+        elif user:
+            database.execute_sql("DELETE FROM daily_rollups WHERE user_id = :user_id", params)
+            database.execute_sql(insert + "FROM visits AS v " + urls + "WHERE v.user_id = :user_id " + group, params)
+        else:
+            database.execute_sql("DELETE FROM daily_rollups")
+            database.execute_sql(insert + "FROM visits AS v " + urls + group, params)
+
+    def query_urls(self, *, username=None, date_lt=None, date_gt=None, url_match=None, title_match=None,
+                   search=None, transition=None, qualifier=None, source=None):
+        """
+        Build a query for urls matching the given filters, see :py:meth:`get_urls`.
         """
         where = []
-        query = Urls.select()
+        query = Urls.select().join(User)
+
+        if transition is not None or qualifier is not None or source is not None:
+            visits = Visits.select(Visits.id).where(Visits.user == Urls.user, Visits.url == Urls.id)
+            where.append(fn.EXISTS(self.filter_visits(visits, transition=transition, qualifier=qualifier,
+                                                      source=source)))
 
         if username:
             user = User.select().where(User.name == username).get()
             where.append(Urls.user == user)
-            query = query.join(User)
+
+        # The search index answers LIKE filters on its columns as well as MATCH
+        text = Urls
+        if self.search_index and (url_match or title_match or search):
+            text = UrlsSearch
+            on = (Urls.user == UrlsSearch.rowid / (1 << 32)) & (Urls.id == UrlsSearch.rowid.bin_and(0xFFFFFFFF))
+            query = query.join_from(Urls, UrlsSearch, on=on)
 
         if date_lt:
             where.append(Urls.last_visit_time < date_lt)
@@ -161,44 +887,740 @@ class MultiUserHistory(object):
             where.append(Urls.last_visit_time > date_gt)
 
         if url_match:
-            where.append(Urls.url ** '%{}%'.format(url_match))
+            where.append(text.url ** '%{}%'.format(url_match))
 
         if title_match:
-            where.append(Urls.title ** '%{}%'.format(title_match))
+            where.append(text.title ** '%{}%'.format(title_match))
+
+        if search:
+            words = search.split()
+            indexed = [word for word in words if len(word) >= FTS_MIN_WORD_LENGTH] if self.search_index else []
+            if indexed:
+                where.append(UrlsSearch.match(fts_query(" ".join(indexed))))
+                query = query.order_by(UrlsSearch.rank())
+            for word in words:
+                if word not in indexed:
+                    where.append((Urls.url ** '%{}%'.format(word)) | (Urls.title ** '%{}%'.format(word)))
 
         if len(where) > 0:
             query = query.where(*where)
 
+        return query
+
+    def get_urls(self, *, username=None, date_lt=None, date_gt=None, url_match=None, title_match=None, search=None,
+                 transition=None, qualifier=None, source=None, limit=None, start=None, with_visits=False):
+        """
+        Retrieve all urls for a given username, if a username is not given, get all urls in all users.
+
+        :param str username: Search in this user's database
+        :param int date_lt: Search for all urls last visited before this date
+        :param int date_gt: Search for all urls last visited after this date
+        :param str url_match: Search for urls matching this pattern
+        :param str title_match: Search for urls with titles matching this pattern
+        :param str search: Full-text search of the url and title, results are ordered by relevance
+        :param TransitionCore transition: Only urls with a visit of this transition type
+        :param TransitionQualifier qualifier: Only urls with a visit that has all of these transition flags
+        :param VisitSourceEnum source: Only urls with a visit from this source
+        :param int limit:  Restrict search to this many urls
+        :param int start: Start the search with this offset, can only be used with `limit`
+        :param bool with_visits: Load the visits of every url up front, rather than a query per url
+        """
+        query = self.query_urls(username=username, date_lt=date_lt, date_gt=date_gt, url_match=url_match,
+                                title_match=title_match, search=search, transition=transition, qualifier=qualifier,
+                                source=source).select_extend(*User._meta.sorted_fields)
+
         if limit:
             query = query.limit(int(limit))
 
             if start:
                 query = query.offset(int(start))
 
+        if with_visits:
+            return prefetch_visits(list(query))
         return list(query)
 
+    def get_url_page(self, *, limit: int = 25, cursor: Optional[str] = None, **filters) -> UrlPage:
+        """
+        Retrieve one page of urls, most recently visited first.
+
+        Pages are found by seeking to the ``(last_visit_time, user_id, id)`` of the url the
+        cursor points at, so every page costs the same as the first no matter how deep it is.
+        Full-text searches are ordered by relevance instead, and are paged by offset.
+
+        :param limit: The number of urls on a page
+        :param cursor: The :py:attr:`UrlPage.next` or :py:attr:`UrlPage.previous` cursor of
+                       another page, the first page is returned if not given
+        :param filters: Filters as accepted by :py:meth:`get_urls`
+        :raises ValueError: If the cursor is invalid
+        """
+        limit = int(limit)
+        kind, key = decode_cursor(cursor) if cursor else (None, None)
+
+        # Cursors are opaque to clients, so one that decodes may still not be one of ours
+        searching = bool(filters.get('search') and self.search_index)
+        key_lengths = {'offset': 1} if searching else {'after': 3, 'before': 3}
+        if kind is not None and key_lengths.get(kind) != len(key):
+            raise ValueError("Invalid cursor {}".format(cursor))
+
+        if searching:
+            offset = key[0] if kind == 'offset' else 0
+            if offset < 0:
+                raise ValueError("Invalid cursor {}".format(cursor))
+            urls = self._search_page(filters, offset, limit + 1)
+            next = encode_cursor('offset', [offset + limit]) if len(urls) > limit else None
+            previous = encode_cursor('offset', [max(offset - limit, 0)]) if offset else None
+            return UrlPage(urls[:limit], next, previous)
+
+        urls = self._seek_page(filters, kind, key, limit + 1)
+        more, urls = len(urls) > limit, urls[:limit]
+        if kind == 'before':
+            urls.reverse()
+
+        if not urls:
+            return UrlPage(urls, None, None)
+
+        first = [urls[0].last_visit_time, urls[0].user_id, urls[0].id]
+        last = [urls[-1].last_visit_time, urls[-1].user_id, urls[-1].id]
+        if kind == 'before':
+            return UrlPage(urls, encode_cursor('after', last), encode_cursor('before', first) if more else None)
+        return UrlPage(urls, encode_cursor('after', last) if more else None,
+                       encode_cursor('before', first) if key else None)
+
+    def _search_page(self, filters: dict, offset: int, limit: int) -> List[Urls]:
+        """
+        Get the urls of a full-text search, by relevance, for :py:meth:`get_url_page`.
+        """
+        return list(self.query_urls(**filters).select_extend(*User._meta.sorted_fields).offset(offset).limit(limit))
+
+    def _seek_page(self, filters: dict, kind: Optional[str], key: Optional[list], limit: int) -> List[Urls]:
+        """
+        Get the urls past a cursor's ``(last_visit_time, user_id, id)`` for :py:meth:`get_url_page`.
+
+        :return: The urls in the order they are paged, oldest first if ``kind`` is ``before``
+        """
+        query = self.query_urls(**filters).select_extend(*User._meta.sorted_fields)
+
+        # With a single user the user_id is fixed, leaving the (user_id, last_visit_time, id) index to seek on
+        if filters.get('username'):
+            columns = (Urls.last_visit_time, Urls.id)
+            key = key and (key[0], key[2])
+        else:
+            columns = (Urls.last_visit_time, Urls.user, Urls.id)
+
+        if kind == 'before':
+            query = query.where(Tuple(*columns) > Tuple(*key)).order_by(*[column.asc() for column in columns])
+        else:
+            if key:
+                query = query.where(Tuple(*columns) < Tuple(*key))
+            query = query.order_by(*[column.desc() for column in columns])
+
+        return list(query.limit(limit))
+
     def get_id_for_user(self, username: str) -> int:
         """
         Get the user id for a given username
         """
         return User.select(User.id).where(User.name == username).get().id
 
-    def get_visit_count(self) -> int:
+    def get_visit_count(self, username: Optional[str] = None, live: bool = False) -> int:
         """
-        Get the number of visits for the url.
+        Get the number of visits in the merged database.
+
+        :param username: Username to filter and count on
+        :param live: Count the visits themselves rather than read the count kept when merging
+        """
+        return self._count(Visits, UserStats.visit_count, username, live)
+
+    def get_visit_source_count(self, username: Optional[str] = None, live: bool = False) -> int:
         """
-        return Visits.select().count()
+        Get the number of visit sources in the merged database.
+
+        :param username: Username to filter and count on
+        :param live: Count the visit sources themselves rather than read the count kept when merging
+        """
+        return self._count(VisitSource, UserStats.visit_source_count, username, live)
 
     def get_visit_by_id(self, visit_id: int, user_id: int) -> Visits:
         """
         Get a visit for this url by the visit id and user id.
         """
-        return Visits.select().where(Visits.user == user_id, Visits.id == visit_id).get()
+        return Visits.select_with_url().where(Visits.user == user_id, Visits.id == visit_id).get()
+
+    def get_visit_graph(self, user_id: int, url_id: int, *, depth: int = GRAPH_DEPTH,
+                        limit: int = GRAPH_LIMIT) -> List[GraphNode]:
+        """
+        Get the navigation graph around a url: its visits, and the visits they came from
+        or led to, transitively.
+
+        The graph is walked in a single recursive query, nearest visits first. Visits the
+        url's visits came from are followed back through ``from_visit`` only, and visits
+        they led to forward only, so the walk never doubles back and ``limit`` bounds the
+        visits found. Each direction is its own recursive step so both are looked up by
+        index, which needs SQLite 3.34 or later.
+
+        :param user_id: The user the url belongs to
+        :param url_id: The url to start from
+        :param depth: Follow at most this many hops from a visit to the url
+        :param limit: Return at most this many visits
+        """
+        params = {'user_id': user_id, 'url_id': url_id, 'depth': int(depth), 'limit': int(limit)}
+        cursor = database.execute_sql(
+            "WITH RECURSIVE graph (id, from_visit, depth, direction) AS ("
+            "SELECT id, from_visit, 0, 0 FROM visits WHERE user_id = :user_id AND url = :url_id "
+            "UNION "
+            "SELECT v.id, v.from_visit, graph.depth + 1, -1 FROM graph "
+            "JOIN visits AS v ON v.user_id = :user_id AND v.id = graph.from_visit "
+            "WHERE graph.direction <= 0 AND graph.depth < :depth AND v.url != :url_id "
+            "UNION "
+            "SELECT v.id, v.from_visit, graph.depth + 1, 1 FROM graph "
+            "JOIN visits AS v ON v.user_id = :user_id AND v.from_visit = graph.id "
+            "WHERE graph.direction >= 0 AND graph.depth < :depth AND v.url != :url_id "
+            "ORDER BY 3 LIMIT :limit) "
+            "SELECT v.id, v.url, u.url, u.title, v.from_visit, v.transition, nodes.depth "
+            "FROM (SELECT id, MIN(depth) AS depth FROM graph GROUP BY id) AS nodes "
+            "JOIN visits AS v ON v.user_id = :user_id AND v.id = nodes.id "
+            "JOIN urls AS u ON u.user_id = :user_id AND u.id = v.url "
+            "ORDER BY nodes.depth, v.id LIMIT :limit",
+            params)
+        return [GraphNode._make(row) for row in cursor]
+
+    def get_visit_graph_index(self, user_id: int) -> VisitGraph:
+        """
+        Get the in-memory index of a user's ``from_visit`` graph.
+
+        The index is built on first use and rebuilt once the user's history is merged
+        with a different hash.
+
+        :param user_id: The user to get the index for
+        """
+        user = self.get_user(user_id=user_id)
+        graph = self._visit_graphs.get(user.id)
+        if graph is None or graph.hash != user.hash:
+            cursor = database.execute_sql("SELECT id, from_visit FROM visits WHERE user_id = ? ORDER BY id", (user.id,))
+            graph = self._visit_graphs[user.id] = VisitGraph(cursor, user.hash)
+        return graph
+
+    def query_redirect_chains(self, *, username=None, start_url=None, end_url=None):
+        """
+        Build a query for redirect chains matching the given filters.
+
+        :param str username: Only chains followed by this user
+        :param int start_url: Only chains starting with the url with this id, requires ``username``
+        :param int end_url: Only chains landing on the url with this id, requires ``username``
+        """
+        where = []
+        query = RedirectChain.select()
+
+        if username:
+            user = User.select().where(User.name == username).get()
+            where.append(RedirectChain.user == user)
+
+            if start_url:
+                where.append(RedirectChain.start_url == start_url)
+
+            if end_url:
+                where.append(RedirectChain.end_url == end_url)
+
+        if len(where) > 0:
+            query = query.where(*where)
+
+        return query
+
+    def query_rollups(self, *columns, username=None, since=None, until=None):
+        """
+        Build a query over the :py:class:`DailyRollup` rows matching the given filters.
+
+        :param columns: The columns to select
+        :param str username: Only the rollups of this user
+        :param str since: Only days on or after this ``YYYY-MM-DD`` date
+        :param str until: Only days on or before this ``YYYY-MM-DD`` date
+        """
+        where = []
+        query = DailyRollup.select(*columns)
+
+        if username:
+            user = User.select().where(User.name == username).get()
+            where.append(DailyRollup.user == user)
+
+        if since:
+            where.append(DailyRollup.day >= since)
+
+        if until:
+            where.append(DailyRollup.day <= until)
+
+        if len(where) > 0:
+            query = query.where(*where)
+
+        return query
+
+    def get_daily_visits(self, **filters) -> list:
+        """
+        Get the number of visits per user per day, read from the rollups.
+
+        :param filters: Filters as accepted by :py:meth:`query_rollups`
+        :return: Rows of ``user_id``, ``day``, ``visit_count``, ``typed_count`` and ``duration``, by day
+        """
+        # Selected as a column, older peewee names the foreign key field ``user`` even when aliased
+        user_id = Column(DailyRollup._meta.table, 'user_id').alias('user_id')
+        query = self.query_rollups(
+            user_id, DailyRollup.day, fn.SUM(DailyRollup.visit_count).alias('visit_count'),
+            fn.SUM(DailyRollup.typed_count).alias('typed_count'), fn.SUM(DailyRollup.duration).alias('duration'),
+            **filters)
+        return list(query.group_by(DailyRollup.user, DailyRollup.day)
+                    .order_by(DailyRollup.day, DailyRollup.user).namedtuples())
+
+    def get_top_hosts(self, *, limit: int = 10, **filters) -> list:
+        """
+        Get the most visited hosts, read from the rollups.
+
+        :param limit: The number of hosts to get
+        :param filters: Filters as accepted by :py:meth:`query_rollups`
+        :return: Rows of ``host``, ``visit_count``, ``typed_count`` and ``duration``, most visited first
+        """
+        visit_count = fn.SUM(DailyRollup.visit_count)
+        query = self.query_rollups(
+            DailyRollup.host, visit_count.alias('visit_count'), fn.SUM(DailyRollup.typed_count).alias('typed_count'),
+            fn.SUM(DailyRollup.duration).alias('duration'), **filters)
+        return list(query.group_by(DailyRollup.host).order_by(visit_count.desc(), DailyRollup.host)
+                    .limit(int(limit)).namedtuples())
+
+    def query_visits(self, *, username=None, url_id=None, date_lt=None, date_gt=None, transition=None,
+                     qualifier=None, source=None):
+        """
+        Build a query for visits matching the given filters.
+
+        :param str username: Only visits by this user
+        :param int url_id: Only visits to the url with this id, requires ``username``
+        :param int date_lt: Only visits before this date
+        :param int date_gt: Only visits after this date
+        :param TransitionCore transition: Only visits of this transition type
+        :param TransitionQualifier qualifier: Only visits that have all of these transition flags
+        :param VisitSourceEnum source: Only visits from this source
+        """
+        where = []
+        query = self.filter_visits(Visits.select(), transition=transition, qualifier=qualifier, source=source)
+
+        if username:
+            user = User.select().where(User.name == username).get()
+            where.append(Visits.user == user)
+
+            if url_id:
+                where.append(Visits.url == url_id)
+
+        if date_lt:
+            where.append(Visits.visit_time < date_lt)
+
+        if date_gt:
+            where.append(Visits.visit_time > date_gt)
+
+        if len(where) > 0:
+            query = query.where(*where)
+
+        return query
+
+    @staticmethod
+    def filter_visits(query, *, transition=None, qualifier=None, source=None):
+        """
+        Restrict a query on visits to the given transition and source.
+
+        :param TransitionCore transition: Only visits of this transition type
+        :param TransitionQualifier qualifier: Only visits that have all of these transition flags
+        :param VisitSourceEnum source: Only visits from this source
+        """
+        if transition is not None:
+            query = query.where(Visits.core == int(transition))
+
+        if qualifier is not None:
+            query = query.where(Visits.qualifier.bin_and(int(qualifier)) == int(qualifier))
+
+        # Chrome only records the source of visits that were not browsed locally
+        if source is not None:
+            on = (VisitSource.user == Visits.user) & (VisitSource.id == Visits.id)
+            if source == VisitSourceEnum.BROWSED:
+                query = query.join(VisitSource, JOIN.LEFT_OUTER, on=on)
+                query = query.where(fn.COALESCE(VisitSource.source, int(source)) == int(source))
+            else:
+                query = query.join(VisitSource, on=on).where(VisitSource.source == int(source))
+
+        return query
+
+    def decode_visits(self, *, datetimes: bool = False, **filters) -> DecodedVisits:
+        """
+        Decode the times and transitions of the visits matching the given filters as columns.
+
+        :param datetimes: Decode the times to ``datetime64[us]``, see :py:func:`historian.decode.decode_times`
+        :param filters: Filters as accepted by :py:meth:`query_visits`
+        """
+        sql, params = self.query_visits(**filters).select(Visits.visit_time, Visits.transition).sql()
+        rows = database.execute_sql(sql, params).fetchall()
+        times, transitions = zip(*rows) if rows else ((), ())
+        return decode_visits(times, transitions, datetimes)
+
+    def iter_urls(self, *, batch_size: int = 1000, **filters) -> Iterator[UrlRow]:
+        """
+        Stream the urls matching the given filters.
+
+        Rows are fetched from a single cursor ``batch_size`` at a time and yielded as
+        :py:data:`UrlRow` tuples rather than models, so memory use stays flat no matter
+        how many urls there are.
+
+        :param batch_size: The number of rows fetched at a time
+        :param filters: Filters as accepted by :py:meth:`get_urls`
+        """
+        return self._iter_rows(self.query_urls(**filters), UrlRow, batch_size)
+
+    def iter_visits(self, *, batch_size: int = 1000, **filters) -> Iterator[VisitRow]:
+        """
+        Stream the visits matching the given filters, see :py:meth:`iter_urls`.
+
+        :param batch_size: The number of rows fetched at a time
+        :param filters: Filters as accepted by :py:meth:`query_visits`
+        """
+        return self._iter_rows(self.query_visits(**filters), VisitRow, batch_size)
+
+    @staticmethod
+    def _iter_rows(query, row, batch_size):
+        sql, params = query.sql()
+        cursor = database.execute_sql(sql, params)
+        try:
+            for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+                yield from map(row._make, rows)
+        finally:
+            cursor.close()
 
     def __str__(self):
         return "<MultiUserHistory merged:{}>".format(self.merged_path)
 
 
+class ShardedHistory(MultiUserHistory):
+    """
+    A collection of chrome histories merged into a shard per user.
+
+    The merged database is a directory: ``index.db`` holds the users and their counts,
+    and ``shards/<username>.db`` the urls, visits, chains, rollups and search index of
+    each user. Re-merging a user only rewrites their shard, and a query for one user
+    only reads the indexes of theirs.
+
+    A user's shard is attached to the connection as ``shard`` when it is needed, and
+    stays attached until another user's is. The index has none of the tables a shard
+    holds, so the same statements as for a single merged database find them. Queries
+    across users, :py:meth:`get_urls`, :py:meth:`get_url_page`, the counts and the
+    rollups, are run against each shard in turn and their results merged. Urls found
+    by a full-text search are ordered by relevance within each user. Query builders
+    such as :py:meth:`query_urls` only work for one user at a time.
+
+    :ivar merged_dir: The directory of the sharded merged database
+    """
+
+    def __init__(self, db_paths, merged_path=None, **kwargs):
+        if kwargs.get('bulk_load') or kwargs.get('swap'):
+            raise ValueError("A sharded merge writes one shard at a time, so it can't be bulk loaded or swapped")
+        if not merged_path:
+            merged_path = tempfile.mkdtemp(prefix='historian-sharded-')
+
+        self.merged_dir = pathlib.Path(merged_path)
+        (self.merged_dir / SHARDS_DIR).mkdir(parents=True, exist_ok=True)
+        self._shard_pragmas = []
+        super().__init__(db_paths, str(self.merged_dir / SHARD_INDEX_NAME), **kwargs)
+
+    def shard_path(self, username: str) -> pathlib.Path:
+        """
+        Get the path of a user's shard.
+        """
+        return self.merged_dir / SHARDS_DIR / '{}.db'.format(username)
+
+    def use_shard(self, username: str):
+        """
+        Attach the shard of a user, unless it already is, detaching the shard of any other user.
+
+        :raises User.DoesNotExist: If the user has no shard
+        """
+        path = self.shard_path(username).resolve()
+        if self._attached_shard() == str(path):
+            return
+        if not path.is_file():
+            raise User.DoesNotExist("No shard for user {}".format(username))
+
+        self.detach_shard()
+        # Read-only connections are opened by URI, see serve_read_only
+        database.execute_sql("ATTACH ? AS {}".format(SHARD_SCHEMA),
+                             ('{}?mode=ro'.format(path.as_uri()) if self._shard_pragmas else str(path),))
+        for pragma, value in self._shard_pragmas:
+            database.execute_sql("PRAGMA {}.{} = {}".format(SHARD_SCHEMA, pragma, value))
+
+    def detach_shard(self):
+        """
+        Detach the attached shard, if any.
+        """
+        if self._attached_shard() is not None:
+            database.execute_sql("DETACH {}".format(SHARD_SCHEMA))
+
+    @staticmethod
+    def _attached_shard() -> Optional[str]:
+        databases = {row[1]: row[2] for row in database.execute_sql("PRAGMA database_list")}
+        return databases.get(SHARD_SCHEMA)
+
+    def _use_shard_of(self, user_id: int):
+        self.use_shard(self.get_user(user_id=user_id).name)
+
+    @staticmethod
+    def _users() -> List[User]:
+        return list(User.select().order_by(User.id))
+
+    def create_shards(self, usernames: Optional[List[str]] = None):
+        """
+        Create the shards of the users about to be merged, or add the columns missing from
+        shards created by an older version of historian.
+
+        Each shard is opened in place of the index while its tables are created, so this
+        must happen before the merge connects.
+
+        :param usernames: Only the shards of these users, rather than of every history
+        """
+        try:
+            for username in (self.dbs if usernames is None else usernames):
+                open_merged(str(self.shard_path(username)))
+                create_schema(SHARD_MODELS)
+        finally:
+            open_merged(str(self.merged_path))
+
+    def merge_history(self, usernames: Optional[List[str]] = None, dropped: Iterable[str] = ()) -> bool:
+        """
+        Merge the individual user histories, each into its own shard.
+
+        See :py:meth:`MultiUserHistory.merge_history`.
+        """
+        self.create_shards(usernames)
+        return super().merge_history(usernames, dropped)
+
+    def upgrade_schema(self):
+        """
+        Create the tables of the index, those of the shards are created by :py:meth:`create_shards`.
+        """
+        create_schema(INDEX_MODELS)
+
+    def has_search_index(self) -> bool:
+        """
+        Whether the shards have a :py:class:`~historian.models.UrlsSearch` index.
+
+        Every shard is created the same way, so the first user's is checked.
+        """
+        user = User.select().order_by(User.id).first()
+        if user is None:
+            return False
+        self.use_shard(user.name)
+        return database.execute_sql("SELECT 1 FROM {}.sqlite_master WHERE name = ?".format(SHARD_SCHEMA),
+                                    (UrlsSearch._meta.table_name,)).fetchone() is not None
+
+    def merge_merged(self, merged_paths: Iterable[str]) -> bool:
+        """
+        Merge databases merged by other historians, each user into their own shard.
+
+        See :py:meth:`MultiUserHistory.merge_merged`, the merged databases can't be sharded.
+        """
+        merged_paths = [pathlib.Path(path) for path in merged_paths]
+
+        # The shards of users that are going to be copied are created before the merge connects
+        with database.connection_context():
+            create_schema(INDEX_MODELS)
+            merged = {(user.name, user.hash) for user in User.select(User.name, User.hash)}
+            usernames = set()
+            for path in merged_paths:
+                database.execute_sql("ATTACH ? AS {}".format(MERGED_SCHEMA), (str(path),))
+                try:
+                    usernames.update(source.username for source in self.read_merged_users(path)
+                                     if (source.username, source.hash) not in merged)
+                finally:
+                    database.execute_sql("DETACH {}".format(MERGED_SCHEMA))
+        self.create_shards(sorted(usernames))
+        return super().merge_merged(merged_paths)
+
+    def copy_merged_user(self, path: pathlib.Path, source: UserRecord, user: Optional[User] = None):
+        """
+        Copy a user's rows out of another merged database into their shard.
+
+        See :py:meth:`MultiUserHistory.copy_merged_user`.
+        """
+        # Tables named without a schema are looked up in the order databases were attached,
+        # so the shard goes first for its tables to be written rather than those copied from
+        self.use_shard(source.username)
+        super().copy_merged_user(path, source, user)
+
+    def drop_user(self, user: User):
+        """
+        Remove a user from the index, and delete their shard.
+        """
+        print("[Historian] {}: Dropping user".format(user.name))
+        self.detach_shard()
+        with database.atomic():
+            for model in [UserStats, MergeCheckpoint]:
+                model.delete().where(model.user == user).execute()
+            user.delete_instance()
+
+        path = self.shard_path(user.name)
+        if path.exists():
+            path.unlink()
+
+    def merge_user(self, staged: StagedHistory, user: Optional[User] = None):
+        """
+        Merge a single staged history into the user's shard.
+
+        See :py:meth:`MultiUserHistory.merge_user`.
+        """
+        # Attached before the history, so the tables named without a schema are the shard's
+        self.use_shard(staged.username)
+        super().merge_user(staged, user)
+
+    def serve_read_only(self, mmap_size: int = READ_ONLY_MMAP_SIZE, cache_kib: int = READ_ONLY_CACHE_KIB):
+        """
+        Switch to read-only connections to the index, attaching shards read-only as well.
+
+        See :py:func:`historian.models.open_read_only`.
+        """
+        self._shard_pragmas = [('mmap_size', int(mmap_size)), ('cache_size', -int(cache_kib))]
+        super().serve_read_only(mmap_size, cache_kib)
+
+    def _count(self, model, stat, username, live):
+        # The counts kept when merging are in the index
+        if not live:
+            return super()._count(model, stat, username, live)
+        if username:
+            self.use_shard(username)
+            return super()._count(model, stat, username, live)
+        return sum(self._count(model, stat, user.name, live) for user in self._users())
+
+    def get_url_by_id(self, id: int, user_id: int) -> Urls:
+        """
+        Get a url by the url id and user id.
+        """
+        self._use_shard_of(user_id)
+        return super().get_url_by_id(id, user_id)
+
+    def get_visit_by_id(self, visit_id: int, user_id: int) -> Visits:
+        """
+        Get a visit for this url by the visit id and user id.
+        """
+        self._use_shard_of(user_id)
+        return super().get_visit_by_id(visit_id, user_id)
+
+    def get_visit_graph(self, user_id: int, url_id: int, **kwargs) -> List[GraphNode]:
+        """
+        Get the navigation graph around a url, see :py:meth:`MultiUserHistory.get_visit_graph`.
+        """
+        self._use_shard_of(user_id)
+        return super().get_visit_graph(user_id, url_id, **kwargs)
+
+    def get_visit_graph_index(self, user_id: int) -> VisitGraph:
+        """
+        Get the in-memory index of a user's ``from_visit`` graph.
+        """
+        self._use_shard_of(user_id)
+        return super().get_visit_graph_index(user_id)
+
+    def _shard_of(self, username: Optional[str]) -> str:
+        if not username:
+            raise ValueError("A sharded history can only be queried one user at a time")
+        self.use_shard(username)
+        return username
+
+    def query_urls(self, *, username=None, **filters):
+        """
+        Build a query for the urls of a user, see :py:meth:`MultiUserHistory.get_urls`.
+
+        :raises ValueError: If no user is given
+        """
+        return super().query_urls(username=self._shard_of(username), **filters)
+
+    def query_visits(self, *, username=None, **filters):
+        """
+        Build a query for the visits of a user, see :py:meth:`MultiUserHistory.query_visits`.
+
+        :raises ValueError: If no user is given
+        """
+        return super().query_visits(username=self._shard_of(username), **filters)
+
+    def query_redirect_chains(self, *, username=None, **filters):
+        """
+        Build a query for the redirect chains of a user, see :py:meth:`MultiUserHistory.query_redirect_chains`.
+
+        :raises ValueError: If no user is given
+        """
+        return super().query_redirect_chains(username=self._shard_of(username), **filters)
+
+    def query_rollups(self, *columns, username=None, **filters):
+        """
+        Build a query over the rollups of a user, see :py:meth:`MultiUserHistory.query_rollups`.
+
+        :raises ValueError: If no user is given
+        """
+        return super().query_rollups(*columns, username=self._shard_of(username), **filters)
+
+    def get_urls(self, *, username=None, limit=None, start=None, **filters) -> List[Urls]:
+        """
+        Retrieve the urls of a user, or of every user a shard at a time, see :py:meth:`MultiUserHistory.get_urls`.
+        """
+        if username:
+            return super().get_urls(username=username, limit=limit, start=start, **filters)
+
+        # Each shard gives every url that could be in the slice asked for
+        start = int(start or 0) if limit else 0
+        urls = []
+        for user in self._users():
+            urls.extend(super().get_urls(username=user.name, limit=limit and start + int(limit), **filters))
+        return urls[start:start + int(limit)] if limit else urls
+
+    def _search_page(self, filters: dict, offset: int, limit: int) -> List[Urls]:
+        if filters.get('username'):
+            return super()._search_page(filters, offset, limit)
+        return self.get_urls(**dict(filters, limit=limit, start=offset))
+
+    def _seek_page(self, filters: dict, kind: Optional[str], key: Optional[list], limit: int) -> List[Urls]:
+        if filters.get('username'):
+            return super()._seek_page(filters, kind, key, limit)
+
+        urls = []
+        for user in self._users():
+            # Within a shard the cursor's user_id is fixed, so its urls are sought by (last_visit_time, id).
+            # Of the other users, every url at the cursor's last_visit_time falls on one side of it.
+            user_key = key and [key[0], user.id,
+                                key[2] if user.id == key[1] else (MAX_ROW_ID if user.id < key[1] else 0)]
+            urls.extend(super()._seek_page(dict(filters, username=user.name), kind, user_key, limit))
+        urls.sort(key=lambda url: (url.last_visit_time, url.user_id, url.id), reverse=kind != 'before')
+        return urls[:limit]
+
+    def get_daily_visits(self, *, username=None, **filters) -> list:
+        """
+        Get the number of visits per user per day, see :py:meth:`MultiUserHistory.get_daily_visits`.
+        """
+        if username:
+            return super().get_daily_visits(username=username, **filters)
+
+        rows = []
+        for user in self._users():
+            rows.extend(super().get_daily_visits(username=user.name, **filters))
+        return sorted(rows, key=lambda row: (row.day, row.user_id))
+
+    def get_top_hosts(self, *, limit: int = 10, username=None, **filters) -> list:
+        """
+        Get the most visited hosts, see :py:meth:`MultiUserHistory.get_top_hosts`.
+
+        Across users, every host of each shard is summed before the most visited are picked.
+        """
+        if username:
+            return super().get_top_hosts(limit=limit, username=username, **filters)
+
+        hosts = {}
+        for user in self._users():
+            for row in super().get_top_hosts(limit=MAX_ROW_ID, username=user.name, **filters):
+                totals = hosts.get(row.host, (0, 0, 0))
+                hosts[row.host] = tuple(total + (count or 0) for total, count in zip(totals, row[1:]))
+        rows = [HostRow(host, *totals) for host, totals in hosts.items()]
+        return sorted(rows, key=lambda row: (-row.visit_count, row.host))[:int(limit)]
+
+    def __str__(self):
+        return "<ShardedHistory merged:{}>".format(self.merged_dir)
+
+
 class History(MultiUserHistory):
     """
     Represents a chrome history file.
@@ -218,11 +1640,11 @@ class History(MultiUserHistory):
         super().__init__([db_path])
         self.user = User.select().where(User.name == name).get()
 
-    def get_url_count(self, **kwargs) -> int:
+    def get_url_count(self, live: bool = False, **kwargs) -> int:
         """
         Get number of urls in the history
         """
-        return super().get_url_count(self.user.name)
+        return super().get_url_count(self.user.name, live)
 
     def get_url_by_id(self, id: int, **kwargs) -> Urls:
         """
@@ -230,10 +1652,42 @@ class History(MultiUserHistory):
         """
         return super().get_url_by_id(id, self.user.id)
 
-    def get_urls(self, *, date_lt=None, date_gt=None, url_match=None, title_match=None, limit=None,
-                 start=None, **kwargs) -> List[Urls]:
+    def query_urls(self, **kwargs):
+        """
+        Build a query for urls in the history, see :py:meth:`MultiUserHistory.get_urls`.
+        """
+        return super().query_urls(**dict(kwargs, username=self.user.name))
+
+    def query_redirect_chains(self, **kwargs):
+        """
+        Build a query for redirect chains in the history, see :py:meth:`MultiUserHistory.query_redirect_chains`.
+        """
+        return super().query_redirect_chains(**dict(kwargs, username=self.user.name))
+
+    def query_rollups(self, *columns, **kwargs):
+        """
+        Build a query over the rollups of the history, see :py:meth:`MultiUserHistory.query_rollups`.
+        """
+        return super().query_rollups(*columns, **dict(kwargs, username=self.user.name))
+
+    def query_visits(self, **kwargs):
+        """
+        Build a query for visits in the history, see :py:meth:`MultiUserHistory.query_visits`.
+        """
+        return super().query_visits(**dict(kwargs, username=self.user.name))
+
+    def get_url_page(self, **kwargs) -> UrlPage:
+        """
+        Retrieve one page of urls in the history, see :py:meth:`MultiUserHistory.get_url_page`.
+        """
+        return super().get_url_page(**dict(kwargs, username=self.user.name))
+
+    def get_urls(self, *, date_lt=None, date_gt=None, url_match=None, title_match=None, search=None,
+                 transition=None, qualifier=None, source=None, limit=None, start=None, with_visits=False,
+                 **kwargs) -> List[Urls]:
         return super().get_urls(username=self.user.name, date_lt=date_lt, date_gt=date_gt, url_match=url_match,
-                                title_match=title_match, limit=limit, start=start)
+                                title_match=title_match, search=search, transition=transition, qualifier=qualifier,
+                                source=source, limit=limit, start=start, with_visits=with_visits)
 
     @property
     def db_path(self) -> str:
@@ -7,8 +7,10 @@ from typing import Union, Optional
 
 from terminaltables import AsciiTable
 
-from historian.history import History, MultiUserHistory
+from historian.collect import MANIFEST_NAME, find_live_histories, read_store
+from historian.history import History, MultiUserHistory, ShardedHistory
 from historian.inspector import utils
+from historian.models import database
 from historian.utils import get_dbs
 
 
@@ -21,6 +23,8 @@ class BaseShell(cmd.Cmd):
     #: Statically set a custom prompt
     custom_prompt = None
 
+    _db_generation = 0
+
     def get_prompt(self) -> Union[str, bool]:
         """
         Override to dynamically set the prompt.
@@ -43,6 +47,15 @@ class BaseShell(cmd.Cmd):
             pmpt = 'historian> '
         return pmpt
 
+    def precmd(self, line: str) -> str:
+        # Commands run against the current merged database, even if it was swapped for a new one
+        self._db_generation = database.check_replaced()
+        return line
+
+    def postcmd(self, stop: bool, line: str) -> bool:
+        database.release(self._db_generation)
+        return stop
+
     def do_exit(self, arg):
         """Quits the inspector"""
         return True
@@ -143,10 +156,27 @@ class InspectorShell(BaseShell):
     def __init__(self, pargs, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.parser_args = pargs
+        history_class = ShardedHistory if pargs.shard else MultiUserHistory
+        if pargs.live:
+            self.hist = history_class(find_live_histories(pargs.live), pargs.merged,
+                                      merge_workers=pargs.merge_workers, verify=pargs.verify,
+                                      digest=pargs.digest, bulk_load=pargs.bulk_load, swap=pargs.swap,
+                                      chunk_size=pargs.chunk_size, live=True)
+            return
+
         history_path = Path(pargs.histories)
-        if history_path.is_dir():
+        if (history_path / MANIFEST_NAME).is_file():
+            dbs, hashes = read_store(history_path, pargs.digest)
+            self.hist = history_class(dbs, pargs.merged, merge_workers=pargs.merge_workers,
+                                      verify=pargs.verify, digest=pargs.digest,
+                                      bulk_load=pargs.bulk_load, swap=pargs.swap,
+                                      chunk_size=pargs.chunk_size, hashes=hashes)
+        elif history_path.is_dir():
             dbs = get_dbs(history_path)
-            self.hist = MultiUserHistory(dbs, pargs.merged)
+            self.hist = history_class(dbs, pargs.merged, merge_workers=pargs.merge_workers,
+                                      verify=pargs.verify, digest=pargs.digest,
+                                      bulk_load=pargs.bulk_load, swap=pargs.swap,
+                                      chunk_size=pargs.chunk_size)
         else:
             username = history_path.name
             self.hist = History(pargs.histories, username)
@@ -240,14 +270,16 @@ class HistoryShell(SubShell):
         """
         search TYPE CRITERIA
 
-            TYPE := url|title
-            TYPE determines what type of entity is being searched.
+            TYPE := url|title|text
+            TYPE determines what type of entity is being searched, text
+            searches both and orders the results by relevance.
 
             CRITERIA is what to search against.
 
         Example:
             search url github.com
             search title "API Reference"
+            search text "chrome historian"
         """
         parts = shlex.split(args)
         if len(parts) != 2:
@@ -259,6 +291,8 @@ class HistoryShell(SubShell):
             urls = self.hist.get_urls(url_match=predicate)
         elif type == "title":
             urls = self.hist.get_urls(title_match=predicate)
+        elif type == "text":
+            urls = self.hist.get_urls(search=predicate)
         else:
             print("[!!] Invalid type")
             return
@@ -286,14 +320,16 @@ class UserShell(SubShell):
         """
         search TYPE CRITERIA
 
-            TYPE := url|title
-            TYPE determines what type of entity is being searched.
+            TYPE := url|title|text
+            TYPE determines what type of entity is being searched, text
+            searches both and orders the results by relevance.
 
             CRITERIA is what to search against.
 
         Example:
             search url github.com
             search title "API Reference"
+            search text "chrome historian"
         """
         parts = shlex.split(args)
         if len(parts) != 2:
@@ -305,6 +341,8 @@ class UserShell(SubShell):
             urls = self.hist.get_urls(username=self.user.name, url_match=predicate)
         elif type == "title":
             urls = self.hist.get_urls(username=self.user.name, title_match=predicate)
+        elif type == "text":
+            urls = self.hist.get_urls(username=self.user.name, search=predicate)
         else:
             print("[!!] Invalid type")
             return
@@ -449,9 +487,45 @@ class VisitShell(SubShell):
         """
         Inspect the current visit's preceding visit.
         """
-        visit = self.visit.visit_from
+        from_visit = self.hist.get_visit_graph_index(self.user.id).parent(self.visit.id)
+        if from_visit is None:
+            print("[!!] Visit {} has no preceding visit".format(self.visit.id))
+            return
+
+        visit = self.hist.get_visit_by_id(from_visit, user_id=self.user.id)
         url = visit.url_obj
         self.visit = visit
         self.url = url
         self.parent._last_visit = visit.id
         self.parent.url = url
+
+    def do_chain(self, args):
+        """
+        List the chain of visits leading to the current visit, starting with the first.
+        """
+        chain = self.hist.get_visit_graph_index(self.user.id).ancestors(self.visit.id)
+        chain.reverse()
+        print(" -> ".join(str(visit) for visit in chain + [self.visit.id]))
+
+    def do_path(self, args):
+        """
+        Find the shortest path between the current visit and another visit.
+
+        Usage: path VISIT_ID
+        """
+        try:
+            visit_id = int(args)
+        except ValueError:
+            print("[!!] You must specify the visit by ID when using path")
+            return
+
+        try:
+            path = self.hist.get_visit_graph_index(self.user.id).shortest_path(self.visit.id, visit_id)
+        except KeyError:
+            print("[!!] No visit with ID {}".format(visit_id))
+            return
+
+        if path is None:
+            print("[!!] Visit {} is not connected to visit {}".format(visit_id, self.visit.id))
+        else:
+            print(" -> ".join(str(visit) for visit in path))
@@ -0,0 +1,326 @@
+"""
+Helpers used to stage individual chrome histories before they are merged.
+
+Staging (hashing, validating and reading a history) does not touch the merged
+database, so it can be spread across a pool of workers. The rows are then handed
+to the single writer in :py:meth:`historian.history.MultiUserHistory.merge_history`.
+
+Live histories, those chrome may be using, are snapshotted once and the snapshot is
+what gets hashed and merged, see :py:func:`snapshot_history`.
+"""
+import os
+import pathlib
+import sqlite3
+import tempfile
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterable, Iterator, Optional, Tuple
+
+from historian.exceptions import InvalidHistory
+from historian.utils import DIGESTS, file_fingerprint, hash_digest, history_hash
+
+#: The columns copied out of each table in a chrome history
+SOURCE_COLUMNS = {
+    'urls': ('id', 'url', 'title', 'visit_count', 'typed_count', 'last_visit_time', 'hidden', 'favicon_id'),
+    'visits': ('id', 'url', 'visit_time', 'from_visit', 'transition', 'segment_id', 'visit_duration'),
+    'visit_source': ('id', 'source'),
+}
+
+#: A history that has been hashed, and if it changed, read into memory.
+#: ``tables`` is ``None`` when the rows were not staged. If ``snapshot`` is set ``path``
+#: is a snapshot of the history, to be removed with :py:func:`discard_snapshot` once merged.
+StagedHistory = namedtuple('StagedHistory', 'username,path,hash,fingerprint,tables,snapshot')
+StagedHistory.__new__.__defaults__ = (False,)
+
+#: The hash and fingerprint of a history when it was last merged
+KnownHistory = namedtuple('KnownHistory', 'hash,fingerprint')
+
+#: Attempts at an intact snapshot of a history chrome holds locked, before giving up on it
+SNAPSHOT_ATTEMPTS = 3
+
+#: Seconds to wait for chrome to release the lock on a history, before reading it ``immutable``
+SNAPSHOT_LOCK_TIMEOUT = 1
+
+#: Seconds to wait before the second attempt at an ``immutable`` snapshot, doubled for each attempt after
+SNAPSHOT_RETRY_SECONDS = 0.1
+
+
+def open_history(path: pathlib.Path, immutable: bool = False, timeout: float = 5) -> sqlite3.Connection:
+    """
+    Open a chrome history read-only.
+
+    :param path: The path of the history
+    :param immutable: Read the history without taking any locks, i.e. while chrome holds it locked
+    :param timeout: Seconds to wait for a lock on the history
+    """
+    return sqlite3.connect('{}?mode=ro{}'.format(path.resolve().as_uri(), '&immutable=1' if immutable else ''),
+                           uri=True, timeout=timeout)
+
+
+def backup_database(conn: sqlite3.Connection, target: pathlib.Path):
+    """
+    Copy the database ``conn`` is connected to, consistently, to ``target``.
+
+    SQLite's backup API is used where Python has it (3.7 and later), otherwise
+    ``VACUUM INTO``. Either waits as long as the connection's timeout for a read lock,
+    and replaces anything already at ``target``.
+    """
+    if not hasattr(conn, 'backup'):
+        if os.path.exists(str(target)):
+            os.unlink(str(target))
+        conn.execute("VACUUM INTO ?", (str(target),))
+        return
+
+    # The backup API retries a locked database forever, so the read lock is taken first
+    conn.execute("BEGIN")
+    conn.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+    copy = sqlite3.connect(str(target))
+    try:
+        conn.backup(copy)
+    finally:
+        copy.close()
+        conn.rollback()
+
+
+def snapshot_database(source: pathlib.Path, target: pathlib.Path):
+    """
+    Copy the database at ``source`` to ``target``, see :py:func:`backup_database`.
+
+    The copy is consistent even while ``source`` is being read or written, and
+    replaces anything already at ``target``.
+    """
+    conn = open_history(source)
+    try:
+        backup_database(conn, target)
+    finally:
+        conn.close()
+
+
+def snapshot_history(path: pathlib.Path, target: pathlib.Path):
+    """
+    Copy a history, that chrome may be using, to ``target``, see :py:func:`backup_database`.
+
+    The history is read once, under a shared lock, so the snapshot is consistent. A
+    running chrome keeps its history locked though, in which case it is read
+    ``immutable``, without a lock, and the snapshot is checked for having been torn
+    by a write. It is retried up to :py:data:`SNAPSHOT_ATTEMPTS` times, backing off
+    so a write in progress can finish.
+
+    :raises InvalidHistory: If the history is corrupt, or no intact snapshot could be taken
+    """
+    try:
+        conn = open_history(path, timeout=SNAPSHOT_LOCK_TIMEOUT)
+        try:
+            backup_database(conn, target)
+            return
+        finally:
+            conn.close()
+    except sqlite3.OperationalError:
+        pass
+    except sqlite3.DatabaseError as e:
+        raise InvalidHistory(path, str(e))
+
+    for attempt in range(SNAPSHOT_ATTEMPTS):
+        if attempt:
+            time.sleep(SNAPSHOT_RETRY_SECONDS * 2 ** (attempt - 1))
+        try:
+            conn = open_history(path, immutable=True)
+            try:
+                backup_database(conn, target)
+            finally:
+                conn.close()
+            copy = sqlite3.connect(str(target))
+            try:
+                validate_history(copy, path)
+            finally:
+                copy.close()
+            return
+        except sqlite3.DatabaseError as e:
+            error = InvalidHistory(path, str(e))
+        except InvalidHistory as e:
+            error = e
+    raise error
+
+
+def discard_snapshot(staged: StagedHistory):
+    """
+    Remove the snapshot a live history was staged from, once it has been merged.
+    """
+    if staged.snapshot:
+        os.unlink(str(staged.path))
+
+
+def validate_history(conn: sqlite3.Connection, path: pathlib.Path):
+    """
+    Make sure the given history is intact and has the tables we import.
+
+    :raises InvalidHistory: If the history is corrupt or is missing tables
+    """
+    try:
+        result = conn.execute("PRAGMA quick_check").fetchone()[0]
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    except sqlite3.DatabaseError as e:
+        raise InvalidHistory(path, str(e))
+
+    if result != 'ok':
+        raise InvalidHistory(path, result)
+
+    missing = set(SOURCE_COLUMNS) - tables
+    if missing:
+        raise InvalidHistory(path, "missing tables {}".format(", ".join(sorted(missing))))
+
+
+def read_history(path: pathlib.Path) -> Dict[str, list]:
+    """
+    Validate a chrome history and read the rows we import into memory.
+
+    :param path: The path of the history
+    :return: Dictionary of table name to a list of rows
+    """
+    conn = open_history(path)
+    try:
+        validate_history(conn, path)
+        return read_tables(conn)
+    finally:
+        conn.close()
+
+
+def read_tables(conn: sqlite3.Connection) -> Dict[str, list]:
+    """
+    Read the rows we import from a chrome history.
+
+    :return: Dictionary of table name to a list of rows, in order of id
+    """
+    return {
+        table: conn.execute("SELECT {} FROM {} ORDER BY id".format(", ".join(columns), table)).fetchall()
+        for table, columns in SOURCE_COLUMNS.items()
+    }
+
+
+def hash_history(path: pathlib.Path, known: Optional[KnownHistory], digest: str) -> str:
+    """
+    Hash a history with ``digest``, unless it is unchanged since it was last merged.
+
+    A history last merged with another digest is first hashed with that one, so hashes are
+    always compared like with like and switching digest doesn't merge every history again.
+
+    :return: The known hash if the history is unchanged, otherwise its hash with ``digest``
+    """
+    known_digest = hash_digest(known.hash) if known is not None else digest
+    if known_digest != digest and known_digest in DIGESTS:
+        if history_hash(str(path), known_digest) == known.hash:
+            return known.hash
+    return history_hash(str(path), digest)
+
+
+def stage_history(username: str, path: pathlib.Path, known: Optional[KnownHistory] = None,
+                  read_rows: bool = True, verify: bool = False, digest: str = 'sha256',
+                  live: bool = False, hash: Optional[str] = None) -> StagedHistory:
+    """
+    Hash a history and, if it differs from the ``known`` history, read its rows.
+
+    Hashing is skipped entirely if the file's fingerprint matches the known one. A
+    live history is snapshotted to a temporary file, which is hashed and staged in its
+    place, so the history itself is only read once.
+
+    :param username: The user the history belongs to
+    :param path: The path of the history
+    :param known: The history last merged for this user
+    :param read_rows: Read the rows into memory, otherwise only hash the history
+    :param verify: Always hash the history, even if its fingerprint is unchanged
+    :param digest: The digest used to hash the history
+    :param live: The history is in a chrome profile, rather than collected, see :py:func:`snapshot_history`
+    :param hash: The hash of the history if it is already known, i.e. from the manifest of a
+                 :py:func:`historian.collect.collect_histories` store, so it isn't hashed again
+    """
+    def changed(hash: str) -> bool:
+        return known is None or hash != known.hash
+
+    fingerprint = file_fingerprint(str(path))
+    if known is not None and not verify and fingerprint == known.fingerprint:
+        return StagedHistory(username, path, known.hash, fingerprint, None)
+
+    if live:
+        fd, snapshot = tempfile.mkstemp(prefix='historian-snapshot-')
+        os.close(fd)
+        snapshot = pathlib.Path(snapshot)
+        staged = None
+        try:
+            snapshot_history(path, snapshot)
+            hash = hash_history(snapshot, known, digest)
+            if not changed(hash):
+                return StagedHistory(username, path, hash, fingerprint, None)
+            if read_rows:
+                return StagedHistory(username, path, hash, fingerprint, read_history(snapshot))
+            staged = StagedHistory(username, snapshot, hash, fingerprint, None, snapshot=True)
+            return staged
+        finally:
+            if staged is None:
+                os.unlink(str(snapshot))
+
+    if hash is None:
+        hash = hash_history(path, known, digest)
+    if not changed(hash) or not read_rows:
+        return StagedHistory(username, path, hash, fingerprint, None)
+    return StagedHistory(username, path, hash, fingerprint, read_history(path))
+
+
+def stage_histories(histories: Iterable[Tuple[str, pathlib.Path]], known: Dict[str, KnownHistory],
+                    workers: int, hashes: Optional[Dict[str, str]] = None, **kwargs) -> Iterator[StagedHistory]:
+    """
+    Stage histories in a pool of threads, yielding them in the order they were given.
+
+    Yielding them in order keeps the user ids of a merge the same however long each
+    history takes to stage. Only ``workers * 2`` histories are staged ahead of the
+    consumer, so the staged rows held in memory stay bounded no matter how many
+    histories there are.
+
+    :param histories: Pairs of username and history path
+    :param known: Dictionary of username to the history last merged
+    :param workers: The number of threads to stage with
+    :param hashes: The hashes of histories that are already known, by username
+    :param kwargs: Passed on to :py:func:`stage_history`
+    """
+    histories = iter(histories)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while True:
+            for username, path in histories:
+                pending.append(pool.submit(stage_history, username, path, known.get(username),
+                                           hash=(hashes or {}).get(username), **kwargs))
+                if len(pending) >= workers * 2:
+                    break
+
+            if not pending:
+                return
+            yield pending.popleft().result()
+
+
+def load_staged(conn: sqlite3.Connection, staged: StagedHistory):
+    """
+    Load staged rows into the in-memory ``userdb`` schema attached to ``conn``.
+
+    The tables mirror the chrome history, so the same import statements work
+    whether ``userdb`` is the history itself or its staged rows. Rows staged
+    for a previous history are replaced. If the rows weren't staged they are
+    streamed from the history, so they are only held in memory once.
+
+    :raises InvalidHistory: If the rows are streamed from a history that isn't valid
+    """
+    history = None
+    if staged.tables is None:
+        history = open_history(staged.path)
+    try:
+        if history is not None:
+            validate_history(history, staged.path)
+        for table, columns in SOURCE_COLUMNS.items():
+            conn.execute("DROP TABLE IF EXISTS userdb.{}".format(table))
+            conn.execute("CREATE TABLE userdb.{} ({})".format(table, ", ".join(columns)))
+            rows = staged.tables[table] if history is None else \
+                history.execute("SELECT {} FROM {} ORDER BY id".format(", ".join(columns), table))
+            conn.executemany(
+                "INSERT INTO userdb.{} VALUES ({})".format(table, ", ".join("?" * len(columns))), rows)
+    finally:
+        if history is not None:
+            history.close()
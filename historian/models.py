@@ -1,13 +1,127 @@
 from enum import IntFlag, IntEnum
 
 import datetime
+import operator
+import os
+import pathlib
+import threading
+from functools import reduce
 from typing import Optional, List
+from urllib.parse import urlsplit
 
 from peewee import *
+from peewee import ModelSelect
+from playhouse.migrate import SqliteMigrator, migrate
+from playhouse.pool import PooledSqliteDatabase
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
 
-from .utils import webkit_datetime
+from .utils import Fingerprint, webkit_datetime
 
-database = SqliteDatabase(None)
+
+class MergedDatabase(PooledSqliteDatabase):
+    """
+    The pool of connections to the merged database.
+
+    A re-merge may replace the merged database with a new file, see
+    :py:meth:`historian.history.MultiUserHistory.swap_merge`. Connections opened before
+    keep reading the old file, so once :py:meth:`check_replaced` notices the swap they
+    are closed rather than handed out again.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.path = None
+        self.generation = 0
+        self._file = None
+        self._swap_lock = threading.Lock()
+
+    @staticmethod
+    def _identify(path: str):
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return stat.st_dev, stat.st_ino
+
+    def watch(self, path: str):
+        """
+        Follow the merged database at ``path`` being replaced.
+        """
+        self.path = path
+        self._file = self._identify(path)
+
+    def close_idle(self):
+        """
+        Close the connections waiting in the pool, leaving those in use open.
+        """
+        if hasattr(super(), 'close_idle'):
+            return super().close_idle()
+        # peewee only has close_idle from 3.6, before which the pool is a bare heap
+        idle, self._connections = self._connections, []
+        for _, conn in idle:
+            conn.close()
+
+    def close_all(self):
+        """
+        Close every connection in the pool, including this thread's.
+        """
+        # Before peewee 3.6 only the idle connections are closed, so this thread's would
+        # be handed back to the pool and reused after the pool is pointed at another file
+        if not self.is_closed():
+            self.close()
+        super().close_all()
+
+    def check_replaced(self) -> int:
+        """
+        Check whether the merged database has been replaced, and if so close the idle
+        connections to the old one.
+
+        :return: The generation connections taken from the pool now belong to
+        """
+        if self.path is not None:
+            file = self._identify(self.path)
+            if file is not None and file != self._file:
+                with self._swap_lock:
+                    if file != self._file:
+                        self.close_idle()
+                        self._file = file
+                        self.generation += 1
+        return self.generation
+
+    def release(self, generation: int):
+        """
+        Hand this thread's connection back to the pool, or close it if the merged
+        database was replaced since it was taken.
+
+        :param generation: The generation :py:meth:`check_replaced` gave before connecting
+        """
+        if self.is_closed():
+            return
+        with self._swap_lock:
+            if generation == self.generation:
+                self.close()
+            else:
+                self.manual_close()
+
+
+#: Connections are pooled so the web server's request threads reuse open connections
+database = MergedDatabase(None, max_connections=None, check_same_thread=False)
+
+#: Bytes of the merged database read through a memory map by read-only connections
+READ_ONLY_MMAP_SIZE = 1024 * 1024 * 1024
+
+#: Size of the page cache of each read-only connection, in KiB
+READ_ONLY_CACHE_KIB = 64 * 1024
+
+
+@database.func('url_host')
+def url_host(url: Optional[str]) -> str:
+    """
+    Get the host of a url, also available to queries as ``url_host(url)``.
+    """
+    try:
+        return urlsplit(url or '').hostname or ''
+    except ValueError:
+        return ''
 
 
 class BaseModel(Model):
@@ -23,6 +137,33 @@ class User(BaseModel):
     name = CharField(unique=True)
     hash = TextField()
 
+    #: The highest visit id merged from this user's history
+    max_visit_id = IntegerField(default=0)
+
+    #: The highest url id merged from this user's history
+    max_url_id = IntegerField(default=0)
+
+    #: The size, mtime and inode of the history when it was last hashed
+    size = IntegerField(default=0)
+    mtime_ns = IntegerField(default=0)
+    inode = IntegerField(default=0)
+
+    @classmethod
+    def add(cls, name: str, hash: str) -> 'User':
+        """
+        Add a user, read back so its id is set, which ``create`` doesn't do for a plain
+        integer primary key on older peewee.
+        """
+        cls.insert(name=name, hash=hash).execute()
+        return cls.select().where(cls.name == name).get()
+
+    @property
+    def fingerprint(self) -> Fingerprint:
+        """
+        The fingerprint of the history when it was last hashed.
+        """
+        return Fingerprint(self.size, self.mtime_ns, self.inode)
+
     class Meta:
         db_table = 'users'
 
@@ -46,11 +187,11 @@ class Urls(BaseModel):
         """
         A collection of visits related to this url.
         """
-        if not hasattr(self, '_visits'):
-            self._visits = None
-
-        if not self._visits:
-            self._visits = list(Visits.select().where(Visits.user == self.user, Visits.url == self.id))
+        if getattr(self, '_visits', None) is None:
+            visits = list(Visits.select().where(Visits.user == self.user_id, Visits.url == self.id))
+            for visit in visits:
+                visit._url_obj = self
+            self._visits = visits
 
         return self._visits
 
@@ -67,7 +208,8 @@ class Urls(BaseModel):
 
         :param int: The timestamp in webkit format
         """
-        visit = Visits.select().where(Visits.user == self.user, Visits.visit_time == time).get()
+        visit = Visits.select().where(Visits.user == self.user_id, Visits.visit_time == time).get()
+        visit._url_obj = self
         return visit
 
     @property
@@ -81,6 +223,8 @@ class Urls(BaseModel):
         db_table = 'urls'
         indexes = (
             (('user', 'id'), True),
+            (('last_visit_time', 'user', 'id'), False),
+            (('user', 'last_visit_time', 'id'), False),
         )
         primary_key = CompositeKey('id', 'user')
 
@@ -98,21 +242,25 @@ class Visits(BaseModel):
     visit_duration = IntegerField()
     visit_time = IntegerField()
 
+    #: The transition with the TRANSITION_CORE_MASK applied, decoded when merged
+    core = IntegerField(db_column='transition_core', default=0)
+
+    #: The transition with the TRANSITION_QUALIFIER_MASK applied, decoded when merged
+    qualifier = IntegerField(db_column='transition_qualifier', default=0)
+
     @property
     def transition_core(self) -> 'TransitionCore':
         """
         The transition value with the TRANSITION_CORE_MASK applied.
         """
-        core = self.transition & TransitionCore.MASK
-        return TransitionCore(core)
+        return TransitionCore(self.core)
 
     @property
     def transition_qualifier(self) -> 'TransitionQualifier':
         """
         The transition value with the TRANSITION_QUALIFIER_MASK applied.
         """
-        qualifier = self.transition & TransitionQualifier.MASK
-        return TransitionQualifier(qualifier)
+        return TransitionQualifier(self.qualifier)
 
     @property
     def visit_from(self) -> Optional['Visits']:
@@ -121,21 +269,31 @@ class Visits(BaseModel):
         """
         if self.from_visit == 0:
             return None
-        return Visits.select().where(Visits.id == self.from_visit).get()
+        return Visits.select_with_url().where(Visits.user == self.user_id, Visits.id == self.from_visit).get()
 
     @property
     def visits_to(self) -> List['Visits']:
         """
         A list of visits with this visit as the preceding visit.
         """
-        return list(Visits.select().where(Visits.user == self.user, Visits.from_visit == self.id))
+        return list(Visits.select_with_url().where(Visits.user == self.user_id, Visits.from_visit == self.id))
 
     @property
     def url_obj(self) -> Urls:
         """
         Get a reference to the :py:class:`Urls` object associated with this visit.
         """
-        return Urls.select().where(Urls.user == self.user, Urls.id == self.url).get()
+        if getattr(self, '_url_obj', None) is None:
+            self._url_obj = Urls.select().where(Urls.user == self.user_id, Urls.id == self.url).get()
+        return self._url_obj
+
+    @classmethod
+    def select_with_url(cls) -> ModelSelect:
+        """
+        Select visits along with their :py:attr:`url_obj`, so it is loaded in the same query.
+        """
+        return cls.select(cls, Urls).join(Urls, on=((Urls.user == cls.user) & (Urls.id == cls.url)),
+                                          attr='_url_obj')
 
     @property
     def visited(self) -> datetime.datetime:
@@ -145,8 +303,7 @@ class Visits(BaseModel):
         return webkit_datetime(self.visit_time)
 
     def __repr__(self) -> str:
-        visit = self.visit_from
-        if visit:
+        if self.from_visit:
             return "<Visit: {}->{} url({})>".format(self.from_visit, self.id, self.url)
         return "<Visit: {} url({})>".format(self.id, self.url)
 
@@ -154,6 +311,11 @@ class Visits(BaseModel):
         db_table = 'visits'
         indexes = (
             (('user', 'id'), True),
+            (('user', 'url'), False),
+            (('user', 'from_visit'), False),
+            (('user', 'visit_time'), False),
+            (('user', 'core', 'visit_time'), False),
+            (('core', 'visit_time'), False),
         )
         primary_key = CompositeKey('id', 'user')
 
@@ -179,10 +341,140 @@ class VisitSource(BaseModel):
         db_table = 'visit_source'
         indexes = (
             (('user', 'id'), True),
+            (('user', 'source'), False),
         )
         primary_key = CompositeKey('id', 'user')
 
 
+class RedirectChain(BaseModel):
+    """
+    A redirect chain, from the visit a navigation started with to the page it landed on.
+
+    Built from the visits' :py:attr:`TransitionQualifier.CHAIN_START` and
+    :py:attr:`TransitionQualifier.CHAIN_END` bits when a history is merged. Navigations
+    that were not redirected are left out.
+    """
+    user = ForeignKeyField(User, db_column='user_id', related_name='redirect_chains')
+    start_visit = IntegerField()
+    end_visit = IntegerField()
+    start_url = IntegerField()
+    end_url = IntegerField()
+
+    #: The number of redirects between the start and end visit
+    hops = IntegerField()
+
+    #: The total duration of the visits in the chain
+    duration = IntegerField()
+
+    #: The time of the start visit
+    visit_time = IntegerField()
+
+    @property
+    def start_url_obj(self) -> Urls:
+        """
+        Get a reference to the :py:class:`Urls` object the chain started with.
+        """
+        return Urls.select().where(Urls.user == self.user_id, Urls.id == self.start_url).get()
+
+    @property
+    def end_url_obj(self) -> Urls:
+        """
+        Get a reference to the :py:class:`Urls` object the chain landed on.
+        """
+        return Urls.select().where(Urls.user == self.user_id, Urls.id == self.end_url).get()
+
+    class Meta:
+        db_table = 'redirect_chains'
+        indexes = (
+            (('user', 'end_visit'), True),
+            (('user', 'start_url'), False),
+            (('user', 'end_url'), False),
+        )
+        primary_key = CompositeKey('end_visit', 'user')
+
+
+class UserStats(BaseModel):
+    """
+    The number of rows a user has in each table, kept up to date as histories are merged.
+    """
+    user = ForeignKeyField(User, db_column='user_id', primary_key=True, related_name='stats')
+    url_count = IntegerField(default=0)
+    visit_count = IntegerField(default=0)
+    visit_source_count = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'user_stats'
+
+
+class DailyRollup(BaseModel):
+    """
+    The visits of a user to a host on a day, maintained as histories are merged.
+    """
+    user = ForeignKeyField(User, db_column='user_id', related_name='daily_rollups')
+
+    #: The day of the visits, as ``YYYY-MM-DD`` in UTC
+    day = TextField()
+
+    #: The host visited, see :py:func:`url_host`
+    host = TextField()
+
+    visit_count = IntegerField()
+
+    #: The number of visits typed into the omnibar
+    typed_count = IntegerField()
+
+    #: The summed duration of the visits
+    duration = IntegerField()
+
+    class Meta:
+        db_table = 'daily_rollups'
+        indexes = (
+            (('user', 'day', 'host'), True),
+            (('day',), False),
+        )
+        primary_key = CompositeKey('user', 'day', 'host')
+
+
+class MergeCheckpoint(BaseModel):
+    """
+    How far a chunked merge of a user's history got, so an interrupted merge can resume.
+
+    See :py:meth:`historian.history.MultiUserHistory.chunked_merge`.
+    """
+    user = ForeignKeyField(User, db_column='user_id', primary_key=True, related_name='checkpoint')
+
+    #: The hash of the history being merged, the checkpoint is stale once the history changes
+    hash = TextField()
+
+    #: Whether only the rows that changed since the user was last merged are being copied
+    incremental = BooleanField()
+
+    #: The table being copied, and the highest id of it copied so far
+    source_table = TextField()
+    last_id = IntegerField(default=0)
+
+    class Meta:
+        db_table = 'merge_checkpoints'
+
+
+class UrlsSearch(FTS5Model):
+    """
+    Full-text index over the url and title of every :py:class:`Urls`.
+
+    The rowid of each row is ``user_id << 32 | id`` of the url it indexes. The trigram
+    tokenizer lets ``LIKE '%x%'`` filters on its columns use the index as well as ``MATCH``.
+    It is kept in sync with the urls table by triggers, see :py:func:`create_search_index`.
+    """
+    rowid = RowIDField()
+    url = SearchField()
+    title = SearchField()
+
+    class Meta:
+        database = database
+        db_table = 'urls_fts'
+        options = {'tokenize': 'trigram'}
+
+
 class TransitionCore(IntEnum):
     """
     How a visit was generated.
@@ -284,3 +576,162 @@ class VisitSourceEnum(IntEnum):
 
     #: Imported from Safari
     SAFARI_IMPORTED = 5
+
+
+def open_merged(path: str):
+    """
+    Point the models at the merged database at ``path``, for merging.
+    """
+    if database.database is not None:
+        database.close_all()
+    database.init(path, pragmas=[], check_same_thread=False)
+    database.watch(path)
+
+
+def open_read_only(path: str, mmap_size: int = READ_ONLY_MMAP_SIZE, cache_kib: int = READ_ONLY_CACHE_KIB):
+    """
+    Point the models at the merged database at ``path``, read-only, for serving.
+
+    Every thread takes a connection from the pool opened with ``mode=ro`` and
+    ``query_only``, so readers never wait on each other for a write lock, reading the
+    database through a memory map rather than a ``read()`` per page.
+
+    :param path: The merged database
+    :param mmap_size: Bytes of the database to memory map
+    :param cache_kib: Size of the page cache of each connection, in KiB
+    """
+    if database.database is not None:
+        database.close_all()
+    database.init('{}?mode=ro'.format(pathlib.Path(path).resolve().as_uri()), uri=True, check_same_thread=False,
+                  pragmas=[('query_only', 1), ('mmap_size', mmap_size), ('cache_size', -cache_kib)])
+    database.watch(path)
+
+
+#: Every table in the merged database
+MODELS = [User, Urls, Visits, VisitSource, RedirectChain, DailyRollup, UserStats, MergeCheckpoint]
+
+#: The tables of the index of a sharded merged database, see :py:class:`historian.history.ShardedHistory`
+INDEX_MODELS = [User, UserStats, MergeCheckpoint]
+
+#: The tables of each user's shard of a sharded merged database, along with :py:class:`UrlsSearch`
+SHARD_MODELS = [Urls, Visits, VisitSource, RedirectChain, DailyRollup]
+
+
+def create_schema(models: List[BaseModel] = MODELS):
+    """
+    Create the tables of the merged database, and add any columns missing from
+    a merged database created by an older version of historian.
+
+    :param models: The tables to create, the search index is created along with :py:class:`Urls`
+    """
+    # Columns go in first, as the indexes created with the tables may cover them
+    migrator = SqliteMigrator(database)
+    operations = []
+    added = set()
+    for model in models:
+        table = model._meta.table_name
+        if not model.table_exists():
+            continue
+        columns = {column.name for column in database.get_columns(table)}
+        for field in model._meta.sorted_fields:
+            if field.column_name not in columns:
+                operations.append(migrator.add_column(table, field.column_name, field))
+                added.add((table, field.column_name))
+    migrate(*operations)
+
+    if ('visits', 'transition_core') in added:
+        database.execute_sql(
+            "UPDATE visits SET transition_core = transition & ?, transition_qualifier = transition & ?",
+            (int(TransitionCore.MASK), int(TransitionQualifier.MASK)))
+
+    database.create_tables(models)
+    if Urls in models:
+        create_search_index()
+
+    # Hashes are stored along with their digest. Those stored before are taken to be sha256,
+    # which at worst merges a history hashed with another digest once more.
+    for model in [User, MergeCheckpoint]:
+        if model in models:
+            database.execute_sql("UPDATE {} SET hash = 'sha256:' || hash WHERE hash != '' AND instr(hash, ':') = 0"
+                                 .format(model._meta.table_name))
+
+
+def drop_indexes(models: List[BaseModel]) -> List[str]:
+    """
+    Drop the secondary indexes of the given models, i.e. before a large import.
+
+    :return: The statements that recreate the dropped indexes
+    """
+    tables = [model._meta.table_name for model in models]
+    indexes = database.execute_sql(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL AND tbl_name IN ({})".format(
+            ", ".join("?" * len(tables))), tables).fetchall()
+    for name, _ in indexes:
+        database.execute_sql('DROP INDEX "{}"'.format(name))
+    return [sql for _, sql in indexes]
+
+
+#: Triggers keeping :py:class:`UrlsSearch` in sync with the urls table
+SEARCH_INDEX_TRIGGERS = (
+    "CREATE TRIGGER urls_fts_insert AFTER INSERT ON urls BEGIN "
+    "INSERT INTO urls_fts (rowid, url, title) VALUES ((new.user_id << 32) | new.id, new.url, new.title); END",
+    "CREATE TRIGGER urls_fts_delete AFTER DELETE ON urls BEGIN "
+    "DELETE FROM urls_fts WHERE rowid = (old.user_id << 32) | old.id; END",
+    "CREATE TRIGGER urls_fts_update AFTER UPDATE OF url, title ON urls BEGIN "
+    "UPDATE urls_fts SET url = new.url, title = new.title WHERE rowid = (old.user_id << 32) | old.id; END",
+)
+
+
+def create_search_index() -> bool:
+    """
+    Create the :py:class:`UrlsSearch` index, filling it with the urls already merged.
+
+    :return: Whether the index exists, it can't be created if SQLite was built without
+             FTS5 or is too old for the trigram tokenizer
+    """
+    if UrlsSearch.table_exists():
+        return True
+
+    try:
+        with database.atomic():
+            UrlsSearch.create_table()
+            for sql in SEARCH_INDEX_TRIGGERS:
+                database.execute_sql(sql)
+            database.execute_sql(
+                "INSERT INTO urls_fts (rowid, url, title) SELECT (user_id << 32) | id, url, title FROM urls")
+    except OperationalError:
+        return False
+    return True
+
+
+def drop_search_index():
+    """
+    Drop the :py:class:`UrlsSearch` index and its triggers, i.e. before a large import.
+    """
+    for name in ('urls_fts_insert', 'urls_fts_delete', 'urls_fts_update'):
+        database.execute_sql("DROP TRIGGER IF EXISTS {}".format(name))
+    database.execute_sql("DROP TABLE IF EXISTS urls_fts")
+
+
+def prefetch_visits(urls: List[Urls]) -> List[Urls]:
+    """
+    Load the :py:attr:`Urls.visits` of all the given urls with a single query.
+
+    :param urls: The urls to load the visits for
+    :return: The same urls
+    """
+    by_user = {}
+    for url in urls:
+        url._visits = []
+        by_user.setdefault(url.user_id, {})[url.id] = url
+
+    if not by_user:
+        return urls
+
+    where = [(Visits.user == user_id) & Visits.url.in_(list(by_id)) for user_id, by_id in by_user.items()]
+    for visit in Visits.select().where(reduce(operator.or_, where)).order_by(Visits.user, Visits.id):
+        url = by_user[visit.user_id][visit.url]
+        visit._url_obj = url
+        url._visits.append(visit)
+
+    return urls
@@ -0,0 +1,136 @@
+"""
+Checks that the queries historian issues against the merged database are served by
+indexes rather than full table scans.
+
+The read paths of the library are exercised once with sample arguments, the queries
+they issue are captured from peewee's query log and each one is run through
+``EXPLAIN QUERY PLAN``.
+"""
+import logging
+import re
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import List
+
+from historian.models import database, Visits, VisitSourceEnum
+
+#: A query plan step that reads every row of a table
+FULL_SCAN = re.compile(r'^SCAN (TABLE )?\w+( AS \w+)?$')
+
+#: A query plan step that builds a common table expression or subquery
+SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)$')
+
+#: A query and the steps of its plan
+QueryPlan = namedtuple('QueryPlan', 'sql,params,plan')
+
+
+class QueryCapture(logging.Handler):
+    """
+    Collects the queries logged by peewee.
+    """
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.queries = []
+
+    def emit(self, record):
+        if isinstance(record.msg, tuple):
+            self.queries.append(record.msg)
+
+
+@contextmanager
+def capture_queries():
+    """
+    Capture the ``(sql, params)`` of every query issued inside the block.
+    """
+    handler = QueryCapture()
+    logger = logging.getLogger('peewee')
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+    try:
+        yield handler.queries
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+
+def exercise_library(hist, visit: Visits):
+    """
+    Run each read path of the library once.
+
+    Whole-table operations, such as the counts and listing every user, are left out as
+    they scan by nature.
+
+    :param historian.history.MultiUserHistory hist: The history to query
+    :param visit: A visit to use as the sample arguments
+    """
+    url = visit.url_obj
+    user = hist.get_user(user_id=url.user_id)
+
+    hist.get_user(username=user.name)
+    hist.get_id_for_user(user.name)
+    hist.get_url_by_id(url.id, user.id)
+    hist.get_visit_by_id(visit.id, user.id)
+
+    hist.get_urls(username=user.name, limit=25, with_visits=True)
+    hist.get_urls(date_gt=url.last_visit_time - 1, date_lt=url.last_visit_time + 1, limit=25)
+    hist.get_urls(url_match=url.url[:8], limit=25)
+    hist.get_urls(title_match=url.title[:8], limit=25)
+    hist.get_urls(search=url.title or url.url, limit=25)
+    hist.get_urls(username=user.name, transition=visit.transition_core, limit=25)
+
+    since = {'date_gt': visit.visit_time - 1, 'date_lt': visit.visit_time + 1}
+    list(hist.query_visits(transition=visit.transition_core, **since))
+    list(hist.query_visits(username=user.name, transition=visit.transition_core, **since))
+    list(hist.query_visits(username=user.name, source=VisitSourceEnum.SYNCED))
+
+    for filters in ({}, {'username': user.name}, {'date_lt': url.last_visit_time}):
+        page = hist.get_url_page(**filters)
+        if page.next:
+            hist.get_url_page(cursor=page.next, **filters)
+
+    url.visits
+    url.visit_at(visit.visit_time)
+    visit.visit_from
+    visit.visits_to
+    visit.url_obj
+    hist.get_visit_graph(user.id, url.id)
+
+    list(hist.query_redirect_chains(username=user.name, start_url=url.id))
+    list(hist.query_redirect_chains(username=user.name, end_url=url.id))
+
+    day = visit.visited.date().isoformat()
+    hist.get_daily_visits(username=user.name, since=day, until=day)
+    hist.get_daily_visits(since=day, until=day)
+    hist.get_top_hosts(username=user.name, since=day)
+
+
+def check_query_plans(hist) -> List[QueryPlan]:
+    """
+    Get the query plan of every query the library issues.
+
+    :param historian.history.MultiUserHistory hist: The history to query, it needs at least one visit
+    """
+    visit = Visits.select().where(Visits.from_visit > 0).limit(1).first() or Visits.select().limit(1).get()
+    with capture_queries() as queries:
+        exercise_library(hist, visit)
+
+    plans = []
+    seen = set()
+    for sql, params in queries:
+        if sql in seen or not sql.lstrip().upper().startswith(('SELECT', 'WITH')):
+            continue
+        seen.add(sql)
+        plan = [row[-1] for row in database.execute_sql("EXPLAIN QUERY PLAN " + sql, params)]
+        plans.append(QueryPlan(sql, params, plan))
+    return plans
+
+
+def full_scans(plan: QueryPlan) -> List[str]:
+    """
+    Get the steps of a query plan that scan a whole table.
+
+    Scans of common table expressions and subqueries the query builds itself are left out.
+    """
+    built = {match.group(1) for match in map(SUBQUERY.match, plan.plan) if match}
+    return [step for step in plan.plan if FULL_SCAN.match(step) and step.split()[-1] not in built]
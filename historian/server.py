@@ -0,0 +1,104 @@
+"""
+A pre-forking server for the web interface.
+
+The parent binds the listening socket and forks workers that all accept connections
+from it, so requests are spread over as many processes as there are workers and a slow
+query only holds up the thread serving it. The parent does not serve requests itself:
+it waits on the workers and starts a new one whenever one exits.
+"""
+import os
+import signal
+import sys
+import time
+import traceback
+from typing import Callable, Optional
+
+from werkzeug.serving import BaseWSGIServer, make_server
+
+#: Seconds to wait before replacing a worker that exited, so a worker failing on start doesn't spin
+RESTART_DELAY = 1
+
+
+def serve_workers(app, host: str, port: int, workers: int, init_worker: Optional[Callable[[], None]] = None):
+    """
+    Serve ``app`` from ``workers`` forked processes until interrupted.
+
+    Nothing may hold a database connection when this is called, as SQLite connections
+    cannot be shared with forked processes. Each worker opens its own.
+
+    :param app: The WSGI application
+    :param host: Interface to listen on
+    :param port: Port to listen on
+    :param workers: Number of worker processes
+    :param init_worker: Called in each worker once it has been forked
+    :raises RuntimeError: If the platform can't fork
+    """
+    if not hasattr(os, 'fork'):
+        raise RuntimeError("Serving with several workers needs os.fork, which this platform lacks")
+
+    server = make_server(host, port, app, threaded=True)
+    # Every worker selects on the socket, and those that lose the race to accept a
+    # connection must go back to waiting rather than block in accept()
+    server.socket.setblocking(False)
+    print("[Historian] Serving on http://{}:{} with {} workers".format(host, server.port, workers))
+
+    children = set()
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            _run_worker(server, init_worker)
+        children.add(pid)
+
+    def stop(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        for _ in range(workers):
+            spawn()
+
+        while True:
+            pid, status = os.wait()
+            if pid not in children:
+                continue
+            children.remove(pid)
+            print("[Historian] Worker {} {}, restarting it".format(pid, _describe_exit(status)))
+            time.sleep(RESTART_DELAY)
+            spawn()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for pid in children:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        server.server_close()
+
+
+def _describe_exit(status: int) -> str:
+    if os.WIFSIGNALED(status):
+        return "was killed by signal {}".format(os.WTERMSIG(status))
+    return "exited with status {}".format(os.WEXITSTATUS(status))
+
+
+def _run_worker(server: BaseWSGIServer, init_worker: Optional[Callable[[], None]]):
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    code = 0
+    try:
+        if init_worker is not None:
+            init_worker()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    except BaseException:
+        traceback.print_exc()
+        code = 1
+    finally:
+        os._exit(code)
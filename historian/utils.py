@@ -1,10 +1,19 @@
+import base64
 import datetime
 import hashlib
 import os
-from typing import List
+from collections import namedtuple
+from typing import Iterable, List, Tuple
 
 BUF_SIZE = 65536
 
+#: Digests that can be used to hash histories. blake2b is considerably faster than
+#: sha256 on CPUs without SHA extensions.
+DIGESTS = ('sha256', 'blake2b')
+
+#: The parts of a file's stat that change whenever the file is rewritten
+Fingerprint = namedtuple('Fingerprint', 'size,mtime_ns,inode')
+
 
 def get_dbs(database: str) -> List[str]:
     """
@@ -15,21 +24,92 @@ def get_dbs(database: str) -> List[str]:
     return [os.path.join(database, f) for f in os.listdir(database) if os.path.isfile(os.path.join(database, f))]
 
 
-def hash_file(filename: str) -> str:
+def hash_file(filename: str, digest: str = 'sha256') -> str:
     """
     Get the hash of a file.
 
     :param filename: The file to hash
+    :param digest: The digest to hash with, one of :py:data:`DIGESTS`
     :return: The hash of the file
     """
-    sha256 = hashlib.sha256()
+    hasher = hashlib.new(digest)
     with open(filename, 'rb') as fp:
         while True:
             data = fp.read(BUF_SIZE)
             if not data:
                 break
-            sha256.update(data)
-    return sha256.hexdigest()
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def history_hash(filename: str, digest: str = 'sha256') -> str:
+    """
+    Get the hash of a history, prefixed with the digest it was hashed with, i.e. ``sha256:9f86...``.
+
+    Hashes made with different digests never compare equal, see :py:func:`hash_digest`.
+
+    :param filename: The history to hash
+    :param digest: The digest to hash with, one of :py:data:`DIGESTS`
+    """
+    return '{}:{}'.format(digest, hash_file(filename, digest))
+
+
+def hash_digest(hash: str) -> str:
+    """
+    Get the digest a :py:func:`history_hash` was made with.
+    """
+    return hash.partition(':')[0]
+
+
+def file_fingerprint(filename: str) -> Fingerprint:
+    """
+    Get a cheap fingerprint of a file from its stat.
+
+    If the fingerprint of a file has not changed, neither has the file, so there is
+    no need to hash it again.
+
+    :param filename: The file to fingerprint
+    """
+    stat = os.stat(filename)
+    return Fingerprint(stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+#: The shortest word the trigram search index can match, shorter words are matched with LIKE
+FTS_MIN_WORD_LENGTH = 3
+
+
+def fts_query(text: str) -> str:
+    """
+    Turn free text into an FTS5 query matching every word in it.
+
+    Each word is quoted, so punctuation (as in urls) is matched literally rather than
+    parsed as query syntax.
+
+    :param text: The text to search for
+    """
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+def encode_cursor(kind: str, key: Iterable[int]) -> str:
+    """
+    Encode a pagination cursor, an opaque string safe to put in a url.
+
+    :param kind: What the cursor selects, i.e. rows before or after the key
+    :param key: The integer key of the row the cursor points at
+    """
+    raw = ":".join([kind] + [str(int(value)) for value in key])
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor: str) -> Tuple[str, Tuple[int, ...]]:
+    """
+    Decode a cursor made by :py:func:`encode_cursor`.
+
+    :raises ValueError: If the cursor is invalid
+    """
+    raw = base64.urlsafe_b64decode((cursor + '=' * (-len(cursor) % 4)).encode('ascii')).decode('ascii')
+    kind, *key = raw.split(":")
+    return kind, tuple(int(value) for value in key)
 
 
 def webkit_datetime(itime: int) -> datetime.datetime:
@@ -0,0 +1,176 @@
+"""
+Keep the merged database up to date with a directory of histories.
+
+The directory is watched with inotify where it is available (Linux), otherwise it is
+polled. Either way the histories are compared by their fingerprint, so only users whose
+file changed are merged again. A changed file is left alone until it has stopped
+changing for a while, so a history still being copied in is not merged half written.
+"""
+import ctypes
+import ctypes.util
+import functools
+import operator
+import os
+import pathlib
+import select
+import threading
+import time
+from typing import Dict, Optional
+
+from historian.exceptions import InvalidHistory
+from historian.merge import open_history, validate_history
+from historian.utils import Fingerprint, file_fingerprint, get_dbs
+
+#: Seconds a history must stay unchanged before it is merged
+SETTLE_SECONDS = 5
+
+#: Seconds between scans of the directory when changes aren't signalled by inotify
+POLL_SECONDS = 30
+
+#: The inotify events that may mean a history was added, changed or removed
+_INOTIFY_MASK = functools.reduce(operator.or_, [
+    0x00000002,  # IN_MODIFY
+    0x00000004,  # IN_ATTRIB
+    0x00000008,  # IN_CLOSE_WRITE
+    0x00000040,  # IN_MOVED_FROM
+    0x00000080,  # IN_MOVED_TO
+    0x00000100,  # IN_CREATE
+    0x00000200,  # IN_DELETE
+])
+
+
+class DirectoryWatcher:
+    """
+    Waits for the files in a directory to change.
+
+    :ivar bool inotify: Whether changes are signalled by inotify, otherwise :py:meth:`wait` just sleeps
+    """
+    def __init__(self, directory: str):
+        self.fd = None
+        self.inotify = False
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        if libc.inotify_add_watch(fd, os.fsencode(directory), _INOTIFY_MASK) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+        self.inotify = True
+
+    def wait(self, timeout: float) -> bool:
+        """
+        Wait until something in the directory changes, or the timeout passes.
+
+        :return: Whether a change was signalled
+        """
+        if self.fd is None:
+            time.sleep(timeout)
+            return False
+
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return False
+        # The events only tell us to look, the directory is scanned for what changed
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def scan_histories(directory: str) -> Dict[str, Fingerprint]:
+    """
+    Get the fingerprint of every history in the directory, by username.
+    """
+    histories = {}
+    for path in get_dbs(directory):
+        try:
+            histories[os.path.basename(path)] = file_fingerprint(path)
+        except FileNotFoundError:
+            pass
+    return histories
+
+
+def is_valid(path: pathlib.Path) -> bool:
+    """
+    Check a history can be merged, reporting why not if it can't.
+    """
+    try:
+        conn = open_history(path)
+        try:
+            validate_history(conn, path)
+        finally:
+            conn.close()
+    except InvalidHistory as e:
+        print("[Historian] {}, skipping it".format(e))
+        return False
+    return True
+
+
+def watch_histories(hist, directory: str, settle: float = SETTLE_SECONDS, poll: float = POLL_SECONDS,
+                    stop: Optional[threading.Event] = None):
+    """
+    Merge the histories in ``directory`` into ``hist`` whenever they change, until stopped.
+
+    New histories add users, changed histories are merged again and users whose
+    history was deleted are dropped. The histories are taken to be merged already.
+
+    :param MultiUserHistory hist: The history to keep up to date, i.e. with ``swap`` set while it's being served
+    :param directory: The directory of histories
+    :param settle: Seconds a history must stay unchanged before it is merged
+    :param poll: Seconds between scans of the directory, when not woken by inotify
+    :param stop: Stop watching once set
+    """
+    watcher = DirectoryWatcher(directory)
+    print("[Historian] Watching {} for changed histories{}".format(directory, "" if watcher.inotify else ", polling"))
+
+    merged = scan_histories(directory)
+    seen = merged
+    changed_at = time.monotonic()
+    try:
+        while stop is None or not stop.is_set():
+            watcher.wait(settle if seen != merged else poll)
+            current = scan_histories(directory)
+            if current != seen:
+                seen, changed_at = current, time.monotonic()
+                continue
+            if current == merged or time.monotonic() - changed_at < settle:
+                continue
+
+            try:
+                merged = merge_changes(hist, directory, merged, current)
+            except Exception as e:
+                # Merged stays as it was, so the changes are tried again on the next pass
+                print("[Historian] Merging changed histories failed, retrying: {!r}".format(e))
+    finally:
+        watcher.close()
+
+
+def merge_changes(hist, directory: str, merged: Dict[str, Fingerprint],
+                  current: Dict[str, Fingerprint]) -> Dict[str, Fingerprint]:
+    """
+    Merge the histories that changed since the ``merged`` scan of the directory.
+
+    :param MultiUserHistory hist: The history to keep up to date
+    :param directory: The directory of histories
+    :param merged: The fingerprints of the histories as last merged
+    :param current: The fingerprints of the histories now
+    :return: The fingerprints of the histories as merged now
+    """
+    # Invalid histories are left alone until they change again
+    updated = [username for username, fingerprint in sorted(current.items())
+               if merged.get(username) != fingerprint and is_valid(pathlib.Path(directory, username))]
+    dropped = sorted(set(merged) - set(current))
+    hist.dbs = {username: pathlib.Path(directory, username) for username in current}
+    hist.refresh(updated, dropped)
+    return current
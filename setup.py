@@ -27,7 +27,10 @@ setup(
             'sphinx',
             'sphinx_rtd_theme',
             'sphinx-autodoc-typehints',
-        ]
+        ],
+        'analytics': [
+            'numpy',
+        ],
     },
     entry_points={
         'console_scripts': ['chrome-historian=historian.historian:main'],
@@ -0,0 +1,92 @@
+import os
+import pathlib
+
+from historian import collect
+from historian.collect import (OBJECTS_DIR, collect_histories, find_live_histories, find_profiles, profile_username,
+                               read_store)
+from historian.merge import snapshot_history
+from historian.utils import history_hash
+from tests.test_merge import make_history
+
+
+def make_profile(home, *parts):
+    history = home.join(*parts, "History")
+    history.ensure()
+    return str(history)
+
+
+def test_find_profiles(tmpdir):
+    make_profile(tmpdir, "Profile 10")
+    make_profile(tmpdir, "Profile 2")
+    make_profile(tmpdir, "Default")
+    make_profile(tmpdir, "System Profile")
+    tmpdir.join("Profile 3").ensure(dir=True)
+
+    profiles = find_profiles(pathlib.Path(str(tmpdir)))
+    assert [profile for profile, _ in profiles] == ["Default", "Profile 2", "Profile 10"]
+    assert find_profiles(pathlib.Path(str(tmpdir.join("missing")))) == []
+
+
+def test_profile_username():
+    assert profile_username("mattg", "Default") == "mattg"
+    assert profile_username("mattg", "Profile 1") == "mattg.Profile 1"
+
+
+def test_find_live_histories(tmpdir):
+    default = make_profile(tmpdir, "mattg", ".config", "google-chrome", "Default")
+    other = make_profile(tmpdir, "mattg", ".config", "google-chrome", "Profile 1")
+    windows = make_profile(tmpdir, "other", "AppData", "Local", "Google", "Chrome", "User Data", "Default")
+    tmpdir.join("nobody").ensure(dir=True)
+
+    histories = find_live_histories(str(tmpdir))
+    assert {username: str(path) for username, path in histories.items()} == {
+        "mattg": default,
+        "mattg.Profile 1": other,
+        "other": windows,
+    }
+
+
+def make_chrome(homes, user, visits=3, profile="Default"):
+    history = homes.join(user, ".config", "google-chrome", profile, "History")
+    history.dirpath().ensure(dir=True)
+    return make_history(history, visits=visits)
+
+
+def test_collect_histories(tmpdir, monkeypatch):
+    homes = tmpdir.mkdir("homes")
+    store = tmpdir.join("store")
+    make_chrome(homes, "mattg")
+    make_chrome(homes, "other")
+    changed = make_chrome(homes, "changed")
+
+    collected = collect_histories(str(homes), str(store))
+    assert sorted(collected) == ["changed", "mattg", "other"]
+    # Identical histories are only kept once
+    assert collected["mattg"].object == collected["other"].object
+    assert collected["mattg"].hash == history_hash(str(store.join(collected["mattg"].object)))
+    assert len(store.join(OBJECTS_DIR).listdir()) == 1
+
+    snapshots = []
+
+    def record_snapshot(source, target):
+        snapshots.append(source)
+        snapshot_history(source, target)
+
+    monkeypatch.setattr(collect, 'snapshot_history', record_snapshot)
+    os.unlink(str(changed))
+    make_history(changed, visits=5)
+    recollected = collect_histories(str(homes), str(store))
+    assert snapshots == [changed]
+    assert recollected["mattg"] == collected["mattg"]
+    assert recollected["changed"].hash != collected["changed"].hash
+
+    dbs, hashes = read_store(pathlib.Path(str(store)), 'sha256')
+    assert dbs["changed"] == pathlib.Path(str(store), recollected["changed"].object)
+    assert hashes == {username: history.hash for username, history in recollected.items()}
+    assert read_store(pathlib.Path(str(store)), 'blake2b')[1] == {}
+
+    # Copies nobody has any more are removed
+    homes.join("mattg").remove()
+    homes.join("other").remove()
+    collect_histories(str(homes), str(store))
+    assert not store.join(collected["mattg"].object).exists()
@@ -0,0 +1,35 @@
+import datetime
+
+import pytest
+
+from historian import decode
+from historian.utils import webkit_datetime
+
+TIMES = [13109575048813599, 13109575049813599, 13209575048000000]
+TRANSITIONS = [0x30000001, 0x10000000, 0xA0000008]
+
+
+def test_decode_times():
+    epoch = datetime.datetime(1970, 1, 1)
+    expected = [(webkit_datetime(time) - epoch) // datetime.timedelta(microseconds=1) for time in TIMES]
+    assert list(decode.decode_times(TIMES)) == expected
+
+
+def test_decode_transitions():
+    core, qualifier = decode.decode_transitions(TRANSITIONS)
+    assert list(core) == [1, 0, 8]
+    assert list(qualifier) == [0x30000000, 0x10000000, 0xA0000000]
+
+
+def test_decode_visits():
+    decoded = decode.decode_visits(TIMES, TRANSITIONS)
+    assert len(decoded.timestamps) == len(decoded.core) == len(decoded.qualifier) == 3
+
+
+def test_decode_datetimes():
+    if decode.numpy is None:
+        with pytest.raises(RuntimeError):
+            decode.decode_times(TIMES, datetimes=True)
+    else:
+        times = decode.decode_times(TIMES, datetimes=True)
+        assert [time.astype(datetime.datetime) for time in times] == [webkit_datetime(time) for time in TIMES]
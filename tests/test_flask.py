@@ -0,0 +1,18 @@
+import json
+
+from historian.flask import app
+from historian.history import MultiUserHistory
+from tests.test_history import make_chain
+
+
+def test_graph_arguments(tmpdir):
+    path = make_chain(tmpdir.join("user1"), 5)
+    app.config['HISTORIES'] = MultiUserHistory([str(path)], str(tmpdir.join("merged.db")))
+    client = app.test_client()
+
+    response = client.get('/graph/1/3/json?depth=1&limit=10')
+    assert response.status_code == 200
+    assert sorted(node['id'] for node in json.loads(response.data.decode())) == [2, 3, 4]
+
+    for args in ['depth=x', 'limit=1.5', 'depth=-1', 'limit=0']:
+        assert client.get('/graph/1/3/json?' + args).status_code == 400
@@ -0,0 +1,26 @@
+from historian.graph import VisitGraph
+
+#: 1 -> 2 -> 3, 2 -> 4 -> 6 and a separate 5 -> 7, 8 came from a visit that expired
+EDGES = [(1, 0), (2, 1), (3, 2), (4, 2), (5, 0), (6, 4), (7, 5), (8, 9)]
+
+
+def test_visit_graph():
+    graph = VisitGraph(EDGES)
+    assert len(graph) == 8
+    assert 4 in graph and 9 not in graph
+    assert graph.parent(1) is None
+    assert graph.parent(8) is None
+    assert graph.parent(6) == 4
+    assert graph.children(2) == [3, 4]
+    assert graph.children(3) == []
+
+
+def test_visit_graph_walks():
+    graph = VisitGraph(EDGES)
+    assert graph.ancestors(6) == [4, 2, 1]
+    assert graph.root(6) == 1
+    assert graph.root(5) == 5
+    assert graph.descendants(1) == [2, 3, 4, 6]
+    assert graph.shortest_path(3, 6) == [3, 2, 4, 6]
+    assert graph.shortest_path(3, 3) == [3]
+    assert graph.shortest_path(3, 7) is None
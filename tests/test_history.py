@@ -0,0 +1,593 @@
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+from peewee import OperationalError
+
+from historian.exceptions import InvalidMergedDatabase
+from historian.history import MultiUserHistory, ShardedHistory, UrlRow, VisitRow
+from historian.models import RedirectChain, TransitionCore, TransitionQualifier, User, VisitSourceEnum, database
+from historian.plans import capture_queries
+from historian.utils import encode_cursor, history_hash
+from tests.test_merge import make_history
+
+
+def make_chain(path, visits):
+    """
+    Make a history of a single chain of visits, each to its own url.
+    """
+    path = make_history(path, visits=0)
+    conn = sqlite3.connect(str(path))
+    conn.execute("DELETE FROM urls")
+    for i in range(1, visits + 1):
+        conn.execute("INSERT INTO urls VALUES (?, ?, ?, 1, 0, ?, 0, 0)",
+                     (i, 'https://example.com/{}'.format(i), 'Page {}'.format(i), 13109575048813599 + i))
+        conn.execute("INSERT INTO visits VALUES (?, ?, ?, ?, 0, 0, 0)", (i, i, 13109575048813599 + i, i - 1))
+        conn.execute("INSERT INTO visit_source VALUES (?, 1)", (i,))
+    conn.commit()
+    conn.close()
+    return path
+
+
+def test_visit_graph_limit(tmpdir):
+    make_chain(tmpdir.mkdir("histories").join("user1"), 200)
+    hist = MultiUserHistory([str(tmpdir.join("histories", "user1"))], str(tmpdir.join("merged.db")))
+
+    for limit in (50, 100):
+        nodes = hist.get_visit_graph(1, 100, depth=200, limit=limit)
+        assert len({node.id for node in nodes}) == limit
+        assert max(node.depth for node in nodes) <= limit // 2
+
+    nodes = hist.get_visit_graph(1, 100, depth=200, limit=1000)
+    assert sorted(node.id for node in nodes) == list(range(1, 201))
+    assert {node.id: node.depth for node in nodes}[1] == 99
+
+
+def test_search_short_words(tmpdir):
+    make_chain(tmpdir.mkdir("histories").join("user1"), 200)
+    hist = MultiUserHistory([str(tmpdir.join("histories", "user1"))], str(tmpdir.join("merged.db")))
+    assert hist.search_index
+
+    results = {}
+    for search_index in (True, False):
+        hist.search_index = search_index
+        results[search_index] = [sorted(url.id for url in hist.get_urls(search=search))
+                                 for search in ("Page 3", "/7", "e/12", "example Page")]
+    assert results[True] == results[False]
+    assert results[True][0][:3] == [3, 13, 23]
+    assert results[True][1] == [7] + list(range(70, 80))
+    assert len(results[True][3]) == 200
+
+
+def test_transition_filters(tmpdir):
+    path = make_chain(tmpdir.join("user1"), 4)
+    typed = TransitionCore.TYPED
+    forward_back = TransitionQualifier.FORWARD_BACK
+    address_bar = TransitionQualifier.FROM_ADDRESS_BAR
+    conn = sqlite3.connect(str(path))
+    conn.executemany("UPDATE visits SET transition = ? WHERE id = ?",
+                     [(TransitionCore.LINK, 1), (typed | address_bar, 2), (TransitionCore.LINK | forward_back, 3),
+                      (typed | forward_back | address_bar, 4)])
+    # Chrome only records the source of visits that weren't browsed locally
+    conn.execute("DELETE FROM visit_source")
+    conn.executemany("INSERT INTO visit_source VALUES (?, ?)", [(2, VisitSourceEnum.SYNCED),
+                                                                (4, VisitSourceEnum.EXTENSION)])
+    conn.commit()
+    conn.close()
+    hist = MultiUserHistory([str(path)], str(tmpdir.join("merged.db")))
+
+    def filtered(**filters):
+        urls = sorted(url.id for url in hist.get_urls(**filters))
+        visits = sorted(visit.id for visit in hist.query_visits(username="user1", **filters))
+        assert urls == visits
+        return urls
+
+    assert filtered(transition=typed) == [2, 4]
+    assert filtered(transition=TransitionCore.LINK) == [1, 3]
+    assert filtered(qualifier=forward_back) == [3, 4]
+    assert filtered(qualifier=forward_back | address_bar) == [4]
+    assert filtered(source=VisitSourceEnum.BROWSED) == [1, 3]
+    assert filtered(source=VisitSourceEnum.SYNCED) == [2]
+    assert filtered(transition=typed, source=VisitSourceEnum.EXTENSION) == [4]
+    assert filtered(transition=TransitionCore.RELOAD) == []
+
+
+def test_iter_rows(tmpdir):
+    path = make_chain(tmpdir.join("user1"), 25)
+    hist = MultiUserHistory([str(path)], str(tmpdir.join("merged.db")))
+
+    # 25 rows fetched 7 at a time cross three batch boundaries
+    urls = list(hist.iter_urls(username="user1", batch_size=7))
+    assert all(type(url) is UrlRow for url in urls)
+    assert urls == list(hist.query_urls(username="user1").tuples())
+    assert [url.id for url in urls] == [url.id for url in hist.get_urls(username="user1")]
+    assert len(urls) == 25 and len(set(urls)) == 25
+
+    visits = list(hist.iter_visits(username="user1", batch_size=7))
+    assert all(type(visit) is VisitRow for visit in visits)
+    assert visits == list(hist.query_visits(username="user1").tuples())
+    assert [visit.id for visit in visits] == list(range(1, 26))
+    assert list(hist.iter_visits(username="user1", batch_size=7, date_gt=visits[20].visit_time)) == visits[21:]
+
+
+def test_with_visits_queries(tmpdir):
+    histories = tmpdir.mkdir("histories")
+    make_chain(histories.join("user1"), 5)
+    make_chain(histories.join("user2"), 40)
+    hist = merge_users(tmpdir, "merged.db")
+
+    def count_queries(username, with_visits):
+        with capture_queries() as queries:
+            for url in hist.get_urls(username=username, with_visits=with_visits):
+                assert url.user.name == username
+                assert [visit.url_obj.id for visit in url.visits] == [url.id]
+        return len(queries)
+
+    # The visits of every url are loaded with one query, however many urls there are
+    assert count_queries("user1", True) == count_queries("user2", True)
+    assert count_queries("user1", False) < count_queries("user2", False)
+
+
+def test_redirect_chains(tmpdir):
+    path = make_chain(tmpdir.join("user1"), 6)
+    start, end = TransitionQualifier.CHAIN_START, TransitionQualifier.CHAIN_END
+    redirect = TransitionQualifier.SERVER_REDIRECT
+    conn = sqlite3.connect(str(path))
+    # 1 isn't redirected, 2 is redirected twice to 4, then 5 once to 6
+    conn.executemany("UPDATE visits SET transition = ?, from_visit = ?, visit_duration = ? WHERE id = ?",
+                     [(start | end, 0, 5, 1), (start, 1, 100, 2), (redirect, 2, 200, 3), (redirect | end, 3, 300, 4),
+                      (start, 0, 10, 5), (redirect | end, 5, 0, 6)])
+    conn.commit()
+    hist = MultiUserHistory([str(path)], str(tmpdir.join("merged.db")))
+
+    def chains():
+        return [(chain.start_visit, chain.end_visit, chain.start_url_obj.url, chain.end_url_obj.url, chain.hops,
+                 chain.duration, chain.visit_time)
+                for chain in hist.query_redirect_chains(username="user1").order_by(RedirectChain.start_visit)]
+
+    visit_time = {visit.id: visit.visit_time for visit in hist.query_visits(username="user1")}
+    assert chains() == [(2, 4, 'https://example.com/2', 'https://example.com/4', 2, 600, visit_time[2]),
+                        (5, 6, 'https://example.com/5', 'https://example.com/6', 1, 10, visit_time[5])]
+    assert [chain.start_visit for chain in hist.query_redirect_chains(username="user1", end_url=4)] == [2]
+
+    # Chrome fills in the duration of the last visit once the user navigates away
+    conn.execute("UPDATE visits SET visit_duration = 40 WHERE id = 6")
+    conn.execute("INSERT INTO visits VALUES (7, 1, 13109575048813607, 6, 0, 0, 0)")
+    conn.commit()
+    conn.close()
+    hist = MultiUserHistory([str(path)], str(tmpdir.join("merged.db")))
+    assert chains()[1][5] == 50
+
+
+def test_url_page_invalid_cursor(tmpdir):
+    make_chain(tmpdir.mkdir("histories").join("user1"), 10)
+    hist = MultiUserHistory([str(tmpdir.join("histories", "user1"))], str(tmpdir.join("merged.db")))
+
+    page = hist.get_url_page(limit=4)
+    assert [url.id for url in hist.get_url_page(limit=4, cursor=page.next).urls] == [6, 5, 4, 3]
+    for cursor in ("not a cursor", encode_cursor('after', [1]), encode_cursor('offset', [4]),
+                   encode_cursor('sideways', [1, 1, 1])):
+        with pytest.raises(ValueError):
+            hist.get_url_page(limit=4, cursor=cursor)
+    for cursor in (encode_cursor('after', [1, 1, 1]), encode_cursor('offset', [-4])):
+        with pytest.raises(ValueError):
+            hist.get_url_page(limit=4, cursor=cursor, search='example')
+
+
+#: The tables compared between merged databases
+MERGED_TABLES = ('users', 'urls', 'visits', 'visit_source', 'redirect_chains', 'daily_rollups', 'user_stats',
+                 'merge_checkpoints')
+
+
+def dump_merged(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        return {table: sorted(conn.execute("SELECT * FROM {}".format(table)).fetchall()) for table in MERGED_TABLES}
+    finally:
+        conn.close()
+
+
+def add_visits(path, first, count):
+    conn = sqlite3.connect(str(path))
+    for i in range(first, first + count):
+        conn.execute("INSERT INTO visits VALUES (?, 1, ?, ?, 0, 0, 0)", (i, 13109575048813599 + i * 10 ** 11, i - 1))
+        conn.execute("INSERT INTO visit_source VALUES (?, 1)", (i,))
+    conn.execute("UPDATE visits SET visit_duration = 1000 WHERE id = 1")
+    conn.commit()
+    conn.close()
+
+
+def merge(tmpdir, name, **kwargs):
+    return MultiUserHistory([str(tmpdir.join("histories", "user1"))], str(tmpdir.join(name)), **kwargs)
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt_after(monkeypatch, batches):
+    """
+    Make the merge fail once it has copied the given number of batches.
+    """
+    monkeypatch.undo()
+    import_table = MultiUserHistory.import_table
+    calls = []
+
+    def failing_import(*args):
+        if len(calls) == batches:
+            raise Interrupted()
+        calls.append(args)
+        import_table(*args)
+    monkeypatch.setattr(MultiUserHistory, 'import_table', staticmethod(failing_import))
+    return calls
+
+
+def test_incremental_merge(tmpdir):
+    path = make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    merge(tmpdir, "merged.db")
+    add_visits(path, 21, 10)
+    merge(tmpdir, "merged.db")
+    assert dump_merged(tmpdir.join("merged.db")) == dump_merged(merge(tmpdir, "fresh.db").merged_path)
+
+
+def test_merge_legacy_hashes(tmpdir, capsys):
+    path = make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    merge(tmpdir, "merged.db")
+    # Hashes stored without their digest, hashed again as the fingerprint doesn't match
+    conn = sqlite3.connect(str(tmpdir.join("merged.db")))
+    conn.execute("UPDATE users SET hash = substr(hash, length('sha256:') + 1), size = 0")
+    conn.commit()
+    conn.close()
+    capsys.readouterr()
+
+    hist = merge(tmpdir, "merged.db")
+    assert "already loaded and latest version" in capsys.readouterr().out
+    assert hist.get_user(username="user1").hash == history_hash(str(path))
+
+
+def test_rewritten_merge(tmpdir):
+    path = make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    merge(tmpdir, "merged.db")
+    # Chrome expiring old history isn't append only, so the user is merged again
+    conn = sqlite3.connect(str(path))
+    conn.execute("DELETE FROM visits WHERE id < 5")
+    conn.commit()
+    conn.close()
+    merge(tmpdir, "merged.db")
+    merged = dump_merged(tmpdir.join("merged.db"))
+    assert merged == dump_merged(merge(tmpdir, "fresh.db").merged_path)
+    assert len(merged['visits']) == 16
+
+
+def test_serve_read_only(tmpdir):
+    hist = MultiUserHistory([str(make_history(tmpdir.join("user1")))], str(tmpdir.join("merged.db")))
+    hist.serve_read_only(mmap_size=1024 * 1024, cache_kib=2048)
+
+    def pragma(name):
+        return database.execute_sql("PRAGMA {}".format(name)).fetchone()[0]
+
+    with database.connection_context():
+        assert pragma("query_only") == 1
+        assert pragma("mmap_size") == 1024 * 1024
+        assert pragma("cache_size") == -2048
+        assert hist.get_user_count() == 1
+        with pytest.raises(OperationalError):
+            User.insert(name="user2", hash="").execute()
+        # Without query_only, the connection is still opened read-only
+        database.execute_sql("PRAGMA query_only = 0")
+        with pytest.raises(OperationalError, match="readonly"):
+            User.insert(name="user2", hash="").execute()
+    assert hist.get_user_count() == 1
+
+
+#: Swap merge the histories in tmpdir in another process, as ``server --watch`` does
+SWAP_MERGE = "import sys, py; from tests.test_history import merge_users; " \
+             "merge_users(py.path.local(sys.argv[1]), 'merged.db', swap=True)"
+
+
+def test_swap_merge(tmpdir):
+    histories = tmpdir.mkdir("histories")
+    make_history(histories.join("user1"))
+    hist = merge_users(tmpdir, "merged.db", swap=True)
+    hist.serve_read_only()
+
+    def usernames():
+        generation = database.check_replaced()
+        database.connect(reuse_if_open=True)
+        try:
+            return [user.name for user in User.select().order_by(User.name)]
+        finally:
+            database.release(generation)
+
+    assert usernames() == ["user1"]
+    # A reader that is in the middle of a request when the merged DB is swapped
+    generation = database.check_replaced()
+    database.connect()
+    make_history(histories.join("user2"))
+    subprocess.run([sys.executable, '-c', SWAP_MERGE, str(tmpdir)], check=True)
+    assert [user.name for user in User.select()] == ["user1"]
+    database.release(generation)
+    # The idle connection to the old file is closed, and the next reader sees the new one
+    assert usernames() == ["user1", "user2"]
+
+
+def test_worker_merge(tmpdir):
+    histories = tmpdir.mkdir("histories")
+    for i in range(1, 7):
+        make_chain(histories.join("user{}".format(i)), 60 - i * 10)
+    expected = dump_merged(merge_users(tmpdir, "merged.db").merged_path)
+    assert dump_merged(merge_users(tmpdir, "workers.db", merge_workers=3).merged_path) == expected
+
+
+def dump_schema(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        return sorted(conn.execute("SELECT type, name, sql FROM sqlite_master").fetchall())
+    finally:
+        conn.close()
+
+
+def dump_search_index(path):
+    conn = sqlite3.connect(str(path))
+    try:
+        return conn.execute("SELECT rowid, url, title FROM urls_fts ORDER BY rowid").fetchall()
+    finally:
+        conn.close()
+
+
+def test_bulk_merge(tmpdir):
+    histories = tmpdir.mkdir("histories")
+    for i in range(1, 4):
+        make_chain(histories.join("user{}".format(i)), 20 * i)
+    expected = merge_users(tmpdir, "merged.db").merged_path
+
+    for name, workers in [("bulk.db", 1), ("bulk-workers.db", 2)]:
+        hist = merge_users(tmpdir, name, bulk_load=True, merge_workers=workers)
+        assert hist.search_index
+        assert dump_merged(hist.merged_path) == dump_merged(expected)
+        assert dump_schema(hist.merged_path) == dump_schema(expected)
+        assert dump_search_index(hist.merged_path) == dump_search_index(expected)
+
+
+def test_bulk_merge_rollback(tmpdir, monkeypatch):
+    histories = tmpdir.mkdir("histories")
+    for i in range(1, 4):
+        make_chain(histories.join("user{}".format(i)), 20 * i)
+    empty = MultiUserHistory({}, str(tmpdir.join("empty.db"))).merged_path
+    merge_user = MultiUserHistory.merge_user
+
+    def failing_merge(self, staged, user=None):
+        if staged.username == "user2":
+            raise Interrupted()
+        merge_user(self, staged, user)
+    monkeypatch.setattr(MultiUserHistory, 'merge_user', failing_merge)
+
+    # The users merged before the failure are rolled back, and the indexes dropped for the load are back
+    bulk = tmpdir.join("bulk.db")
+    with pytest.raises(Interrupted):
+        merge_users(tmpdir, "bulk.db", bulk_load=True)
+    assert dump_schema(bulk) == dump_schema(empty)
+    assert dump_merged(bulk) == dump_merged(empty)
+    conn = sqlite3.connect(str(bulk))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'delete'
+    conn.close()
+
+    monkeypatch.undo()
+    merge_users(tmpdir, "bulk.db", bulk_load=True)
+    assert dump_merged(bulk) == dump_merged(merge_users(tmpdir, "merged.db").merged_path)
+
+
+def test_chunked_merge(tmpdir):
+    make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    assert dump_merged(merge(tmpdir, "chunked.db", chunk_size=3).merged_path) == \
+        dump_merged(merge(tmpdir, "fresh.db").merged_path)
+
+
+def test_chunked_merge_resume(tmpdir, monkeypatch):
+    make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    calls = interrupt_after(monkeypatch, 4)
+    with pytest.raises(Interrupted):
+        merge(tmpdir, "chunked.db", chunk_size=3)
+    interrupted = dump_merged(tmpdir.join("chunked.db"))
+    assert interrupted['merge_checkpoints'] and interrupted['users'][0][2] == ''
+
+    # The batches copied before aren't copied again
+    calls = interrupt_after(monkeypatch, 100)
+    merge(tmpdir, "chunked.db", chunk_size=3)
+    assert calls[0][1:] == ('visits', False, 9, 12)
+    assert dump_merged(tmpdir.join("chunked.db")) == dump_merged(merge(tmpdir, "fresh.db").merged_path)
+
+
+def test_chunked_merge_resume_changed(tmpdir, monkeypatch):
+    path = make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    interrupt_after(monkeypatch, 4)
+    with pytest.raises(Interrupted):
+        merge(tmpdir, "chunked.db", chunk_size=3)
+    monkeypatch.undo()
+
+    # The checkpoint is for another version of the history, so the user is merged from scratch
+    add_visits(path, 21, 10)
+    merge(tmpdir, "chunked.db", chunk_size=3)
+    assert dump_merged(tmpdir.join("chunked.db")) == dump_merged(merge(tmpdir, "fresh.db").merged_path)
+
+
+def test_chunked_merge_resume_incremental(tmpdir, monkeypatch):
+    path = make_history(tmpdir.mkdir("histories").join("user1"), visits=20)
+    merge(tmpdir, "chunked.db", chunk_size=3)
+    add_visits(path, 21, 10)
+    interrupt_after(monkeypatch, 3)
+    with pytest.raises(Interrupted):
+        merge(tmpdir, "chunked.db", chunk_size=3)
+    assert dump_merged(tmpdir.join("chunked.db"))['merge_checkpoints'][0][2] == 1
+
+    calls = interrupt_after(monkeypatch, 100)
+    merge(tmpdir, "chunked.db", chunk_size=3)
+    assert all(incremental for _, _, incremental, _, _ in calls)
+    assert dump_merged(tmpdir.join("chunked.db")) == dump_merged(merge(tmpdir, "fresh.db").merged_path)
+
+
+def dump_sharded(path):
+    """
+    Dump a sharded merged database as :py:func:`dump_merged` dumps a merged database.
+    """
+    merged = {table: [] for table in MERGED_TABLES}
+    for db in [path.join("index.db")] + path.join("shards").listdir():
+        conn = sqlite3.connect(str(db))
+        try:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for table in tables & set(MERGED_TABLES):
+                merged[table].extend(conn.execute("SELECT * FROM {}".format(table)))
+        finally:
+            conn.close()
+    return {table: sorted(rows) for table, rows in merged.items()}
+
+
+def merge_users(tmpdir, name, history_class=MultiUserHistory, **kwargs):
+    histories = sorted(str(path) for path in tmpdir.join("histories").listdir())
+    return history_class(histories, str(tmpdir.join(name)), **kwargs)
+
+
+def browse(hist):
+    """
+    Query a merged database across users the ways the web interface and inspector do.
+    """
+    pages = []
+    page = hist.get_url_page(limit=7)
+    while True:
+        pages.append([(url.user_id, url.id) for url in page.urls])
+        if not page.next:
+            break
+        page = hist.get_url_page(limit=7, cursor=page.next)
+
+    searched = []
+    result = hist.get_url_page(limit=4, search='Page 2')
+    while True:
+        searched.extend((url.user_id, url.id) for url in result.urls)
+        if not result.next:
+            break
+        result = hist.get_url_page(limit=4, cursor=result.next, search='Page 2')
+
+    return {
+        'pages': pages,
+        'back': [(url.user_id, url.id) for url in hist.get_url_page(limit=7, cursor=page.previous).urls],
+        'urls': sorted((url.user_id, url.id) for url in hist.get_urls()),
+        'slice': len(hist.get_urls(limit=10, start=65)),
+        'searched': sorted(searched),
+        'counts': (hist.get_url_count(), hist.get_visit_count(live=True),
+                   hist.get_visit_source_count(username='user2', live=True)),
+        'daily': [tuple(row) for row in hist.get_daily_visits()],
+        'hosts': [tuple(row) for row in hist.get_top_hosts(limit=5)],
+        'url': hist.get_url_by_id(5, 2).url,
+        'graph': [node.id for node in hist.get_visit_graph(2, 5)],
+    }
+
+
+def test_sharded_merge(tmpdir):
+    # Urls of both users are visited at the same times, so paging has to break ties by user
+    make_chain(tmpdir.mkdir("histories").join("user1"), 40)
+    make_chain(tmpdir.join("histories", "user2"), 30)
+    merged = merge_users(tmpdir, "merged.db")
+    expected = browse(merged)
+    assert len(expected['pages']) == 10
+
+    sharded = merge_users(tmpdir, "sharded", ShardedHistory)
+    assert sharded.search_index
+    assert browse(sharded) == expected
+    assert dump_sharded(tmpdir.join("sharded")) == dump_merged(merged.merged_path)
+    with pytest.raises(ValueError):
+        sharded.query_visits()
+
+
+def test_sharded_remerge(tmpdir):
+    make_chain(tmpdir.mkdir("histories").join("user1"), 40)
+    path = make_chain(tmpdir.join("histories", "user2"), 30)
+    merge_users(tmpdir, "sharded", ShardedHistory)
+    shard = tmpdir.join("sharded", "shards", "user1.db").read_binary()
+
+    # Only the shard of the user whose history changed is written to
+    add_visits(path, 31, 5)
+    merge_users(tmpdir, "sharded", ShardedHistory, chunk_size=4)
+    assert tmpdir.join("sharded", "shards", "user1.db").read_binary() == shard
+    assert dump_sharded(tmpdir.join("sharded")) == dump_merged(merge_users(tmpdir, "fresh.db").merged_path)
+
+    hist = merge_users(tmpdir, "sharded", ShardedHistory)
+    hist.refresh([], dropped=["user1"])
+    assert not tmpdir.join("sharded", "shards", "user1.db").exists()
+    assert [user.name for user in hist.get_users()] == ["user2"]
+    assert hist.get_url_count() == len(hist.get_urls()) == 30
+
+
+def without_fingerprints(dumped):
+    """
+    Leave out the fingerprints of the histories, which merged databases don't share.
+    """
+    return dict(dumped, users=[user[:5] for user in dumped['users']])
+
+
+def merge_host(tmpdir, host, histories):
+    """
+    Merge copies of the given histories the way a collection host would.
+    """
+    directory = tmpdir.ensure(host, "histories", dir=True)
+    for path in histories:
+        directory.join(path.basename).write_binary(path.read_binary())
+    return MultiUserHistory(sorted(str(path) for path in directory.listdir()), str(tmpdir.join(host, "merged.db")))
+
+
+def test_merge_merged(tmpdir):
+    user1 = make_chain(tmpdir.mkdir("histories").join("user1"), 40)
+    make_chain(tmpdir.join("histories", "user2"), 30)
+    make_history(tmpdir.join("histories", "user3"), visits=10)
+    histories = sorted(tmpdir.join("histories").listdir())
+    host1 = str(merge_host(tmpdir, "host1", histories[:2]).merged_path)
+    host2 = str(merge_host(tmpdir, "host2", histories[1:]).merged_path)
+
+    # user2 was merged on both hosts, so is only copied once
+    hist = MultiUserHistory({}, str(tmpdir.join("combined.db")))
+    assert hist.merge_merged([host1, host2])
+    assert not hist.merge_merged([host2, host1])
+    expected = without_fingerprints(dump_merged(merge_users(tmpdir, "fresh.db").merged_path))
+    assert without_fingerprints(dump_merged(tmpdir.join("combined.db"))) == expected
+
+    # A combined database can be combined again, into shards as well
+    hist = ShardedHistory({}, str(tmpdir.join("sharded")))
+    assert hist.merge_merged([str(tmpdir.join("combined.db"))])
+    assert hist.search_index
+    assert without_fingerprints(dump_sharded(tmpdir.join("sharded"))) == expected
+
+    # A user whose history changed on a host replaces the user merged before
+    add_visits(user1, 41, 5)
+    host1 = str(merge_host(tmpdir, "host1", histories[:1]).merged_path)
+    hist = MultiUserHistory({}, str(tmpdir.join("combined.db")))
+    assert hist.merge_merged([host1, host2])
+    assert without_fingerprints(dump_merged(tmpdir.join("combined.db"))) == \
+        without_fingerprints(dump_merged(merge_users(tmpdir, "fresh2.db").merged_path))
+
+
+def test_merge_merged_identical(tmpdir):
+    alice = make_chain(tmpdir.mkdir("histories").join("alice"), 20)
+    tmpdir.join("histories", "bob").write_binary(alice.read_bytes())
+    histories = sorted(tmpdir.join("histories").listdir())
+    host1 = str(merge_host(tmpdir, "host1", histories[:1]).merged_path)
+    host2 = str(merge_host(tmpdir, "host2", histories[1:]).merged_path)
+
+    # Different users with the same history are each copied
+    expected = without_fingerprints(dump_merged(merge_users(tmpdir, "fresh.db").merged_path))
+    hist = MultiUserHistory({}, str(tmpdir.join("combined.db")))
+    assert hist.merge_merged([host1, host2])
+    assert without_fingerprints(dump_merged(tmpdir.join("combined.db"))) == expected
+    hist = ShardedHistory({}, str(tmpdir.join("sharded")))
+    assert hist.merge_merged([host1, host2])
+    assert without_fingerprints(dump_sharded(tmpdir.join("sharded"))) == expected
+
+
+def test_merge_merged_invalid(tmpdir):
+    conn = sqlite3.connect(str(tmpdir.join("old.db")))
+    conn.execute("CREATE TABLE users (id INTEGER PRIMARY KEY, name, hash)")
+    conn.close()
+
+    hist = MultiUserHistory({}, str(tmpdir.join("combined.db")))
+    with pytest.raises(InvalidMergedDatabase):
+        hist.merge_merged([str(tmpdir.join("old.db"))])
+    assert hist.get_user_count() == 0
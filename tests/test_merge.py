@@ -0,0 +1,178 @@
+import os
+import pathlib
+import sqlite3
+import time
+
+import pytest
+
+from historian import merge
+from historian.exceptions import InvalidHistory
+from historian.merge import KnownHistory, discard_snapshot, snapshot_history, stage_history, stage_histories
+from historian.utils import file_fingerprint, history_hash
+
+
+def make_history(path, visits=3):
+    conn = sqlite3.connect(str(path))
+    conn.executescript("""
+        CREATE TABLE urls (id INTEGER PRIMARY KEY, url, title, visit_count, typed_count, last_visit_time, hidden,
+                           favicon_id);
+        CREATE TABLE visits (id INTEGER PRIMARY KEY, url, visit_time, from_visit, transition, segment_id,
+                             visit_duration);
+        CREATE TABLE visit_source (id INTEGER PRIMARY KEY, source);
+    """)
+    conn.execute("INSERT INTO urls VALUES (1, 'https://example.com', 'Example', ?, 0, ?, 0, 0)",
+                 (visits, 13109575048813599 + visits))
+    for i in range(1, visits + 1):
+        conn.execute("INSERT INTO visits VALUES (?, 1, ?, ?, 0, 0, 0)", (i, 13109575048813599 + i, i - 1))
+        conn.execute("INSERT INTO visit_source VALUES (?, 1)", (i,))
+    conn.commit()
+    conn.close()
+    return pathlib.Path(str(path))
+
+
+def test_stage_history(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    staged = stage_history("user1", path)
+    assert staged.hash == history_hash(str(path))
+    assert len(staged.tables['urls']) == 1
+    assert len(staged.tables['visits']) == 3
+    assert len(staged.tables['visit_source']) == 3
+
+
+def test_stage_history_unchanged(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    staged = stage_history("user1", path, KnownHistory(history_hash(str(path)), None))
+    assert staged.tables is None
+
+
+def test_stage_history_digest(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    # Compared with the hash of the last merge in its own digest
+    known = KnownHistory(history_hash(str(path)), None)
+    staged = stage_history("user1", path, known, digest='blake2b')
+    assert staged.hash == known.hash and staged.tables is None
+
+    os.unlink(str(path))
+    make_history(path, visits=5)
+    staged = stage_history("user1", path, known, digest='blake2b')
+    assert staged.hash == history_hash(str(path), 'blake2b') and staged.hash.startswith('blake2b:')
+    assert staged.tables is not None
+
+
+def test_stage_history_fingerprint(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    known = KnownHistory("stale", file_fingerprint(str(path)))
+    assert stage_history("user1", path, known).hash == "stale"
+
+    staged = stage_history("user1", path, known, verify=True)
+    assert staged.hash == history_hash(str(path))
+    assert staged.tables is not None
+
+
+def test_stage_history_known_hash(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    staged = stage_history("user1", path, KnownHistory("known", None), hash="known")
+    assert staged.hash == "known"
+    assert staged.tables is None
+
+
+def test_stage_history_invalid(tmpdir):
+    path = tmpdir.join("user1")
+    path.write("not a history")
+    with pytest.raises(InvalidHistory):
+        stage_history("user1", pathlib.Path(str(path)))
+
+
+def test_stage_histories(tmpdir):
+    histories = [("user{}".format(i), make_history(tmpdir.join("user{}".format(i)), i)) for i in range(1, 6)]
+    staged = {s.username: s for s in stage_histories(histories, {}, 2)}
+    assert sorted(staged) == ["user{}".format(i) for i in range(1, 6)]
+    assert len(staged["user4"].tables['visits']) == 4
+
+
+def test_stage_histories_order(tmpdir, monkeypatch):
+    histories = [("user{}".format(i), make_history(tmpdir.join("user{}".format(i)), i)) for i in range(1, 6)]
+    stage = merge.stage_history
+
+    def slow_first(username, *args, **kwargs):
+        # The first history finishes staging last
+        if username == "user1":
+            time.sleep(0.2)
+        return stage(username, *args, **kwargs)
+
+    monkeypatch.setattr(merge, 'stage_history', slow_first)
+    assert [s.username for s in stage_histories(histories, {}, 3)] == [username for username, _ in histories]
+
+
+def test_snapshot_history(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    snapshot = tmpdir.join("snapshot")
+    snapshot_history(path, pathlib.Path(str(snapshot)))
+    conn = sqlite3.connect(str(snapshot))
+    assert conn.execute("SELECT COUNT(*) FROM visits").fetchone()[0] == 3
+    conn.close()
+
+
+def test_snapshot_history_locked(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    snapshot = tmpdir.join("snapshot")
+    # Chrome holds its history with an exclusive lock while it runs
+    chrome = sqlite3.connect(str(path))
+    chrome.execute("PRAGMA locking_mode = EXCLUSIVE")
+    chrome.execute("INSERT INTO visit_source VALUES (4, 1)")
+    chrome.commit()
+    try:
+        snapshot_history(path, pathlib.Path(str(snapshot)))
+    finally:
+        chrome.close()
+    conn = sqlite3.connect(str(snapshot))
+    assert conn.execute("SELECT COUNT(*) FROM visit_source").fetchone()[0] == 4
+    conn.close()
+
+
+def test_snapshot_history_torn(tmpdir, monkeypatch):
+    path = make_history(tmpdir.join("user1"))
+    chrome = sqlite3.connect(str(path))
+    chrome.execute("PRAGMA locking_mode = EXCLUSIVE")
+    chrome.execute("INSERT INTO visit_source VALUES (4, 1)")
+    chrome.commit()
+    # The first two snapshots are torn by chrome writing to the history
+    torn = [InvalidHistory(path, "torn"), InvalidHistory(path, "torn")]
+    validate_history = merge.validate_history
+
+    def validate(conn, source):
+        if torn:
+            raise torn.pop()
+        validate_history(conn, source)
+
+    sleeps = []
+    monkeypatch.setattr(merge, 'validate_history', validate)
+    monkeypatch.setattr(merge.time, 'sleep', sleeps.append)
+    try:
+        snapshot_history(path, pathlib.Path(str(tmpdir.join("snapshot"))))
+    finally:
+        chrome.close()
+    assert sleeps == [merge.SNAPSHOT_RETRY_SECONDS, merge.SNAPSHOT_RETRY_SECONDS * 2]
+
+
+def test_snapshot_history_invalid(tmpdir):
+    path = tmpdir.join("user1")
+    path.write("not a history")
+    with pytest.raises(InvalidHistory):
+        snapshot_history(pathlib.Path(str(path)), pathlib.Path(str(tmpdir.join("snapshot"))))
+
+
+def test_stage_history_live(tmpdir):
+    path = make_history(tmpdir.join("user1"))
+    staged = stage_history("user1", path, read_rows=False, live=True)
+    assert staged.snapshot and staged.path != path
+    assert staged.hash == history_hash(str(staged.path))
+    discard_snapshot(staged)
+    assert not staged.path.exists()
+
+    known = KnownHistory(staged.hash, None)
+    unchanged = stage_history("user1", path, known, live=True)
+    assert unchanged.path == path and not unchanged.snapshot
+
+    staged = stage_history("user1", path, live=True)
+    assert len(staged.tables['visits']) == 3 and not staged.snapshot
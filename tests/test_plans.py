@@ -0,0 +1,33 @@
+from historian import plans
+from historian.history import MultiUserHistory
+from historian.models import Urls
+from historian.plans import check_query_plans, full_scans
+from tests.test_history import make_chain
+
+
+def merge_chains(tmpdir):
+    histories = tmpdir.mkdir("histories")
+    make_chain(histories.join("user1"), 30)
+    make_chain(histories.join("user2"), 20)
+    paths = sorted(str(path) for path in histories.listdir())
+    return MultiUserHistory(paths, str(tmpdir.join("merged.db")))
+
+
+def test_check_query_plans(tmpdir):
+    queries = check_query_plans(merge_chains(tmpdir))
+    assert len(queries) > 20
+    assert {plan.sql: full_scans(plan) for plan in queries if full_scans(plan)} == {}
+
+
+def test_check_query_plans_full_scan(tmpdir, monkeypatch):
+    exercise_library = plans.exercise_library
+
+    def exercise_unindexed(hist, visit):
+        exercise_library(hist, visit)
+        list(Urls.select().where(Urls.title == 'Page 1'))
+    monkeypatch.setattr(plans, 'exercise_library', exercise_unindexed)
+
+    scans = [plan for plan in check_query_plans(merge_chains(tmpdir)) if full_scans(plan)]
+    assert len(scans) == 1
+    assert '"title" = ?' in scans[0].sql
+    assert scans[0].params == ['Page 1']
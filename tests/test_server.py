@@ -0,0 +1,50 @@
+import os
+import signal
+import socket
+import time
+import urllib.request
+from multiprocessing import get_context
+
+from historian import server
+from historian.server import serve_workers
+
+
+def worker_pid(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode()]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def get_worker(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            with urllib.request.urlopen('http://127.0.0.1:{}/'.format(port), timeout=1) as response:
+                return int(response.read())
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def test_serve_workers_respawn(monkeypatch, capfd):
+    monkeypatch.setattr(server, 'RESTART_DELAY', 0)
+    port = free_port()
+    parent = get_context('fork').Process(target=serve_workers, args=(worker_pid, '127.0.0.1', port, 1))
+    parent.start()
+    try:
+        worker = get_worker(port)
+        os.kill(worker, signal.SIGKILL)
+        respawned = get_worker(port)
+        assert respawned not in (worker, parent.pid)
+    finally:
+        parent.terminate()
+        parent.join(10)
+    assert parent.exitcode == 0
+    restarted = "Worker {} was killed by signal {}, restarting it".format(worker, int(signal.SIGKILL))
+    assert restarted in capfd.readouterr().out
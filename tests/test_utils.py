@@ -1,5 +1,9 @@
 from datetime import datetime
-from historian.utils import webkit_datetime, hash_file, get_dbs
+
+import pytest
+
+from historian.utils import webkit_datetime, hash_file, get_dbs, file_fingerprint, fts_query, \
+    encode_cursor, decode_cursor, hash_digest, history_hash
 
 
 def test_webkit_datetime():
@@ -13,6 +17,27 @@ def test_hash_file(tmpdir):
     testfile.write("test")
     print(testfile.read())
     assert hash_file(str(testfile)) == "9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"
+    assert hash_file(str(testfile), 'blake2b') == (
+        "a71079d42853dea26e453004338670a53814b78137ffbed07603a41d76a483aa"
+        "9bc33b582f77d30a65e6f29a896c0411f38312e1d66e0bf16386c86a89bea572")
+
+
+def test_history_hash(tmpdir):
+    testfile = tmpdir.join("test.txt")
+    testfile.write("test")
+    assert history_hash(str(testfile)) == "sha256:" + hash_file(str(testfile))
+    assert hash_digest(history_hash(str(testfile), 'blake2b')) == 'blake2b'
+
+
+def test_file_fingerprint(tmpdir):
+    testfile = tmpdir.join("test.txt")
+    testfile.write("test")
+    fingerprint = file_fingerprint(str(testfile))
+    assert fingerprint.size == 4
+    assert file_fingerprint(str(testfile)) == fingerprint
+
+    testfile.write("tested")
+    assert file_fingerprint(str(testfile)) != fingerprint
 
 
 def test_get_dbs(tmpdir):
@@ -24,3 +49,16 @@ def test_get_dbs(tmpdir):
     dbs = get_dbs(str(tmpdir))
     assert str(user1) in dbs
     assert str(user2) in dbs
+
+
+def test_fts_query():
+    assert fts_query("github.com chrome") == '"github.com" "chrome"'
+    assert fts_query(' say "hi" ') == '"say" """hi"""'
+
+
+def test_cursor():
+    cursor = encode_cursor('after', [13109575048813599, 2, 58067])
+    assert decode_cursor(cursor) == ('after', (13109575048813599, 2, 58067))
+
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
@@ -0,0 +1,87 @@
+import pathlib
+import threading
+import time
+
+from historian.utils import file_fingerprint
+from historian.watch import is_valid, scan_histories, watch_histories
+from tests.test_merge import make_history
+
+
+class FakeHistory:
+    def __init__(self):
+        self.dbs = {}
+        self.refreshed = []
+
+    def refresh(self, usernames, dropped):
+        self.refreshed.append((usernames, dropped))
+
+
+def test_scan_histories(tmpdir):
+    make_history(tmpdir.join("user1"))
+    make_history(tmpdir.join("user2"))
+
+    histories = scan_histories(str(tmpdir))
+    assert sorted(histories) == ["user1", "user2"]
+    assert histories["user1"] == file_fingerprint(str(tmpdir.join("user1")))
+
+
+def test_is_valid(tmpdir):
+    assert is_valid(make_history(tmpdir.join("user1")))
+
+    tmpdir.join("user2").write("not a history")
+    assert not is_valid(pathlib.Path(str(tmpdir.join("user2"))))
+
+
+def test_watch_histories(tmpdir):
+    make_history(tmpdir.join("user1"))
+    make_history(tmpdir.join("user2"))
+    hist = FakeHistory()
+    stop = threading.Event()
+    thread = threading.Thread(target=watch_histories, args=(hist, str(tmpdir)),
+                              kwargs={'settle': 0.05, 'poll': 0.05, 'stop': stop})
+    thread.start()
+    try:
+        time.sleep(0.1)
+        make_history(tmpdir.join("user3"))
+        tmpdir.join("user2").remove()
+        tmpdir.join("user4").write("not a history")
+
+        deadline = time.monotonic() + 5
+        while not hist.refreshed and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert hist.refreshed[0] == (["user3"], ["user2"])
+    assert sorted(hist.dbs) == ["user1", "user3", "user4"]
+
+
+def test_watch_histories_retries(tmpdir):
+    make_history(tmpdir.join("user1"))
+    hist = FakeHistory()
+    failures = [OSError("database is locked")]
+
+    def refresh(usernames, dropped):
+        if failures:
+            raise failures.pop()
+        hist.refreshed.append((usernames, dropped))
+    hist.refresh = refresh
+
+    stop = threading.Event()
+    thread = threading.Thread(target=watch_histories, args=(hist, str(tmpdir)),
+                              kwargs={'settle': 0.05, 'poll': 0.05, 'stop': stop})
+    thread.start()
+    try:
+        time.sleep(0.1)
+        make_history(tmpdir.join("user2"))
+
+        deadline = time.monotonic() + 5
+        while not hist.refreshed and time.monotonic() < deadline:
+            time.sleep(0.05)
+    finally:
+        stop.set()
+        thread.join()
+
+    assert not failures
+    assert hist.refreshed == [(["user2"], [])]